@@ -0,0 +1,194 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import queue
+import threading
+import logging
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+
+class DeadlineExceeded(Exception):
+    """ Exception raised when the time budget of the operation being done (usually, the handling of a Telegram Update) runs out """
+    def __init__(self, name):
+
+        self.name = name
+        self.message = f'Deadline of {name} exceeded'
+
+        super().__init__(self.message)
+
+    def __str__(self):
+        return self.message
+
+
+class Deadline:
+    """ Point in time when an operation must be finished
+
+    Params:
+        budget (float): Seconds from the start of the operation until the deadline
+        name (string): Name of the operation (like the name of the handler that received the Update)
+        started_at (float) (optional): When the operation started ('time.monotonic()'). Defaults to now
+    """
+
+    def __init__(self, budget, name, started_at=None):
+        self.name = name
+        self.budget = budget
+        self.expires_at = (started_at if started_at is not None else time.monotonic()) + budget
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+
+# Deadline of the current thread (or task). Threads started to work on part of an operation must copy the context
+# of the thread that started them ('contextvars.copy_context().run') to keep the deadline.
+_CURRENT_DEADLINE = contextvars.ContextVar('deadline', default=None)
+
+# When the item the current thread is working on was put on its TimedQueue (see below)
+_RECEIVED_AT = contextvars.ContextVar('received_at', default=None)
+
+_EXCEEDED_COUNTS = {}
+_EXCEEDED_LOCK = threading.Lock()
+
+
+def current_deadline():
+    return _CURRENT_DEADLINE.get()
+
+
+class TimedQueue(queue.Queue):
+    """ Queue that records when each item was put on it. Getting an item makes that time the start of the deadlines set by
+    'with_deadline' on the thread that got it, so they also count the time the item waited on the queue (like Telegram
+    Updates waiting for the dispatcher, that handles one at a time) """
+
+    def _put(self, item):
+        super()._put((time.monotonic(), item))
+
+    def _get(self):
+        received_at, item = super()._get()
+        _RECEIVED_AT.set(received_at) # Runs on the thread calling 'get'
+        return item
+
+
+@contextlib.contextmanager
+def deadline_scope(budget, name, started_at=None):
+    """ Context manager that sets a deadline 'budget' seconds from now (or from 'started_at', a 'time.monotonic()' time) for
+    everything done inside it. Nested scopes can only make the deadline earlier """
+
+    deadline = Deadline(budget, name, started_at)
+
+    outer_deadline = _CURRENT_DEADLINE.get()
+    if outer_deadline is not None and outer_deadline.expires_at < deadline.expires_at:
+        deadline = outer_deadline
+
+    token = _CURRENT_DEADLINE.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _CURRENT_DEADLINE.reset(token)
+
+
+def remaining_time(default=None):
+    """ Get how many seconds are left until the current deadline (at most 'default'). Returns 'default' if there is no deadline
+
+    Raises:
+        DeadlineExceeded: Raised if the current deadline has already passed
+    """
+
+    deadline = _CURRENT_DEADLINE.get()
+    if deadline is None:
+        return default
+
+    remaining = deadline.remaining()
+    if remaining <= 0:
+        raise DeadlineExceeded(deadline.name)
+
+    if default is None:
+        return remaining
+    return min(default, remaining)
+
+
+def check_deadline():
+    """ Raises DeadlineExceeded if the current deadline has already passed """
+    remaining_time()
+
+
+def get_timeout(connect_timeout, read_timeout):
+    """ Get the timeout for a network call: the configured hard timeouts, reduced to the time left until the current deadline
+
+    Returns:
+        Tuple (connect timeout, read timeout), in seconds
+
+    Raises:
+        DeadlineExceeded: Raised if the current deadline has already passed
+    """
+    return (remaining_time(connect_timeout), remaining_time(read_timeout))
+
+
+def sleep_within_deadline(seconds):
+    """ Sleep for 'seconds', unless that would go past the current deadline
+
+    Raises:
+        DeadlineExceeded: Raised (without sleeping) if the deadline would pass during the sleep
+    """
+
+    deadline = _CURRENT_DEADLINE.get()
+    if deadline is not None and deadline.remaining() <= seconds:
+        raise DeadlineExceeded(deadline.name)
+
+    time.sleep(seconds)
+
+
+async def sleep_within_deadline_async(seconds):
+    """ asyncio version of 'sleep_within_deadline' (the deadline is the one of the current task)
+
+    Raises:
+        DeadlineExceeded: Raised (without sleeping) if the deadline would pass during the sleep
+    """
+
+    deadline = _CURRENT_DEADLINE.get()
+    if deadline is not None and deadline.remaining() <= seconds:
+        raise DeadlineExceeded(deadline.name)
+
+    await asyncio.sleep(seconds)
+
+
+def record_exceeded(name):
+    with _EXCEEDED_LOCK:
+        _EXCEEDED_COUNTS[name] = _EXCEEDED_COUNTS.get(name, 0) + 1
+
+
+def get_exceeded_counts() -> dict:
+    """ Get how many times the deadline was exceeded, for each operation (handler) name """
+    with _EXCEEDED_LOCK:
+        return dict(_EXCEEDED_COUNTS)
+
+
+def with_deadline(function, budget, name=None, on_exceeded=None):
+    """ Wraps 'function' so each call to it runs under a new deadline of 'budget' seconds, counted from when the item being
+    handled by the thread was received on a TimedQueue (or from the call, if there's none). If the deadline is exceeded, the
+    event is counted and 'on_exceeded' is called with the same arguments (its return value is returned)
+
+    Args:
+        function (callable): Function to be wrapped (like a Telegram handler callback)
+        budget (float): Time budget of each call, in seconds
+        name (string) (optional): Name used on the counters. Defaults to the function name
+        on_exceeded (callable) (optional): Called when the deadline is exceeded. If None, DeadlineExceeded is raised again
+    """
+
+    name = name or function.__name__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with deadline_scope(budget, name, _RECEIVED_AT.get()):
+            try:
+                return function(*args, **kwargs)
+            except DeadlineExceeded:
+                record_exceeded(name)
+                LOGGER.warning('Deadline of %s seconds exceeded on %s', budget, name)
+
+                if on_exceeded is None:
+                    raise
+                return on_exceeded(*args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,125 @@
+import hashlib
+import threading
+import logging
+import yaml
+
+from redis import RedisError
+
+from .resilience import get_resilience
+from .sharding import get_user_shards
+from .user_layout import legacy_key
+
+LOGGER = logging.getLogger(__name__)
+
+
+def http_cache_key(chat_id) -> str:
+    """ Redis key (a hash, on the shard of the user) of the responses stored for an user """
+    return legacy_key(chat_id, 'http_cache')
+
+
+class SpotifyHTTPCache:
+    """ HTTP cache of Spotify GET responses based on ETags, stored on Redis (so all bot replicas share it).
+
+    Responses with an 'ETag' header are stored together with it. The next time the same resource is requested, the stored
+    ETag is sent on header 'If-None-Match' and, if Spotify answers 304 (Not Modified), the stored body is used, saving its
+    download (and the work of building it on Spotify's side).
+
+    Responses depend on the user, so only requests sent on behalf of one are cached. The responses of an user are fields of a
+    single hash on their shard ('user:[id]:http_cache'), removed with the rest of their data (see
+    UserKeyLayout.queue_delete_user), and kept for 'ttl' seconds after the last one was stored.
+
+    A Redis error never fails a request: it's treated as a cache miss.
+
+    Params:
+        shards (ConsistentHashRing): Redis clients of the shards where the data of users is stored
+        endpoints (list of strings): Endpoint classes that are cached (see EndpointResilience.endpoint_for)
+        ttl (int): Seconds stored responses are kept
+    """
+
+    def __init__(self, shards, endpoints, ttl=86400):
+        self.shards = shards
+        self.endpoints = set(endpoints)
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'stores': 0, 'bytes_saved': 0}
+
+    def _count(self, stat, amount=1):
+        with self._lock:
+            self._stats[stat] += amount
+
+    def is_cacheable(self, method, url, chat_id) -> bool:
+        return method.upper() == 'GET' and chat_id is not None and get_resilience().endpoint_for(url) in self.endpoints
+
+    def key_for(self, url, params) -> str:
+        """ Identity of a resource, among the ones stored for the same user """
+
+        params = sorted((str(key), str(val)) for key, val in (params or {}).items())
+        return hashlib.sha256(repr((url, params)).encode('utf-8')).hexdigest()
+
+    def lookup(self, chat_id, key):
+        """ Get the stored response of a resource requested on behalf of user 'chat_id'
+
+        Returns:
+            Tuple (ETag, body bytes), or None if nothing is stored
+        """
+
+        try:
+            etag, body = self.shards.get_node(chat_id).hmget(http_cache_key(chat_id), key + ':etag', key + ':body')
+        except RedisError:
+            LOGGER.exception('Could not read HTTP cache')
+            return None
+
+        if etag is None or body is None:
+            return None
+        return etag.decode('utf-8'), body
+
+    def store(self, chat_id, key, etag, body):
+        try:
+            pipeline = self.shards.get_node(chat_id).pipeline(transaction=False)
+            pipeline.hset(http_cache_key(chat_id), mapping={key + ':etag': etag, key + ':body': body})
+            pipeline.expire(http_cache_key(chat_id), self.ttl)
+            pipeline.execute()
+            self._count('stores')
+        except RedisError:
+            LOGGER.exception('Could not write on HTTP cache')
+
+    def record_hit(self, body):
+        self._count('hits')
+        self._count('bytes_saved', len(body))
+
+    def record_miss(self):
+        self._count('misses')
+
+    def get_stats(self) -> dict:
+        """ Get cache metrics: responses served from cache after a 304 ('hits'), conditional requests that got a new body or
+        requests without a stored response ('misses'), responses stored ('stores') and body bytes not downloaded ('bytes_saved') """
+        with self._lock:
+            return dict(self._stats)
+
+
+_HTTP_CACHE = None
+_HTTP_CACHE_LOCK = threading.Lock()
+
+
+def get_http_cache() -> SpotifyHTTPCache:
+    """ Get the process-wide HTTP cache, creating it on first use with the settings found under the 'httpCache' section
+    of 'config.yaml' """
+
+    global _HTTP_CACHE
+
+    if _HTTP_CACHE is None:
+        with _HTTP_CACHE_LOCK:
+            if _HTTP_CACHE is None:
+                with open('config.yaml', 'r') as f:
+                    config = yaml.safe_load(f)
+
+                cache_config = config.get('httpCache') or {}
+
+                _HTTP_CACHE = SpotifyHTTPCache(
+                    get_user_shards(),
+                    endpoints=cache_config.get('endpoints', []),
+                    ttl=cache_config.get('ttl', 86400)
+                )
+
+    return _HTTP_CACHE
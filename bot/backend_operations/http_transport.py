@@ -0,0 +1,171 @@
+import threading
+import logging
+import yaml
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from .deadline import get_timeout
+
+LOGGER = logging.getLogger(__name__)
+
+
+class _ConnectionCounter:
+    """ Thread-safe counters of how many requests were sent and how many new TCP (and TLS) connections had to be opened
+    to send them. Every request that did not need a new connection reused a kept-alive one """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def count_new_connection(self):
+        with self._lock:
+            self.new_connections += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'new_connections': self.new_connections,
+                'reused_connections': max(self.requests - self.new_connections, 0)
+            }
+
+
+_CONNECTION_COUNTER = _ConnectionCounter()
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        _CONNECTION_COUNTER.count_new_connection()
+        return super()._new_conn()
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        _CONNECTION_COUNTER.count_new_connection()
+        return super()._new_conn()
+
+
+class _CountingHTTPAdapter(HTTPAdapter):
+    """ HTTP Adapter whose connection pools count every new connection opened """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+
+        # A new dict is needed: by default, all pool managers share urllib3's module level one
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _CountingHTTPConnectionPool,
+            'https': _CountingHTTPSConnectionPool
+        }
+
+    def send(self, request, **kwargs):
+        _CONNECTION_COUNTER.count_request()
+        return super().send(request, **kwargs)
+
+
+class HTTPTransport:
+    """ Process-wide HTTP transport with keep-alive connection pooling, used for every call to the Spotify API (and
+    the Spotify token endpoint).
+
+    A single adapter (which owns the connection pools, one pool per host) is shared by all threads. As a requests.Session
+    is not fully thread-safe (cookies, for example), each thread gets its own lightweight session with that adapter mounted.
+
+    Params:
+        pool_connections (int): How many hosts can have a connection pool at the same time
+        pool_maxsize (int): Maximum number of kept-alive connections stored per host
+        pool_block (bool): If a thread should wait for a free connection when the pool of a host is full (if False,
+            a new connection is opened and discarded after use)
+        connect_timeout (float): Maximum seconds to establish a connection
+        read_timeout (float): Maximum seconds waiting for data from the server
+    """
+
+    def __init__(self, pool_connections=4, pool_maxsize=16, pool_block=False, connect_timeout=3.05, read_timeout=10):
+
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+        self._adapter = _CountingHTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block
+        )
+        self._local = threading.local()
+
+    def _get_session(self) -> requests.Session:
+        """ Get the session of the current thread, creating it if needed """
+
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('https://', self._adapter)
+            session.mount('http://', self._adapter)
+            self._local.session = session
+
+        return session
+
+    def request(self, method, url, **kwargs) -> requests.Response:
+        """ Send HTTP request throught the shared connection pool. Accepts the same arguments as 'requests.request'.
+
+        If no timeout is given, the configured ones are used, reduced to the time left until the current deadline (see deadline.py)
+
+        Raises:
+            DeadlineExceeded: Raised if the current deadline has already passed
+        """
+
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = get_timeout(self.connect_timeout, self.read_timeout)
+
+        return self._get_session().request(method=method, url=url, **kwargs)
+
+    def post(self, url, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def get_stats(self) -> dict:
+        """ Get connection counters
+
+        Returns:
+            Dict with the number of requests sent ('requests'), connections opened ('new_connections') and requests
+            that reused a kept-alive connection ('reused_connections')
+        """
+        return _CONNECTION_COUNTER.snapshot()
+
+    def close(self):
+        """ Close all pooled connections """
+        self._adapter.close()
+
+
+_TRANSPORT = None
+_TRANSPORT_LOCK = threading.Lock()
+
+
+def get_transport() -> HTTPTransport:
+    """ Get the process-wide HTTP transport, creating it on first use with the pool settings found under the 'http'
+    section of 'config.yaml' (defaults are used for missing fields) """
+
+    global _TRANSPORT
+
+    if _TRANSPORT is None:
+        with _TRANSPORT_LOCK:
+            if _TRANSPORT is None:
+                with open('config.yaml', 'r') as f:
+                    http_config = yaml.safe_load(f).get('http') or {}
+
+                _TRANSPORT = HTTPTransport(
+                    pool_connections=http_config.get('poolConnections', 4),
+                    pool_maxsize=http_config.get('poolMaxSize', 16),
+                    pool_block=http_config.get('poolBlock', False),
+                    connect_timeout=http_config.get('connectTimeout', 3.05),
+                    read_timeout=http_config.get('readTimeout', 10)
+                )
+                LOGGER.info('HTTP transport created (pool size per host: %s)', _TRANSPORT.pool_maxsize)
+
+    return _TRANSPORT
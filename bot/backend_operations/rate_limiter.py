@@ -0,0 +1,259 @@
+import threading
+import logging
+import random
+import time
+import yaml
+
+from redis import RedisError
+
+from .deadline import sleep_within_deadline
+from .redis_connection import get_redis
+
+LOGGER = logging.getLogger(__name__)
+
+
+# Token bucket, refilled continuously at 'rate' tokens per second up to 'capacity'. Uses the Redis server clock, so every
+# bot replica sees the same bucket. If the Spotify API has asked us to wait (429 with Retry-After), no token is given
+# until the block key expires.
+#
+# Returns: {allowed (0 or 1), seconds to wait before trying again, tokens left}. Floats are returned as strings, as Lua
+# numbers are converted to integers when returned to Redis clients
+_TOKEN_BUCKET_SCRIPT = """
+local bucket_key = KEYS[1]
+local block_key = KEYS[2]
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+
+local redis_time = redis.call('TIME')
+local now = tonumber(redis_time[1]) + tonumber(redis_time[2]) / 1000000
+
+local bucket = redis.call('HMGET', bucket_key, 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(now - ts, 0) * rate)
+
+local blocked_ms = redis.call('PTTL', block_key)
+local allowed = 0
+local wait = 0
+
+if blocked_ms > 0 then
+    wait = blocked_ms / 1000
+elseif tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    wait = (1 - tokens) / rate
+end
+
+redis.call('HSET', bucket_key, 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', bucket_key, math.ceil(capacity / rate) + 60)
+
+return {allowed, tostring(wait), tostring(tokens)}
+"""
+
+
+class SpotifyRateLimiter:
+    """ Application-wide rate limiter for calls to the Spotify Web API, shared by all bot replicas throught Redis.
+
+    Every request must call 'acquire' before being sent. When Spotify answers with 429 (Too Many Requests), 'block' stops
+    every replica from sending requests for the time asked on the 'Retry-After' header.
+
+    If Redis is unavailable, requests are let through (the limiter only protects from 429 responses, it's not worth
+    failing operations for it) and Redis is not tried again for some seconds.
+
+    Params:
+        redis (Redis): Redis client where the bucket is stored
+        rate (float): Tokens (requests) added to the bucket per second
+        capacity (int): Maximum tokens on the bucket (size of a burst of requests)
+        jitter (float): Maximum random time (in seconds) added to each wait, so waiting threads don't all wake up together
+        max_retries (int): How many times a request that got a 429 response is sent again
+        key_prefix (string): Prefix of the Redis keys used
+    """
+
+    # Seconds without trying to use Redis after a Redis error
+    REDIS_RETRY_INTERVAL = 5
+
+    def __init__(self, redis, rate=10, capacity=20, jitter=0.5, max_retries=3, key_prefix='spotify:rate_limit'):
+        self.redis = redis
+        self.rate = rate
+        self.capacity = capacity
+        self.jitter = jitter
+        self.max_retries = max_retries
+
+        self.bucket_key = key_prefix + ':bucket'
+        self.block_key = key_prefix + ':blocked'
+
+        self._script = self.redis.register_script(_TOKEN_BUCKET_SCRIPT)
+
+        self._lock = threading.Lock()
+        self._redis_disabled_until = 0
+        self._stats = {
+            'acquired': 0,
+            'throttled': 0, # Calls that had to wait for a token at least once
+            'throttle_wait_seconds': 0.0,
+            'rate_limited_responses': 0 # 429 responses received
+        }
+
+    def _count(self, stat, amount=1):
+        with self._lock:
+            self._stats[stat] += amount
+
+    def _redis_available(self) -> bool:
+        return time.monotonic() >= self._redis_disabled_until
+
+    def _disable_redis(self):
+        LOGGER.exception('Rate limiter could not acess Redis. Letting requests through for %s seconds', self.REDIS_RETRY_INTERVAL)
+        self._redis_disabled_until = time.monotonic() + self.REDIS_RETRY_INTERVAL
+
+    def try_acquire(self) -> float:
+        """ Take a token for sending a request to the Spotify API, if there's one, without waiting for it
+
+        Returns:
+            0 if the request can be sent now. Otherwise, seconds to wait (with jitter) before trying again
+        """
+
+        if not self._redis_available():
+            return 0.0
+
+        try:
+            allowed, wait, _ = self._script(keys=[self.bucket_key, self.block_key], args=[self.rate, self.capacity])
+        except RedisError:
+            self._disable_redis()
+            return 0.0
+
+        if int(allowed):
+            return 0.0
+        return max(float(wait), 0.001) + random.uniform(0, self.jitter)
+
+    def record_acquired(self, waited):
+        """ Count a token taken (with 'try_acquire') after waiting 'waited' seconds for it """
+
+        self._count('acquired')
+        if waited > 0:
+            self._count('throttled')
+            self._count('throttle_wait_seconds', waited)
+
+    def acquire(self):
+        """ Block until a request can be sent to the Spotify API
+
+        Returns:
+            Time waited, in seconds (float)
+        """
+
+        waited = 0.0
+        wait = self.try_acquire()
+        while wait > 0:
+            sleep_within_deadline(wait)
+            waited += wait
+            wait = self.try_acquire()
+
+        self.record_acquired(waited)
+        return waited
+
+    def block(self, retry_after):
+        """ Stop all requests (from all replicas) for 'retry_after' seconds. Called when a 429 response is received
+
+        Args:
+            retry_after (float): Seconds to wait, as sent by Spotify on header 'Retry-After'
+        """
+
+        self._count('rate_limited_responses')
+
+        if not self._redis_available():
+            return
+
+        try:
+            # Only extends the current block (if any), never shortens it
+            current_block_ms = self.redis.pttl(self.block_key)
+            retry_after_ms = max(int(retry_after * 1000), 1)
+            if current_block_ms is None or current_block_ms < retry_after_ms:
+                self.redis.set(self.block_key, 1, px=retry_after_ms)
+        except RedisError:
+            self._disable_redis()
+
+    def wait_retry_after(self, response):
+        """ Handle a 429 response: block all replicas for the time asked by Spotify and wait for it (plus jitter)
+
+        Returns:
+            Time waited, in seconds (float)
+        """
+
+        retry_after = get_retry_after(response)
+        self.block(retry_after)
+
+        wait = retry_after + random.uniform(0, self.jitter)
+        sleep_within_deadline(wait)
+        self._count('throttle_wait_seconds', wait)
+
+        return wait
+
+    def get_budget(self):
+        """ Get how many requests can be sent right now without waiting (float), or None if it could not be read """
+
+        try:
+            if self.redis.pttl(self.block_key) > 0:
+                return 0.0
+
+            tokens, ts = self.redis.hmget(self.bucket_key, 'tokens', 'ts')
+            if tokens is None or ts is None:
+                return float(self.capacity)
+
+            seconds, microseconds = self.redis.time()
+            now = seconds + microseconds / 1000000
+            return min(float(self.capacity), float(tokens) + max(now - float(ts), 0) * self.rate)
+        except RedisError:
+            LOGGER.exception('Could not read rate limiter budget')
+            return None
+
+    def get_stats(self) -> dict:
+        """ Get rate limiter metrics
+
+        Returns:
+            Dict with the current budget ('budget'), calls that acquired a token ('acquired'), calls that had to wait ('throttled'),
+            total time waited ('throttle_wait_seconds') and number of 429 responses ('rate_limited_responses')
+        """
+
+        with self._lock:
+            stats = dict(self._stats)
+        stats['budget'] = self.get_budget()
+
+        return stats
+
+
+def get_retry_after(response, default=1.0) -> float:
+    """ Get how many seconds the Spotify API asked us to wait from a 429 response (header 'Retry-After') """
+
+    try:
+        return max(float(response.headers.get('Retry-After', default)), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+
+_RATE_LIMITER = None
+_RATE_LIMITER_LOCK = threading.Lock()
+
+
+def get_rate_limiter() -> SpotifyRateLimiter:
+    """ Get the process-wide Spotify rate limiter, creating it on first use with the settings found under the 'rateLimit'
+    section of 'config.yaml' """
+
+    global _RATE_LIMITER
+
+    if _RATE_LIMITER is None:
+        with _RATE_LIMITER_LOCK:
+            if _RATE_LIMITER is None:
+                with open('config.yaml', 'r') as f:
+                    config = yaml.safe_load(f)
+
+                rate_limit_config = config.get('rateLimit') or {}
+                redis = get_redis(db = 0)
+
+                _RATE_LIMITER = SpotifyRateLimiter(
+                    redis,
+                    rate=rate_limit_config.get('requestsPerSecond', 10),
+                    capacity=rate_limit_config.get('burst', 20),
+                    jitter=rate_limit_config.get('jitter', 0.5),
+                    max_retries=rate_limit_config.get('maxRetries', 3)
+                )
+
+    return _RATE_LIMITER
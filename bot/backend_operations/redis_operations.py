@@ -3,12 +3,34 @@ import base64
 import yaml
 import os
 import logging
-import json
-
-from redis import Redis, RedisError
+import secrets
+import contextlib
+import threading
+import time
+import types
+
+from redis import Redis, RedisError, TimeoutError as RedisTimeoutError
+from redis.client import Pipeline
+
+from .http_transport import get_transport
+from .request_scheduler import get_scheduler, INTERACTIVE
+from .resilience import get_resilience, CircuitOpenError
+from .deadline import check_deadline, remaining_time, sleep_within_deadline, DeadlineExceeded
+from .token_cache import AccessTokenCache
+from .redis_connection import get_redis
+from .sharding import get_user_shards
+from .top_items_cache import queue_invalidate_top_items
+from . import value_codec
+from .user_layout import UserKeyLayout, LEGACY, USER, SEEDS, ATTRIBUTES, legacy_key
 
 LOGGER = logging.getLogger(__name__)
 
+_TRACK_URI_PREFIX = 'spotify:track:'
+
+
+def playlist_mirror_key(chat_id) -> str:
+    return legacy_key(chat_id, 'playlist')
+
 
 class AlreadyLoggedInException(Exception):
     """ Exception Class that holds all the needed Redis connections and functions related to
@@ -41,23 +63,150 @@ class TokenRequestException(Exception):
     """ Exception class used to represent some kind of internal error during processo of obtaining
     user tokens from the Spotify API """
 
+# Deletes the lock only if it's still owned by whoever is releasing it (it may have expired and been taken by someone else)
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Sorted sets (member: chat ID) with the expiration time of each stored acess token and the last time each user was active
+# (both as UNIX timestamps), used by the background token refresher (see token_refresher.py)
+TOKEN_EXPIRY_KEY = 'tokens:expiry'
+USER_ACTIVITY_KEY = 'tokens:last_active'
+
+class _DeadlineReplies:
+    """ Waits for each reply from Redis no longer than until the current deadline (see deadline.py), instead of the whole
+    socket timeout (for clients and pipelines) """
+
+    def parse_response(self, connection, command_name, **options):
+        try:
+            timeout = remaining_time(connection.socket_timeout)
+        except DeadlineExceeded:
+            connection.disconnect() # The reply would be left unread on the connection
+            raise
+
+        sock = connection._sock
+        if sock is None or timeout == connection.socket_timeout:
+            return super().parse_response(connection, command_name, **options)
+
+        sock.settimeout(timeout)
+        try:
+            return super().parse_response(connection, command_name, **options)
+        except RedisTimeoutError:
+            check_deadline() # A timeout caused by the end of the deadline is reported as such (not retried)
+            raise
+        finally:
+            # The connection is dropped on timeouts (so there may be no socket anymore)
+            if connection._sock is sock:
+                sock.settimeout(connection.socket_timeout)
+
+
+class _DeadlinePipeline(_DeadlineReplies, Pipeline):
+    """ Redis pipeline that refuses to send its commands after the current deadline has passed """
+
+    def execute(self, raise_on_error=True):
+        check_deadline()
+        return super().execute(raise_on_error)
+
+
+class _DeadlineRedis(_DeadlineReplies, Redis):
+    """ Redis client that refuses to send commands after the current deadline (see deadline.py) has passed, and waits for
+    their replies only until it passes """
+
+    def execute_command(self, *args, **options):
+        check_deadline()
+        return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return _DeadlinePipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+def _freeze(value):
+    """ Read-only version of a decoded JSON value (dicts become mapping proxies and lists, tuples) """
+
+    if isinstance(value, dict):
+        return types.MappingProxyType({key: _freeze(val) for key, val in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(val) for val in value)
+    return value
+
+
+class UserProfileSnapshot:
+    """ Immutable snapshot of what is stored about an user: the fields of 'user:[id]' (except tokens), the seeds of 'user:[id]:seeds'
+    and the survey attributes of 'user:[id]:attributes', as they were when it was loaded (see RedisAcess.get_user_profile)
+
+    Params:
+        chat_id (int or string): ID of Telegram Bot chat
+        user_hash (dict): Fields of 'user:[id]' (field names as strings, values as bytes)
+        seeds_hash (dict): Fields of 'user:[id]:seeds'
+        attributes_hash (dict): Fields of 'user:[id]:attributes'
+    """
+
+    __slots__ = ('_chat_id', '_user_id', '_playlist_id', '_artists', '_tracks', '_attributes')
+
+    def __init__(self, chat_id, user_hash, seeds_hash, attributes_hash):
+
+        def decode(value):
+            return None if value is None else value.decode('utf-8')
+
+        def decode_seeds(value, type_entity):
+            return None if value is None else _freeze(value_codec.decode_seeds(value, type_entity))
+
+        object.__setattr__(self, '_chat_id', chat_id)
+        object.__setattr__(self, '_user_id', decode(user_hash.get('user_id')))
+        object.__setattr__(self, '_playlist_id', decode(user_hash.get('playlist_id')))
+        object.__setattr__(self, '_artists', decode_seeds(seeds_hash.get('artists'), 'artists'))
+        object.__setattr__(self, '_tracks', decode_seeds(seeds_hash.get('tracks'), 'tracks'))
+        object.__setattr__(self, '_attributes', types.MappingProxyType(
+            {key: _freeze(value_codec.decode(val)) for key, val in attributes_hash.items()}
+        ))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('UserProfileSnapshot is immutable')
+
+    @property
+    def chat_id(self):
+        return self._chat_id
+
+    @property
+    def user_id(self):
+        """ Spotify User ID (or None) """
+        return self._user_id
+
+    @property
+    def playlist_id(self):
+        """ Spotify Playlist ID (or None) """
+        return self._playlist_id
+
+    @property
+    def artists(self):
+        """ Seed artists (tuple, or None if none were selected) """
+        return self._artists
+
+    @property
+    def tracks(self):
+        """ Seed tracks (tuple, or None if none were selected) """
+        return self._tracks
+
+    @property
+    def attributes(self):
+        """ All survey attributes (read-only mapping of attribute name to its values) """
+        return self._attributes
+
+    def get_survey_attribute(self, attribute):
+        """ Get attribute values registered during survey process (see RedisAcess.get_survey_attribute), or None """
+        return self._attributes.get(attribute)
+
+
 class RedisAcess:
     """ Class that gives acess to al Redis databases and functions related to getting and setting values """
-    def __init__(self):
 
-        self.redis = Redis(
-            host = 'redis',
-            port = 6379,
-            #password=,
-            db = 0 # Used for memcache the acess token into telegram bot
-        )
+    # Seconds a copy of the tracks of a playlist is kept (see 'register_playlist_mirror')
+    PLAYLIST_MIRROR_TTL = 2592000
 
-        self.memcache = Redis(
-            host = 'redis',
-            port = 6379,
-            #password=,
-            db = 1 # Memcache, filled on webserver side (to be delete when recieved here)
-        )
+    def __init__(self):
 
         with open('config.yaml') as f:
             config = yaml.safe_load(f)
@@ -65,9 +214,73 @@ class RedisAcess:
             self.spotify_redirect_url = config['spotify']['url']['redirectURL']
             self.spotify_user_url = config['spotify']['url']['userURL']
 
+        redis_config = config.get('redis') or {}
+
+        # Clients share the connection pools of the process (see redis_connection.py)
+        self.redis = get_redis(db = 0, client_class = _DeadlineRedis) # Data not tied to an user (as chat persistence)
+        self.memcache = get_redis(db = 1, client_class = _DeadlineRedis) # Memcache, filled on webserver side (to be delete when recieved here)
+
+        # All keys of an user (and its entries on the token sorted sets) are stored on the same shard, chosen by its chat ID
+        # (see sharding.py), so they can still be read and written together on a single round trip
+        self.shards = get_user_shards(client_class = _DeadlineRedis, replicas = redis_config.get('shardReplicas', 160))
+
+        # Acess tokens are needed by almost every Spotify call, so they are also kept in memory
+        token_cache_config = config.get('tokenCache') or {}
+        self.token_cache = AccessTokenCache(
+            max_size = token_cache_config.get('maxSize', 1024),
+            safety_margin = token_cache_config.get('safetyMargin', 60),
+            max_ttl = token_cache_config.get('maxTtl', 30)
+        )
+
+        # Only one refresh of the acess token of a chat at a time, across all bot replicas
+        token_refresh_config = config.get('tokenRefresh') or {}
+        self.refresh_lock_timeout = token_refresh_config.get('lockTimeout', 10)
+        self.refresh_poll_interval = token_refresh_config.get('pollInterval', 0.05)
+        self.activity_mark_interval = token_refresh_config.get('activityMarkInterval', 60)
+        self._activity_marks = {} # chat ID -> monotonic time when its activity was last written on Redis
+
+        self._release_lock = self.redis.register_script(_RELEASE_LOCK_SCRIPT)
+        self._refresh_stats_lock = threading.Lock()
+        self._refresh_stats = {'performed': 0, 'deduplicated': 0, 'lock_timeouts': 0}
+
+        # Keys (and fields) where the data of each user is stored (see user_layout.py)
+        self.layout = UserKeyLayout(self.redis, redis_config.get('keyLayout', 'legacy'), redis_config.get('fieldTTL', False))
+
+    def shard(self, chat_id):
+        """ Redis client of the shard where the data of an user is stored """
+        return self.shards.get_node(chat_id)
+
+    def _read(self, chat_id, section, fields):
+        """ Read some fields of a section of the data of an user (list of values, as bytes or None) """
+
+        pipeline = self.shard(chat_id).pipeline(transaction=False)
+        parse = self.layout.queue_read(pipeline, chat_id, section, fields)
+        return parse(iter(pipeline.execute()))
+
+    def _read_section(self, chat_id, section):
+        """ Read all fields of a section of the data of an user (dict of field name to value, as bytes) """
+
+        pipeline = self.shard(chat_id).pipeline(transaction=False)
+        parse = self.layout.queue_read_section(pipeline, chat_id, section)
+        return parse(iter(pipeline.execute()))
+
+    def _write(self, chat_id, section, mapping):
+        """ Write some fields (dict of field name to value) of a section of the data of an user """
+
+        with self.write_batch(chat_id, transaction=self.layout.mode != LEGACY) as batch:
+            self.layout.queue_write(batch, chat_id, section, mapping)
+
+    def _write_seeds(self, chat_id, mapping):
+        """ Write seeds of an user (dict of 'artists' and / or 'tracks' to their encoded values). The cached top items, that
+        seeds are selected from, are dropped with them: the next selection gets them from Spotify """
+
+        with self.write_batch(chat_id, transaction=self.layout.mode != LEGACY) as batch:
+            self.layout.queue_write(batch, chat_id, SEEDS, mapping)
+            queue_invalidate_top_items(batch, chat_id)
+
 
     # TODO: Change for SpotifyRequest class
-    def __user_token_request_process__(self, body_form, is_refresh):
+    def __user_token_request_process__(self, body_form, is_refresh, chat_id=None, priority=INTERACTIVE):
         """
         Unites behavior for getting acess and refresh tokens from Spotify or for getting new acess token
         by using the refresh token
@@ -75,6 +288,8 @@ class RedisAcess:
         Args:
             body_form (dict): Form to be sent to Spotify Token endpoint (body of request)
             is_refresh (boolean): If current request is for refreshing acess code or not
+            chat_id (int or string) (optional): ID of Telegram Bot chat (used for fair queueing of the request)
+            priority (string) (optional): Priority class of the request (INTERACTIVE, unless no user is waiting for it)
 
         Returns:
             Dictionary with response parameters (Acess Token, Expires In and, if it isn't a refresh operation,
@@ -94,9 +309,12 @@ class RedisAcess:
                           os.environ.get('SPOTIFY_CLIENT_SECRECT'), 'utf-8')).decode('utf-8'))
         }
 
-        request = requests.post(self.spotify_token_url, data=body_form, headers=header)
-
         try:
+            request = get_resilience().call(
+                self.spotify_token_url, 'POST',
+                get_scheduler().run, chat_id, priority, get_transport().post, self.spotify_token_url, data=body_form, headers=header
+            )
+
             request.raise_for_status()
             response = request.json() # Dictionary with response
 
@@ -107,7 +325,8 @@ class RedisAcess:
             if not is_refresh:
                 return_params['refresh_token'] = response['refresh_token'] # REFRESH TOKEN
 
-        except requests.HTTPError:
+        except (requests.RequestException, CircuitOpenError):
+            check_deadline() # A timeout caused by the end of the deadline is reported as such
             message = 'Could not get authentication response from Spotify'
             LOGGER.exception(message)
             raise TokenRequestException(message)
@@ -144,15 +363,17 @@ class RedisAcess:
 
         """
 
-        # Get real token from memcache
-        spot_code = self.memcache.get(db_hash)
+        # Get real token from memcache (and remove it, in the same transaction, so it can't be used twice)
+        pipeline = self.memcache.pipeline(transaction=True)
+        pipeline.get(db_hash)
+        pipeline.unlink(db_hash)
+        spot_code, _ = pipeline.execute()
         if not spot_code:
             LOGGER.error(""" Hash {db_hash} was not found on memcache database """.format({db_hash}))
             raise ValueError(""" Invalid hash: Hash {db_hash} not found """.format({db_hash}))
-        self.memcache.delete(db_hash)
 
         # Check if user already has been registered on DB
-        if self.redis.hget(name = 'user' + ':' + str(chat_id), key = 'refresh_token') is not None:
+        if self._read(chat_id, USER, ['refresh_token'])[0] is not None:
             raise AlreadyLoggedInException(chat_id)
 
         # Sending another request, as specified by the Spotify API
@@ -162,7 +383,7 @@ class RedisAcess:
             "grant_type": "authorization_code",
         }
 
-        response_params = self.__user_token_request_process__(auth_form, is_refresh=False)
+        response_params = self.__user_token_request_process__(auth_form, is_refresh=False, chat_id=chat_id)
 
         acess_token = response_params['acess_token']
         refresh_token = response_params['refresh_token']
@@ -171,17 +392,43 @@ class RedisAcess:
         # ! Storing most information about user on a hash map like 'user:[id]' (including acess token)
         # ! The refresh token is kept separate due to the necessity of setting an expiration time only for it
         try:
-            self.redis.set(name = 'user' + ':' + str(chat_id) + ':' + 'acess_token', value = acess_token, ex = expires_in)
-            self.redis.hset(name = 'user' + ':' + str(chat_id), key = 'refresh_token', value = refresh_token)
+            with self.write_batch(chat_id) as batch:
+                self.layout.queue_write_token(batch, chat_id, acess_token, expires_in)
+                self.layout.queue_write(batch, chat_id, USER, {'refresh_token': refresh_token})
+                batch.zadd(TOKEN_EXPIRY_KEY, {str(chat_id): time.time() + expires_in})
+                # May be of another Spotify account
+                queue_invalidate_top_items(batch, chat_id)
         except RedisError:
             LOGGER.error(""" Could not register user '{chat_id}' Spotify Tokens on Redis DB""")
             raise
 
+        self.token_cache.put(chat_id, acess_token, expires_in)
+
+
+    @contextlib.contextmanager
+    def write_batch(self, chat_id, transaction=True):
+        """
+        Group several writes of the data of an user in a single round trip to Redis (to the shard of the user). Commands are
+        queued on the object given by the 'with' statement (a Redis pipeline, with the same methods as a Redis client) and sent
+        together when the block ends. If the block raises an exception, nothing is sent.
+
+        Args:
+            chat_id (int or string): ID of Telegram Bot chat
+            transaction (bool) (optional): If the commands should be applied atomically (wrapped in MULTI / EXEC)
+
+        Raises:
+            RedisError: Raised if there was some internal Redis error
+            DeadlineExceeded: Raised if the current deadline has already passed when the commands are about to be sent
+        """
+
+        with self.shard(chat_id).pipeline(transaction=transaction) as pipeline:
+            yield pipeline
+            pipeline.execute()
 
     def get_spotify_acess_token(self, chat_id):
         """
-        Get Spotify Acess token from internal DB. If not found (could have already expired), create new one and sve
-        on DB.
+        Get Spotify Acess token from memory or, if not there, from internal DB. If not found (could have already expired), create
+        new one and sve on DB.
 
         Args:
             chat_id (int or string): ID of Telegram Bot chat
@@ -194,30 +441,169 @@ class RedisAcess:
             RedisError: Raised if there was some internal Redis error
         """
 
-        acess_token = self.redis.get('user' + ':' + str(chat_id) + ':' + 'acess_token') # Saved as bytes, not str
-        if acess_token is None:
-            refresh_token = self.redis.hget(name = 'user' + ':' + str(chat_id), key = 'refresh_token')
-
-            # If refresh_token is None, user is not logged in, so it will return None
-            if refresh_token is not None:
+        acess_token = self._get_acess_token(chat_id)
+        if acess_token is not None:
+            self.mark_user_active(chat_id)
+        return acess_token
 
-                refresh_form = {
-                    "grant_type": "refresh_token",
-                    "refresh_token": refresh_token.decode('utf-8')
-                }
+    def _get_acess_token(self, chat_id):
+        acess_token = self.token_cache.get(chat_id)
+        if acess_token is not None:
+            return acess_token
 
-                response_params = self.__user_token_request_process__(refresh_form, is_refresh=True)
+        # Getting the time left for the token, for keeping it in memory no longer than on Redis. The refresh token is read along,
+        # in case the acess token has expired
+        pipeline = self.shard(chat_id).pipeline(transaction=False)
+        parse_token = self.layout.queue_read_token(pipeline, chat_id)
+        parse_refresh_token = self.layout.queue_read(pipeline, chat_id, USER, ['refresh_token'])
+        results = iter(pipeline.execute())
+        acess_token, expires_in = parse_token(results) # Saved as bytes, not str
+        refresh_token, = parse_refresh_token(results)
 
-                acess_token = response_params['acess_token']
-                expires_in = response_params['expires_in']
+        if acess_token is None:
 
-                self.redis.set(name = 'user' + ':' + str(chat_id) + ':' + 'acess_token', value = acess_token, ex = expires_in)
+            # If refresh_token is None, user is not logged in, so it will return None
+            if refresh_token is not None:
+                acess_token = self._refresh_acess_token(chat_id, refresh_token)
         else:
             # If entered both if statments, acess_token is a string. Else, it's bytes (from the get operation on the Redis DB)
             acess_token = acess_token.decode('utf-8')
+            if expires_in is not None and expires_in > 0: # Negative if the key has no expiration (or vanished meanwhile)
+                self.token_cache.put(chat_id, acess_token, expires_in)
 
         return acess_token
 
+    def mark_user_active(self, chat_id):
+        """
+        Register that user 'chat_id' is active now (for the background token refresher to keep its acess token valid). To
+        avoid a Redis write on every call, it's written at most once every 'activity_mark_interval' seconds by each process.
+        Best effort: a Redis error is only logged (the mark is tried again on the next call)
+        """
+
+        key = str(chat_id)
+        now = time.monotonic()
+
+        with self._refresh_stats_lock:
+            last_mark = self._activity_marks.get(key)
+            if last_mark is not None and now - last_mark < self.activity_mark_interval:
+                return
+            self._activity_marks[key] = now
+
+            if len(self._activity_marks) > 4096:
+                self._activity_marks = {chat: mark for chat, mark in self._activity_marks.items()
+                                        if now - mark < self.activity_mark_interval}
+
+        try:
+            self.shard(chat_id).zadd(USER_ACTIVITY_KEY, {key: time.time()})
+        except RedisError:
+            LOGGER.exception('Could not mark user %s as active', chat_id)
+            with self._refresh_stats_lock:
+                self._activity_marks.pop(key, None)
+
+    def _count_refresh(self, stat):
+        with self._refresh_stats_lock:
+            self._refresh_stats[stat] += 1
+
+    def _refresh_acess_token(self, chat_id, refresh_token, min_ttl=0, priority=INTERACTIVE):
+        """
+        Get a new acess token with the refresh token and store it. The refresh is done under a lock (on Redis) per chat: while
+        some thread (of any bot replica) is refreshing the token of a chat, others wait for the new token to be stored and use it,
+        instead of asking Spotify for another one. If the lock holder takes longer than the lock timeout (or dies), another
+        waiter takes the lock and refreshes the token itself.
+
+        Args:
+            chat_id (int or string): ID of Telegram Bot chat
+            refresh_token (bytes): Spotify refresh token of the user
+            min_ttl (int) (optional): A stored token is only replaced if it expires in at most this many seconds
+            priority (string) (optional): Priority class of the token request
+
+        Returns:
+            Spotify API Acess token (string)
+
+        Raises:
+            TokenRequestException: Raised when there was some error from the response from Spotify API.
+            RedisError: Raised if there was some internal Redis error
+            DeadlineExceeded: Raised if the current deadline passes while waiting for another refresh
+        """
+
+        redis = self.shard(chat_id)
+        lock_key = legacy_key(chat_id, 'token_refresh_lock')
+        lock_owner = secrets.token_hex(16)
+
+        while True:
+            if redis.set(lock_key, lock_owner, nx=True, ex=self.refresh_lock_timeout):
+                break
+
+            # Someone else is refreshing it: wait for the new token (or for the lock to be released without one)
+            wait_until = time.monotonic() + self.refresh_lock_timeout
+            while time.monotonic() < wait_until:
+                sleep_within_deadline(self.refresh_poll_interval)
+
+                pipeline = redis.pipeline(transaction=False)
+                parse_token = self.layout.queue_read_token(pipeline, chat_id)
+                pipeline.exists(lock_key)
+                results = iter(pipeline.execute())
+                acess_token, expires_in = parse_token(results)
+                is_locked = next(results)
+
+                if acess_token is not None:
+                    self._count_refresh('deduplicated')
+                    acess_token = acess_token.decode('utf-8')
+                    if expires_in > 0:
+                        self.token_cache.put(chat_id, acess_token, expires_in)
+                    return acess_token
+
+                if not is_locked:
+                    break
+            else:
+                self._count_refresh('lock_timeouts')
+                LOGGER.warning('Timed out waiting for refresh of acess token of user %s', chat_id)
+
+        try:
+            # The token may have been stored between the first lookup and getting the lock
+            pipeline = redis.pipeline(transaction=False)
+            parse_token = self.layout.queue_read_token(pipeline, chat_id)
+            acess_token, expires_in = parse_token(iter(pipeline.execute()))
+
+            if acess_token is not None and expires_in > min_ttl:
+                self._count_refresh('deduplicated')
+                return acess_token.decode('utf-8')
+
+            refresh_form = {
+                "grant_type": "refresh_token",
+                "refresh_token": refresh_token.decode('utf-8')
+            }
+
+            response_params = self.__user_token_request_process__(refresh_form, is_refresh=True, chat_id=chat_id, priority=priority)
+            self._count_refresh('performed')
+
+            acess_token = response_params['acess_token']
+            expires_in = response_params['expires_in']
+
+            with self.write_batch(chat_id, transaction=False) as batch:
+                self.layout.queue_write_token(batch, chat_id, acess_token, expires_in)
+                batch.zadd(TOKEN_EXPIRY_KEY, {str(chat_id): time.time() + expires_in})
+            self.token_cache.put(chat_id, acess_token, expires_in)
+
+            return acess_token
+        finally:
+            try:
+                self._release_lock(keys=[lock_key], args=[lock_owner], client=redis)
+            except RedisError:
+                LOGGER.exception('Could not release token refresh lock of user %s (it expires on its own)', chat_id)
+
+    def get_token_refresh_stats(self) -> dict:
+        """
+        Get acess token refresh metrics of this process
+
+        Returns:
+            Dict with the number of refreshes asked to Spotify ('performed'), refreshes avoided by using a token refreshed by
+            someone else ('deduplicated') and waits for another refresh that timed out ('lock_timeouts')
+        """
+
+        with self._refresh_stats_lock:
+            return dict(self._refresh_stats)
+
     def is_user_logged_in(self, chat_id):
         """
         Checks if user 'chat_id' is logged in (by checking if we have a refresh token)
@@ -232,7 +618,7 @@ class RedisAcess:
             RedisError: Raised if there was some internal Redis error
         """
 
-        refresh_token = self.redis.hget(name = 'user' + ':' + str(chat_id), key = 'refresh_token')
+        refresh_token, = self._read(chat_id, USER, ['refresh_token'])
         if refresh_token is None:
             return False
         return True
@@ -249,7 +635,7 @@ class RedisAcess:
             RedisError: Raised if there was some internal Redis error
         """
 
-        self.redis.hset(name = 'user' + ':' + str(chat_id), key = 'user_id', value = user_id)
+        self._write(chat_id, USER, {'user_id': user_id})
 
 
     def get_spotify_user_id(self, chat_id):
@@ -266,7 +652,7 @@ class RedisAcess:
             RedisError: Raised if there was some internal Redis error
         """
 
-        b_user_id = self.redis.hget(name = 'user' + ':' + str(chat_id), key = 'user_id')
+        b_user_id, = self._read(chat_id, USER, ['user_id'])
 
         if b_user_id is None:
             return b_user_id
@@ -284,7 +670,7 @@ class RedisAcess:
             RedisError: Raised if there was some internal Redis error
         """
 
-        self.redis.hset(name = 'user' + ':' + str(chat_id), key = 'playlist_id', value = playlist_id)
+        self._write(chat_id, USER, {'playlist_id': playlist_id})
 
     def get_spotify_playlist_id(self, chat_id):
         """
@@ -300,44 +686,122 @@ class RedisAcess:
             RedisError: Raised if there was some internal Redis error
         """
 
-        b_playlist_id = self.redis.hget(name = 'user' + ':' + str(chat_id), key = 'playlist_id')
+        b_playlist_id, = self._read(chat_id, USER, ['playlist_id'])
 
         if b_playlist_id is None:
             return b_playlist_id
         return b_playlist_id.decode('utf-8')
 
+    def register_playlist_mirror(self, chat_id, playlist_id, snapshot_id, tracks):
+        """
+        Keep a copy of the tracks of the Spotify Playlist of an user, as they are on version 'snapshot_id' of it (so they
+        don't need to be read from Spotify again while the playlist stays on that version)
+
+        Args:
+            chat_id (int or string): ID of Telegram Bot chat
+            playlist_id (string): ID of Spotify Playlist
+            snapshot_id (string): Version of the playlist (as returned by Spotify when it's changed)
+            tracks (list of strings): URIs of the tracks on the playlist, in order
+
+        Raises:
+            RedisError: Raised if there was some internal Redis error
+        """
+
+        # Most URIs are of Spotify tracks: only their ID is stored
+        stored_tracks = [uri[len(_TRACK_URI_PREFIX):] if uri.startswith(_TRACK_URI_PREFIX) else uri for uri in tracks]
+        key = playlist_mirror_key(chat_id)
+
+        with self.write_batch(chat_id) as batch:
+            batch.unlink(key)
+            batch.hset(key, mapping={'p': playlist_id, 's': snapshot_id, 'uris': value_codec.encode(stored_tracks)})
+            batch.expire(key, self.PLAYLIST_MIRROR_TTL)
+
+    def get_playlist_mirror(self, chat_id, playlist_id):
+        """
+        Get the copy of the tracks of a Spotify Playlist kept by 'register_playlist_mirror'
+
+        Args:
+            chat_id (int or string): ID of Telegram Bot chat
+            playlist_id (string): ID of Spotify Playlist
+
+        Returns:
+            Tuple (version of the playlist (snapshot ID), list of track URIs), or (None, None) if no copy of that playlist is kept
+
+        Raises:
+            RedisError: Raised if there was some internal Redis error
+        """
+
+        b_playlist_id, b_snapshot_id, b_tracks = self.shard(chat_id).hmget(playlist_mirror_key(chat_id), 'p', 's', 'uris')
+
+        if b_playlist_id is None or b_playlist_id.decode('utf-8') != playlist_id or b_snapshot_id is None or b_tracks is None:
+            return None, None
+
+        try:
+            stored_tracks = value_codec.decode(b_tracks)
+        except value_codec.CodecException:
+            LOGGER.exception('Invalid playlist mirror of user %s', chat_id)
+            return None, None
+
+        return b_snapshot_id.decode('utf-8'), [uri if ':' in uri else _TRACK_URI_PREFIX + uri for uri in stored_tracks]
+
+    def remove_playlist_mirror(self, chat_id):
+        self.shard(chat_id).unlink(playlist_mirror_key(chat_id))
+        return True
+
     def register_user_tracks(self, chat_id, tracks_info):
-        self.redis.hset(name = 'user' + ':' + str(chat_id) + ':' + 'seeds', key = 'tracks', value = json.dumps(tracks_info))
+        self._write_seeds(chat_id, {'tracks': value_codec.encode_seeds(tracks_info, 'tracks')})
 
     def get_user_tracks(self, chat_id):
-        b_tracks_val = self.redis.hget(name = 'user' + ':' + str(chat_id) + ':' + 'seeds', key = 'tracks')
+        b_tracks_val, = self._read(chat_id, SEEDS, ['tracks'])
 
         if b_tracks_val is None:
             return b_tracks_val
-        return json.loads(b_tracks_val.decode('utf-8'))
+        return value_codec.decode_seeds(b_tracks_val, 'tracks')
 
     def remove_user_tracks(self, chat_id):
-        return bool(self.redis.hdel('user' + ':' + str(chat_id) + ':' + 'seeds', 'tracks'))
+        with self.write_batch(chat_id) as batch:
+            self.layout.queue_delete_fields(batch, chat_id, SEEDS, ['tracks'])
+        return True
 
     def register_user_artists(self, chat_id, artists_info):
-        self.redis.hset(name = 'user' + ':' + str(chat_id) + ':' + 'seeds', key = 'artists', value = json.dumps(artists_info))
+        self._write_seeds(chat_id, {'artists': value_codec.encode_seeds(artists_info, 'artists')})
 
     def get_user_artists(self, chat_id):
-        b_artists_val = self.redis.hget(name = 'user' + ':' + str(chat_id) + ':' + 'seeds', key = 'artists')
+        b_artists_val, = self._read(chat_id, SEEDS, ['artists'])
 
         if b_artists_val is None:
             return b_artists_val
-        return json.loads(b_artists_val.decode('utf-8'))
+        return value_codec.decode_seeds(b_artists_val, 'artists')
 
     def remove_user_artists(self, chat_id):
-        return bool(self.redis.hdel('user' + ':' + str(chat_id) + ':' + 'seeds', 'artists'))
+        with self.write_batch(chat_id) as batch:
+            self.layout.queue_delete_fields(batch, chat_id, SEEDS, ['artists'])
+        return True
+
+    def register_user_seeds(self, chat_id, artists_info, tracks_info):
+        """
+        Replace both seed artists and seed tracks of user 'chat_id' at once (a single HSET per layout, so they are always seen together)
+
+        Args:
+            chat_id (int or string): ID of Telegram Bot chat
+            artists_info (list): Selected artists
+            tracks_info (list): Selected tracks
+
+        Raises:
+            RedisError: Raised if there was some internal Redis error
+        """
+
+        self._write_seeds(chat_id, {
+            'artists': value_codec.encode_seeds(artists_info, 'artists'),
+            'tracks': value_codec.encode_seeds(tracks_info, 'tracks')
+        })
 
     def register_survey_attribute(self, chat_id, attribute, values):
         """
         Used to store information about what the user 'chat_id' in one of the Telegram polls during the survey process \
             (getting user preferences about music for generating recommendation of musics). For the sake of reducing the number of \
             Redis keys needed to store all attributes spawned from the survey, the values associated with user (for now, min value, max value and
-            possibly a precise value) will be store as a string. The get process wil convert it back to a dict.
+            possibly a precise value) will be store as a single value (see value_codec.py). The get process wil convert it back to a dict.
 
         Args:
             chat_id (int or string): ID of Telegram Bot chat
@@ -349,7 +813,7 @@ class RedisAcess:
             RedisError: Raised if there was some internal Redis error
         """
 
-        self.redis.hset(name = 'user' + ':' + str(chat_id) + ':' + 'attributes', key = attribute, value = json.dumps(values))
+        self._write(chat_id, ATTRIBUTES, {attribute: value_codec.encode(values)})
 
     def get_survey_attribute(self, chat_id, attribute):
         """
@@ -366,11 +830,11 @@ class RedisAcess:
                 RedisError: Raised if there was some internal Redis error
         """
 
-        b_attribute_val = self.redis.hget(name = 'user' + ':' + str(chat_id) + ':' + 'attributes', key = attribute)
+        b_attribute_val, = self._read(chat_id, ATTRIBUTES, [attribute])
 
         if b_attribute_val is None:
             return b_attribute_val
-        return json.loads(b_attribute_val.decode('utf-8'))
+        return value_codec.decode(b_attribute_val)
 
     def get_all_survey_attributes(self, chat_id):
         """
@@ -385,23 +849,49 @@ class RedisAcess:
                     RedisError: Raised if there was some internal Redis error
         """
 
-        all_attributes = self.redis.hgetall(name = 'user' + ':' + str(chat_id) + ':' + 'attributes')
+        all_attributes = self._read_section(chat_id, ATTRIBUTES)
 
-        all_attributes = {key.decode('utf-8'): json.loads(val.decode('utf-8')) for key, val in all_attributes.items() if val != b'{}'}
-        return all_attributes
+        all_attributes = {key: value_codec.decode(val) for key, val in all_attributes.items()}
+        return {key: val for key, val in all_attributes.items() if val != {}}
+
+    def get_user_profile(self, chat_id):
+        """
+        Load everything stored about user 'chat_id' (user hash, seeds and survey attributes) in a single round trip to Redis
+
+        Args:
+            chat_id (int or string): ID of Telegram Bot chat
+
+        Returns:
+            UserProfileSnapshot object
+
+        Raises:
+            RedisError: Raised if there was some internal Redis error
+        """
+
+        pipeline = self.shard(chat_id).pipeline(transaction=False)
+        parsers = [self.layout.queue_read_section(pipeline, chat_id, section) for section in (USER, SEEDS, ATTRIBUTES)]
+        results = iter(pipeline.execute())
+        user_hash, seeds_hash, attributes_hash = [parse(results) for parse in parsers]
+
+        return UserProfileSnapshot(chat_id, user_hash, seeds_hash, attributes_hash)
 
     def remove_all_survey_attributes(self, chat_id):
+        """
+        Remove all survey attributes of user 'chat_id' (without reading them first). On the legacy layout, the whole hash is
+        removed with UNLINK, which frees its memory in background, so the call doesn't block Redis even for large hashes
 
-        attributes_key = list(self.get_all_survey_attributes(chat_id).keys())
-        if len(attributes_key) != 0:
-            return bool(self.redis.hdel('user' + ':' + str(chat_id) + ':' + 'attributes', *attributes_key))
+        Raises:
+            RedisError: Raised if there was some internal Redis error
+        """
 
+        with self.write_batch(chat_id) as batch:
+            self.layout.queue_delete_section(batch, chat_id, ATTRIBUTES)
         return True
 
     def delete_user(self, chat_id):
-        self.redis.delete('user' + ':' + str(chat_id) + ':' + 'seeds')
-        self.redis.delete('user' + ':' + str(chat_id) + ':' + 'attributes')
-        self.redis.delete('user' + ':' + str(chat_id) + ':' + 'acess_token')
-
-        self.redis.delete('user' + ':' + str(chat_id))
+        self.token_cache.invalidate(chat_id)
 
+        with self.write_batch(chat_id) as batch:
+            self.layout.queue_delete_user(batch, chat_id)
+            batch.zrem(TOKEN_EXPIRY_KEY, str(chat_id))
+            batch.zrem(USER_ACTIVITY_KEY, str(chat_id))
@@ -0,0 +1,342 @@
+import collections
+import logging
+import threading
+import zlib
+
+from redis import RedisError
+from telegram import Update
+from telegram.ext import BasePersistence, TypeHandler
+
+from . import value_codec
+from .survey import SurveyManager
+
+LOGGER = logging.getLogger(__name__)
+
+# Stored chat data is this header followed by a value of value_codec.py (or by a zlib-compressed one, for the big ones: the
+# seed lists and the survey carry lots of repeated text). Headers 1 and 2 were pickles, which are not read anymore
+_CODEC_V1, _CODEC_ZLIB_V1 = b'\x03', b'\x04'
+
+# Values of chat_data that value_codec.py can't represent are stored as a dict with one of these keys
+_SET_TAG = '__set__'
+_SURVEY_TAG = '__survey__'
+
+# Fields of the hash of each chat: its chat_data and the state of each of its conversations ('c:[handler name]:[key]')
+_DATA_FIELD = 'd'
+_CONVERSATION_PREFIX = 'c:'
+
+
+def chat_key(chat_id) -> str:
+    return 'chat' + ':' + str(chat_id)
+
+
+def _to_plain(value):
+    """ Version of a chat_data value made only of what value_codec.py can represent """
+
+    if isinstance(value, dict):
+        return {key: _to_plain(val) for key, val in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_plain(val) for val in value]
+    if isinstance(value, (set, frozenset)):
+        return {_SET_TAG: [_to_plain(val) for val in value]}
+    if isinstance(value, SurveyManager):
+        return {_SURVEY_TAG: value.get_state()}
+    return value
+
+
+def _from_plain(value):
+    """ Rebuild a chat_data value from what '_to_plain' returned """
+
+    if isinstance(value, dict):
+        if len(value) == 1 and _SET_TAG in value:
+            return set(_from_plain(val) for val in value[_SET_TAG])
+        if len(value) == 1 and _SURVEY_TAG in value:
+            return SurveyManager.from_state(value[_SURVEY_TAG])
+        return {key: _from_plain(val) for key, val in value.items()}
+    if isinstance(value, list):
+        return [_from_plain(val) for val in value]
+    return value
+
+
+class RedisPersistence(BasePersistence):
+    """ Persistence of the conversation states and chat_data of the Telegram Bot on Redis, so they survive restarts and are
+    shared by all bot replicas. Only per chat data is stored (no user_data or bot_data), on a single hash per chat ('chat:[id]')
+    that expires after 'ttl' seconds without changes (abandoned conversations don't stay there forever).
+
+    Writes are only made when something changed (chat_data is compared with what was last read or written). The changes of
+    the chat of an Update are written when it's done being handled (on a single round trip), so the next Update of that chat
+    can be handled by any replica. Changes made outside of an Update (conversation timeouts, or chat_data saved by jobs with
+    'save_chat_data') are kept in memory, to be sent together on a single round trip every 'flush_interval' seconds (see
+    'write_pending'), or right away if it's 0. Before an Update is handled, the data of its chat is read from Redis (see
+    'refresh_chat_data'), so the replica that receives it continues where another one stopped; writes of that chat still
+    waiting to be sent go first.
+
+    Chat data is stored with value_codec.py (not as a pickle, so what is read from Redis is never run as code): its values
+    must be what JSON can represent, sets or SurveyManager objects. Conversation handlers must be 'per_chat' (the default), as
+    states are stored by chat, and registered with 'register_conversation_handler'.
+
+    Params:
+        redis_instance (RedisAcess): Acess point to the database
+        flush_interval (float): Seconds between writes of changed data. If 0, changes are written as soon as they're made
+        ttl (int): Seconds the data of a chat is kept after its last change
+        compress_above (int): Size (bytes) of encoded chat data from which it's stored compressed
+    """
+
+    def __init__(self, redis_instance, flush_interval=5, ttl=604800, compress_above=512):
+        super().__init__(store_user_data=False, store_chat_data=True, store_bot_data=False)
+
+        # BasePersistence wraps 'update_chat_data' to hand it a copy of the data without Bot objects. Chat data here has none,
+        # and after every job the Telegram Bot calls it for every chat it knows (see 'update_chat_data'), so copying them all
+        # would cost O(chats) for calls that are ignored anyway
+        del self.__dict__['update_chat_data']
+
+        self.redis_instance = redis_instance
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.compress_above = compress_above
+
+        self._lock = threading.Lock()
+        self._conversations = {} # Handler name -> dict of conversation key -> state (the ones used by each ConversationHandler)
+        self._conversation_locks = {} # Handler name -> lock the ConversationHandler uses for its dict of states
+        self._stored_data = {} # Chat ID -> hash of its encoded chat_data as last read from (or written to) Redis
+        self._pending = collections.defaultdict(dict) # Chat ID -> fields to write (None to remove)
+        self._handling = {} # Chat ID of each Update being handled (loaded, and not yet written) -> thread handling it
+        self._stats = {'loads': 0, 'writes': 0, 'unchanged': 0}
+
+    @staticmethod
+    def _encode(data) -> bytes:
+        return value_codec.encode(_to_plain(data)) if len(data) > 0 else b''
+
+    def _dumps(self, raw) -> bytes:
+        """ Stored version of chat data encoded by '_encode' """
+        if len(raw) > self.compress_above:
+            return _CODEC_ZLIB_V1 + zlib.compress(raw)
+        return _CODEC_V1 + raw
+
+    @staticmethod
+    def _loads(value):
+        """ Rebuild chat data from its stored version
+
+        Raises:
+            ValueError: Raised if the value is not in a known format
+            value_codec.CodecException: Raised if the value is invalid
+        """
+        if value[:1] == _CODEC_ZLIB_V1:
+            return _from_plain(value_codec.decode(zlib.decompress(value[1:])))
+        if value[:1] == _CODEC_V1:
+            return _from_plain(value_codec.decode(value[1:]))
+        raise ValueError('Unknown chat data format')
+
+    # Data loaded when the bot starts: nothing, as the data of each chat is loaded when needed
+
+    def get_user_data(self):
+        return collections.defaultdict(dict)
+
+    def get_chat_data(self):
+        return collections.defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name):
+        with self._lock:
+            return self._conversations.setdefault(name, {})
+
+    def register_conversation_handler(self, handler):
+        """ Use the lock of a persistent ConversationHandler (already added to the dispatcher) when replacing the states of its
+        conversations with the ones loaded from Redis, so they don't change while the handler is reading them """
+
+        with self._lock:
+            # python-telegram-bot has no public way of getting it (version 13)
+            self._conversation_locks[handler.name] = handler._conversations_lock
+
+    # Data of the chat of an Update, loaded before it's handled
+
+    def refresh_chat_data(self, chat_id, chat_data):
+        """ Called by the Telegram Bot when the context of an Update is made (see 'get_load_handler') """
+
+        try:
+            self.load_chat(chat_id, chat_data)
+        except RedisError:
+            LOGGER.exception('Could not load the data of chat %s', chat_id)
+
+    # Changes made while handling an Update
+
+    def update_conversation(self, name, key, new_state):
+        field = _CONVERSATION_PREFIX + name + ':' + ','.join(str(part) for part in key)
+        with self._lock:
+            self._pending[key[0]][field] = None if new_state is None else str(new_state)
+        if self.flush_interval == 0:
+            self.write_pending()
+
+    def update_chat_data(self, chat_id, data):
+        """ Called by the Telegram Bot when an Update is done being handled (for its chat), and after every job (for all the
+        chats it knows). Only the first is used: the chat_data of the chat of the Update is written right away, along with
+        the conversation states the Update changed. Calls for chats not being handled by the calling thread are ignored
+        (without even serializing their data), so a job can't write the data of an Update still being handled """
+
+        with self._lock:
+            if self._handling.get(chat_id) != threading.get_ident():
+                return
+            del self._handling[chat_id]
+
+        self._queue_chat_data(chat_id, data)
+        self.write_chat(chat_id)
+
+    def save_chat_data(self, chat_id, data):
+        """ Save the chat_data of a chat changed outside of the handling of its Updates (like by a job). Written with the
+        next batch (see 'write_pending') """
+
+        self._queue_chat_data(chat_id, data)
+        if self.flush_interval == 0:
+            self.write_pending()
+
+    def _queue_chat_data(self, chat_id, data):
+        """ Add the chat_data of a chat to the pending writes, if it changed """
+
+        raw = self._encode(data)
+
+        with self._lock:
+            if self._stored_data.get(chat_id) == hash(raw):
+                self._stats['unchanged'] += 1
+                return
+
+            self._stored_data[chat_id] = hash(raw)
+            self._pending[chat_id][_DATA_FIELD] = self._dumps(raw) if len(raw) > 0 else None
+
+    def update_user_data(self, user_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
+
+    # Reads and writes on Redis
+
+    def _queue_writes(self, pipeline, chat_id, fields):
+        key = chat_key(chat_id)
+
+        to_remove = [field for field, value in fields.items() if value is None]
+        to_set = {field: value for field, value in fields.items() if value is not None}
+
+        if len(to_remove) > 0:
+            pipeline.hdel(key, *to_remove)
+        if len(to_set) > 0:
+            pipeline.hset(key, mapping=to_set)
+            pipeline.expire(key, self.ttl)
+
+    def write_pending(self, context=None):
+        """ Write all changes not yet stored, on a single round trip. Also a callback for the Telegram Bot job queue
+        (see 'JobQueue.run_repeating') """
+
+        with self._lock:
+            pending, self._pending = self._pending, collections.defaultdict(dict)
+        self._write(pending)
+
+    def write_chat(self, chat_id):
+        """ Write the changes of a single chat not yet stored (the ones of other chats keep waiting) """
+
+        with self._lock:
+            fields = self._pending.pop(chat_id, None)
+        if fields:
+            self._write({chat_id: fields})
+
+    def _write(self, pending):
+        """ Write the fields of each chat on 'pending' (chat ID -> fields), on a single round trip. If it fails, they are kept
+        for the next write """
+
+        if len(pending) == 0:
+            return
+
+        pipeline = self.redis_instance.redis.pipeline(transaction=False)
+        for chat_id, fields in pending.items():
+            self._queue_writes(pipeline, chat_id, fields)
+
+        try:
+            pipeline.execute()
+        except RedisError:
+            LOGGER.exception('Could not write the data of %s chats', len(pending))
+            with self._lock: # Kept for the next try (unless changed again in the meantime)
+                for chat_id, fields in pending.items():
+                    for field, value in fields.items():
+                        self._pending[chat_id].setdefault(field, value)
+            return
+
+        with self._lock:
+            self._stats['writes'] += len(pending)
+
+    def flush(self):
+        """ Called by the Telegram Bot when it stops """
+        self.write_pending()
+
+    def load_chat(self, chat_id, chat_data):
+        """ Replace the chat_data and conversation states of a chat with the ones stored on Redis (after writing the changes of
+        the chat still waiting to be sent), on a single round trip. 'chat_data' is changed key by key (it's never empty
+        meanwhile, for a job reading it)
+
+        Args:
+            chat_id (int): ID of Telegram Bot chat
+            chat_data (dict): chat_data of the chat on the Telegram Bot dispatcher, changed in place
+        """
+
+        # Its changes are written when the Update is done (even if it can't be loaded now)
+        with self._lock:
+            fields = self._pending.pop(chat_id, None)
+            self._handling[chat_id] = threading.get_ident()
+
+        pipeline = self.redis_instance.redis.pipeline(transaction=False)
+        if fields:
+            self._queue_writes(pipeline, chat_id, fields)
+        pipeline.hgetall(chat_key(chat_id))
+        stored = pipeline.execute()[-1]
+
+        states = {}
+        data = {}
+        for field, value in stored.items():
+            field = field.decode('utf-8')
+            if field == _DATA_FIELD:
+                try:
+                    data = self._loads(value)
+                except Exception: # A chat with unreadable data is better off starting again than stuck
+                    LOGGER.exception('Could not read the chat_data of chat %s', chat_id)
+            elif field.startswith(_CONVERSATION_PREFIX):
+                name, key = field[len(_CONVERSATION_PREFIX):].rsplit(':', 1)
+                states.setdefault(name, {})[tuple(int(part) for part in key.split(','))] = int(value)
+
+        for key in [key for key in chat_data if key not in data]:
+            del chat_data[key]
+        chat_data.update(data)
+
+        with self._lock:
+            self._stored_data[chat_id] = hash(self._encode(data))
+            self._stats['loads'] += 1
+            conversations_by_name = [(name, conversations, self._conversation_locks.get(name))
+                                     for name, conversations in self._conversations.items()]
+
+        for name, conversations, lock in conversations_by_name:
+            if lock is None:
+                LOGGER.warning('Conversation handler %s not registered on the persistence', name)
+                lock = threading.Lock()
+
+            with lock:
+                for key in [key for key in conversations if key[0] == chat_id]:
+                    del conversations[key]
+                conversations.update(states.get(name, {}))
+
+    def get_load_handler(self):
+        """ Handler (to be added to a group run before all others, like -1) that makes the data of the chat of each Update be
+        loaded before any other handler sees it.
+
+        The data is loaded by 'refresh_chat_data', which the Telegram Bot calls when it makes the context of an Update: that
+        is done for the first handler that accepts it, but only after the handlers before it checked the Update.
+        ConversationHandlers check their conversation states when doing so, so one handler accepting every Update must come
+        first (it costs nothing more: each Update is loaded once, on a single round trip) """
+
+        def loaded(update, context):
+            pass
+
+        return TypeHandler(Update, loaded)
+
+    def get_stats(self) -> dict:
+        """ Get persistence metrics: chats loaded from Redis ('loads'), chats written ('writes') and chat_data updates that
+        didn't need a write ('unchanged') """
+        with self._lock:
+            return dict(self._stats)
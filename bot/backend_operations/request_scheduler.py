@@ -0,0 +1,192 @@
+import collections
+import heapq
+import itertools
+import threading
+import logging
+import time
+import yaml
+
+from .deadline import current_deadline, DeadlineExceeded
+
+LOGGER = logging.getLogger(__name__)
+
+# Priority classes of Spotify calls. Interactive calls are the ones a user is waiting for right now (top items,
+# recommendations, token refresh...). Bulk calls are the many requests of a larger operation (pages of tracks)
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+
+
+class SpotifyRequestScheduler:
+    """ Weighted fair queueing of outbound Spotify calls.
+
+    At most 'max_concurrent' calls are sent at the same time. When all slots are taken, calls wait on a queue per
+    (chat, priority class) and, as slots are freed, they are served by self-clocked fair queueing: each call receives a
+    virtual finish time that grows by 1 / weight of its class for each call queued by the same chat and class, and the
+    call with the smallest one goes next. So a chat with hundreds of queued pages gets the same share as a chat with a single
+    call, and interactive calls get 'weight' times more of the slots than bulk ones (without starving them).
+
+    Params:
+        max_concurrent (int): How many calls can be sent at the same time
+        class_weights (dict): Weight of each priority class
+        latency_samples (int): How many of the last latencies of each class are kept for the percentiles
+    """
+
+    # Prune idle flows from the virtual finish time table when it grows past this size
+    MAX_IDLE_FLOWS = 1024
+
+    def __init__(self, max_concurrent=8, class_weights=None, latency_samples=1000):
+
+        self.max_concurrent = max_concurrent
+        self.class_weights = class_weights or {INTERACTIVE: 4, BULK: 1}
+
+        self._lock = threading.Lock()
+        self._free_slots = max_concurrent
+        self._queue = [] # Heap of (virtual finish time, sequence number, event) of the calls waiting
+        self._sequence = itertools.count()
+        self._virtual_time = 0.0
+        self._last_finish = {} # (chat_id, priority) -> virtual finish time of its last queued call
+
+        self._queue_waits = {priority: collections.deque(maxlen=latency_samples) for priority in self.class_weights}
+        self._latencies = {priority: collections.deque(maxlen=latency_samples) for priority in self.class_weights}
+        self._counts = {priority: 0 for priority in self.class_weights}
+
+    def _acquire(self, chat_id, priority):
+        """ Wait for a free slot
+
+        Raises:
+            DeadlineExceeded: Raised if the current deadline passes while waiting
+        """
+
+        with self._lock:
+            if self._free_slots > 0 and len(self._queue) == 0:
+                self._free_slots -= 1
+                return
+
+            flow = (chat_id, priority)
+            start = max(self._virtual_time, self._last_finish.get(flow, 0.0))
+            finish = start + 1.0 / self.class_weights[priority]
+            self._last_finish[flow] = finish
+
+            entry = (finish, next(self._sequence), threading.Event())
+            heapq.heappush(self._queue, entry)
+
+        # The slot is handed over directly by '_release'
+        event = entry[2]
+        deadline = current_deadline()
+        if deadline is None:
+            event.wait()
+            return
+
+        if not event.wait(max(deadline.remaining(), 0)):
+            with self._lock:
+                # The slot may have been handed over right after the wait timed out
+                if not event.is_set():
+                    self._queue.remove(entry)
+                    heapq.heapify(self._queue)
+                    raise DeadlineExceeded(deadline.name)
+
+            self._release()
+            raise DeadlineExceeded(deadline.name)
+
+    def _release(self):
+        """ Give the slot to the next call (if any) """
+
+        with self._lock:
+            if len(self._queue) == 0:
+                self._free_slots += 1
+                return
+
+            finish, _, event = heapq.heappop(self._queue)
+            self._virtual_time = finish
+
+            if len(self._last_finish) > self.MAX_IDLE_FLOWS:
+                self._last_finish = {flow: tag for flow, tag in self._last_finish.items() if tag > self._virtual_time}
+
+            event.set()
+
+    def run(self, chat_id, priority, function, *args, **kwargs):
+        """ Call 'function' as soon as the fair queue allows it
+
+        Args:
+            chat_id (int or string): ID of Telegram Bot chat on behalf of whom the call is made (None if there's none)
+            priority (string): Priority class (INTERACTIVE or BULK)
+            function (callable): Function that sends the request. Receives the remaining arguments
+
+        Returns:
+            What 'function' returns
+        """
+
+        if priority not in self.class_weights:
+            priority = INTERACTIVE
+
+        start = time.monotonic()
+        self._acquire(chat_id, priority)
+        queue_wait = time.monotonic() - start
+
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self._release()
+
+            with self._lock:
+                self._counts[priority] += 1
+                self._queue_waits[priority].append(queue_wait)
+                self._latencies[priority].append(time.monotonic() - start)
+
+    @staticmethod
+    def _percentiles(samples):
+        if len(samples) == 0:
+            return {'p50': None, 'p90': None, 'p99': None}
+
+        ordered = sorted(samples)
+        def percentile(p):
+            return ordered[min(int(p / 100 * len(ordered)), len(ordered) - 1)]
+
+        return {'p50': percentile(50), 'p90': percentile(90), 'p99': percentile(99)}
+
+    def get_stats(self) -> dict:
+        """ Get scheduler metrics
+
+        Returns:
+            Dict with the number of queued calls ('queued'), free slots ('free_slots') and, for each priority class, the number of
+            calls made ('count') and the percentiles (p50, p90, p99, in seconds) of the time waited on queue ('queue_wait') and of
+            the total latency, queue included ('latency')
+        """
+
+        with self._lock:
+            stats = {'queued': len(self._queue), 'free_slots': self._free_slots}
+            for priority in self.class_weights:
+                stats[priority] = {
+                    'count': self._counts[priority],
+                    'queue_wait': self._percentiles(self._queue_waits[priority]),
+                    'latency': self._percentiles(self._latencies[priority])
+                }
+
+        return stats
+
+
+_SCHEDULER = None
+_SCHEDULER_LOCK = threading.Lock()
+
+
+def get_scheduler() -> SpotifyRequestScheduler:
+    """ Get the process-wide Spotify call scheduler, creating it on first use with the settings found under the 'scheduler'
+    section of 'config.yaml' """
+
+    global _SCHEDULER
+
+    if _SCHEDULER is None:
+        with _SCHEDULER_LOCK:
+            if _SCHEDULER is None:
+                with open('config.yaml', 'r') as f:
+                    scheduler_config = yaml.safe_load(f).get('scheduler') or {}
+
+                _SCHEDULER = SpotifyRequestScheduler(
+                    max_concurrent=scheduler_config.get('maxConcurrentCalls', 8),
+                    class_weights={
+                        INTERACTIVE: scheduler_config.get('interactiveWeight', 4),
+                        BULK: scheduler_config.get('bulkWeight', 1)
+                    }
+                )
+
+    return _SCHEDULER
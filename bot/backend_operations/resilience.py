@@ -0,0 +1,355 @@
+import re
+import random
+import threading
+import logging
+import time
+import yaml
+
+from urllib.parse import urlsplit
+
+import requests
+
+from .deadline import check_deadline, sleep_within_deadline, sleep_within_deadline_async
+
+LOGGER = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """ Exception raised when a call is refused because the circuit breaker of its endpoint is open """
+    def __init__(self, endpoint, retry_in):
+
+        self.endpoint = endpoint
+        self.retry_in = retry_in
+        self.message = f'Endpoint {endpoint} is failing. Calls are refused for {retry_in:.1f} more seconds'
+
+        super().__init__(self.message)
+
+    def __str__(self):
+        return self.message
+
+
+class CircuitBreaker:
+    """ Circuit breaker of a single endpoint class.
+
+    While CLOSED, calls go through. After 'failure_threshold' consecutive failures it goes OPEN, and every call fails fast
+    for 'reset_timeout' seconds. Then it goes HALF_OPEN: a single trial call is let through (others still fail fast). If it
+    succeeds, the breaker closes again; if it fails, it opens for another 'reset_timeout' seconds.
+
+    Params:
+        endpoint (string): Name of the endpoint class (used on messages)
+        failure_threshold (int): Consecutive failures needed to open the breaker
+        reset_timeout (float): Seconds the breaker stays open before a trial call
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, endpoint, failure_threshold=5, reset_timeout=30):
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+
+        self.total_failures = 0
+        self.total_rejected = 0
+
+    def before_call(self):
+        """ Check if a call can be made
+
+        Raises:
+            CircuitOpenError: Raised if the breaker is open (or half-open with a trial call already in flight)
+        """
+
+        with self._lock:
+            if self._state == self.OPEN:
+                retry_in = self._opened_at + self.reset_timeout - time.monotonic()
+                if retry_in > 0:
+                    self.total_rejected += 1
+                    raise CircuitOpenError(self.endpoint, retry_in)
+
+                self._state = self.HALF_OPEN
+                self._trial_in_flight = False
+
+            if self._state == self.HALF_OPEN:
+                if self._trial_in_flight:
+                    self.total_rejected += 1
+                    raise CircuitOpenError(self.endpoint, 0.0)
+                self._trial_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                LOGGER.info('Circuit breaker of endpoint %s closed', self.endpoint)
+            self._state = self.CLOSED
+            self._consecutive_failures = 0
+            self._trial_in_flight = False
+
+    def release_trial(self):
+        """ End a call that failed for reasons unrelated to the endpoint (as the deadline of the caller), without counting it
+        as a success or a failure. A half-open breaker lets another trial call through """
+
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.total_failures += 1
+            self._consecutive_failures += 1
+            self._trial_in_flight = False
+
+            if self._state == self.HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    LOGGER.warning('Circuit breaker of endpoint %s opened after %s consecutive failures', self.endpoint, self._consecutive_failures)
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def get_state(self) -> dict:
+        with self._lock:
+            retry_in = 0.0
+            if self._state == self.OPEN:
+                retry_in = max(self._opened_at + self.reset_timeout - time.monotonic(), 0.0)
+
+            return {
+                'state': self._state,
+                'consecutive_failures': self._consecutive_failures,
+                'total_failures': self.total_failures,
+                'total_rejected': self.total_rejected,
+                'retry_in': retry_in
+            }
+
+
+class RetryPolicy:
+    """ Retry policy of an endpoint class: exponential backoff with full jitter (the wait before attempt n + 1 is random,
+    between 0 and min(max_delay, base_delay * 2^n)), so retries from many threads don't hit Spotify at the same time.
+
+    Params:
+        max_attempts (int): Total attempts of a call, including the first one
+        base_delay (float): Maximum wait (seconds) before the first retry
+        max_delay (float): Upper bound of the wait between attempts
+        methods (list of strings): HTTP methods that can be retried (non-idempotent ones, like POST, could duplicate effects)
+    """
+
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=8.0, methods=('GET', 'PUT', 'DELETE')):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.methods = set(method.upper() for method in methods)
+
+    def can_retry(self, method, attempt) -> bool:
+        return method.upper() in self.methods and attempt + 1 < self.max_attempts
+
+    def backoff(self, attempt) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+
+class EndpointResilience:
+    """ Applies a retry policy and a circuit breaker for each endpoint class of the Spotify API. The endpoint classes are
+    the keys of the URLs on the 'spotify.url' section of 'config.yaml' ('topURL', 'playlist.tracksURL', ...); URLs that
+    match none of them belong to class 'other'.
+
+    Calls are retried when they fail with a connection error (or timeout) or with a 5xx response. These are the failures
+    that count for the circuit breaker; other error responses (like 404) mean the endpoint is working.
+
+    Params:
+        url_list (dict): The 'spotify.url' section of 'config.yaml'
+        resilience_config (dict): The 'resilience' section of 'config.yaml'
+    """
+
+    OTHER_ENDPOINT = 'other'
+
+    def __init__(self, url_list, resilience_config=None):
+
+        resilience_config = resilience_config or {}
+        default_config = resilience_config.get('default') or {}
+        endpoints_config = resilience_config.get('endpoints') or {}
+
+        self._url_patterns = []
+        for endpoint, url in self._flatten_urls(url_list):
+            pattern = re.escape(url.rstrip('?'))
+            pattern = re.sub(r'\\\{\w+\\\}', '[^/]+', pattern)
+            self._url_patterns.append((endpoint, re.compile(pattern + '$')))
+
+        self._policies = {}
+        self._breakers = {}
+        for endpoint in [endpoint for endpoint, _ in self._url_patterns] + [self.OTHER_ENDPOINT]:
+            endpoint_config = dict(default_config)
+            endpoint_config.update(endpoints_config.get(endpoint) or {})
+
+            self._policies[endpoint] = RetryPolicy(
+                max_attempts=endpoint_config.get('maxAttempts', 3),
+                base_delay=endpoint_config.get('baseDelay', 0.5),
+                max_delay=endpoint_config.get('maxDelay', 8.0),
+                methods=endpoint_config.get('methods', ['GET', 'PUT', 'DELETE'])
+            )
+            self._breakers[endpoint] = CircuitBreaker(
+                endpoint,
+                failure_threshold=endpoint_config.get('failureThreshold', 5),
+                reset_timeout=endpoint_config.get('resetTimeout', 30)
+            )
+
+    @staticmethod
+    def _flatten_urls(url_list, prefix=''):
+        for key, value in url_list.items():
+            if isinstance(value, dict):
+                yield from EndpointResilience._flatten_urls(value, prefix + key + '.')
+            elif value:
+                yield prefix + key, value
+
+    def endpoint_for(self, url) -> str:
+        """ Get the endpoint class of an URL """
+
+        split_url = urlsplit(url)
+        url_without_query = split_url.scheme + '://' + split_url.netloc + split_url.path
+
+        for endpoint, pattern in self._url_patterns:
+            if pattern.match(url_without_query):
+                return endpoint
+
+        return self.OTHER_ENDPOINT
+
+    def call(self, url, method, function, *args, **kwargs):
+        """ Make a call to 'url' (by calling 'function') under the retry policy and circuit breaker of its endpoint class
+
+        Args:
+            url (string): URL being called
+            method (string): HTTP method of the call
+            function (callable): Function that sends the request and returns a requests.Response. Receives the remaining arguments
+
+        Returns:
+            The last response received (can be an error response, if all attempts failed)
+
+        Raises:
+            CircuitOpenError: Raised if the circuit breaker of the endpoint is open
+            requests.RequestException: Raised if the last attempt failed with a connection error or timeout
+        """
+
+        endpoint = self.endpoint_for(url)
+        policy = self._policies[endpoint]
+        breaker = self._breakers[endpoint]
+
+        attempt = 0
+        while True:
+            breaker.before_call()
+
+            try:
+                response = function(*args, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                # If the deadline is over, the call was probably cut short by it (and not by a failing endpoint)
+                try:
+                    check_deadline()
+                except BaseException:
+                    breaker.release_trial()
+                    raise
+
+                breaker.record_failure()
+                if not policy.can_retry(method, attempt):
+                    raise
+                LOGGER.warning('Connection error calling endpoint %s (attempt %s)', endpoint, attempt + 1)
+            except BaseException:
+                # Not a failure of the endpoint (the deadline ran out, the rate limiter failed, ...): a trial call must still
+                # end, or a half-open breaker would refuse every call after it
+                breaker.release_trial()
+                raise
+            else:
+                if response.status_code < 500:
+                    breaker.record_success()
+                    return response
+
+                breaker.record_failure()
+                if not policy.can_retry(method, attempt):
+                    return response
+                LOGGER.warning('Error code %s calling endpoint %s (attempt %s)', response.status_code, endpoint, attempt + 1)
+
+            sleep_within_deadline(policy.backoff(attempt))
+            attempt += 1
+
+    async def call_async(self, url, method, transport_errors, function, *args, **kwargs):
+        """ asyncio version of 'call'
+
+        Args:
+            url (string): URL being called
+            method (string): HTTP method of the call
+            transport_errors (tuple): Exceptions 'function' raises on connection errors and timeouts
+            function (coroutine function): Sends the request and returns an object with its 'status_code'. Receives the
+                remaining arguments
+
+        Returns:
+            The last response received (can be an error response, if all attempts failed)
+
+        Raises:
+            CircuitOpenError: Raised if the circuit breaker of the endpoint is open
+            Any of 'transport_errors': Raised if the last attempt failed with it
+        """
+
+        endpoint = self.endpoint_for(url)
+        policy = self._policies[endpoint]
+        breaker = self._breakers[endpoint]
+
+        attempt = 0
+        while True:
+            breaker.before_call()
+
+            try:
+                response = await function(*args, **kwargs)
+            except transport_errors:
+                # Same as on 'call'
+                try:
+                    check_deadline()
+                except BaseException:
+                    breaker.release_trial()
+                    raise
+
+                breaker.record_failure()
+                if not policy.can_retry(method, attempt):
+                    raise
+                LOGGER.warning('Connection error calling endpoint %s (attempt %s)', endpoint, attempt + 1)
+            except BaseException:
+                breaker.release_trial()
+                raise
+            else:
+                if response.status_code < 500:
+                    breaker.record_success()
+                    return response
+
+                breaker.record_failure()
+                if not policy.can_retry(method, attempt):
+                    return response
+                LOGGER.warning('Error code %s calling endpoint %s (attempt %s)', response.status_code, endpoint, attempt + 1)
+
+            await sleep_within_deadline_async(policy.backoff(attempt))
+            attempt += 1
+
+    def get_breaker_states(self) -> dict:
+        """ Get the state of the circuit breaker of every endpoint class
+
+        Returns:
+            Dict where keys are endpoint classes and values, dicts with the breaker 'state' ('closed', 'open' or 'half_open'),
+            'consecutive_failures', 'total_failures', 'total_rejected' (calls that failed fast) and 'retry_in' (seconds until
+            an open breaker lets a trial call through)
+        """
+        return {endpoint: breaker.get_state() for endpoint, breaker in self._breakers.items()}
+
+
+_RESILIENCE = None
+_RESILIENCE_LOCK = threading.Lock()
+
+
+def get_resilience() -> EndpointResilience:
+    """ Get the process-wide retry policies and circuit breakers, creating them on first use with the settings found under the
+    'resilience' section of 'config.yaml' """
+
+    global _RESILIENCE
+
+    if _RESILIENCE is None:
+        with _RESILIENCE_LOCK:
+            if _RESILIENCE is None:
+                with open('config.yaml', 'r') as f:
+                    config = yaml.safe_load(f)
+
+                _RESILIENCE = EndpointResilience(config['spotify']['url'], config.get('resilience'))
+
+    return _RESILIENCE
@@ -0,0 +1,75 @@
+import bisect
+import hashlib
+
+import yaml
+from redis import Redis
+
+from .redis_connection import get_redis
+
+
+def _hash(value) -> int:
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+class ConsistentHashRing:
+    """ Consistent hashing of keys (chat IDs) to nodes (Redis shards). Each node is placed on 'replicas' points of a ring, by the
+    hash of its name, and a key belongs to the first node found going forward on the ring from the hash of the key. Adding (or
+    removing) a node only moves the keys of the ring arcs it takes (or leaves): about 1/N of them, for N nodes.
+
+    Node names (not their addresses) decide where they are on the ring, so an endpoint can change without moving any key.
+
+    Params:
+        nodes (dict): Name of each node -> node
+        replicas (int): Points of the ring per node. More points spread keys more evenly across nodes
+    """
+
+    def __init__(self, nodes, replicas=160):
+        if len(nodes) == 0:
+            raise ValueError('At least one node is required')
+
+        self.nodes = dict(nodes)
+
+        points = sorted((_hash('{}#{}'.format(name, i)), name) for name in self.nodes for i in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._names = [name for _, name in points]
+
+    def get_name(self, key) -> str:
+        """ Name of the node of a key """
+
+        if len(self.nodes) == 1:
+            return self._names[0]
+
+        index = bisect.bisect(self._hashes, _hash(str(key)))
+        return self._names[index % len(self._names)]
+
+    def get_node(self, key):
+        """ Node of a key """
+        return self.nodes[self.get_name(key)]
+
+    def get_nodes(self) -> list:
+        return list(self.nodes.values())
+
+
+def get_user_shards(client_class=Redis, replicas=160) -> ConsistentHashRing:
+    """
+    Get the Redis shards where the data of users is stored, configured by 'redis.shards' on 'config.yaml' (a list of endpoints
+    with 'name', 'host', 'port' and 'db'). Without shards, all of it is stored on the configured Redis server (database 0)
+
+    Args:
+        client_class (class): Class of the clients (Redis or a subclass of it)
+        replicas (int): Points of the ring per shard
+
+    Returns:
+        ConsistentHashRing of shard name -> Redis client
+    """
+
+    with open('config.yaml', 'r') as f:
+        shards_config = (yaml.safe_load(f).get('redis') or {}).get('shards') or []
+
+    if len(shards_config) == 0:
+        return ConsistentHashRing({'default': get_redis(db = 0, client_class = client_class)}, replicas)
+
+    return ConsistentHashRing({
+        shard['name']: get_redis(db = shard.get('db', 0), client_class = client_class, host = shard['host'], port = shard.get('port', 6379))
+        for shard in shards_config
+    }, replicas)
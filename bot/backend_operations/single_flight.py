@@ -0,0 +1,133 @@
+import copy
+import hashlib
+import threading
+import logging
+
+from .deadline import current_deadline, DeadlineExceeded
+
+LOGGER = logging.getLogger(__name__)
+
+
+class _Flight:
+    """ A call in progress, and its outcome once finished """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def _is_deadline_error(error) -> bool:
+    """ Check if an exception was caused by the end of a deadline (directly, or as the cause of the exception raised) """
+
+    while error is not None:
+        if isinstance(error, DeadlineExceeded):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+def _copy_error(error):
+    """ Get a copy of an exception, so that each caller raises its own object (raising an exception changes its traceback) """
+
+    try:
+        copied = copy.copy(error)
+    except Exception:
+        # Exceptions which can't be rebuilt from their arguments are shared
+        return error
+
+    copied.__cause__, copied.__context__ = error.__cause__, error.__context__
+    return copied
+
+
+class SingleFlight:
+    """ Request coalescing: while a call identified by some key is in progress, other calls with the same key don't run.
+    They wait for the one in progress and receive its result (or its exception). If that call failed because of its own
+    deadline, the ones waiting for it make the call again (one of them runs it, the others wait for it).
+
+    Only for calls without side effects (like GET requests), as the callers share a single execution
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+        self.executed = 0 # Calls that actually ran
+        self.shared = 0 # Calls that received the result of another one (calls saved)
+
+    def do(self, key, function, *args, **kwargs):
+        """ Run 'function' (with the remaining arguments), unless a call with the same 'key' is already running
+
+        Args:
+            key (hashable): Identity of the call
+            function (callable): Function to run
+
+        Returns:
+            What 'function' returns (the same object for all callers sharing the call)
+
+        Raises:
+            Whatever 'function' raises (a copy of it, for callers sharing the call). DeadlineExceeded if the current deadline
+            passes while waiting for another call
+        """
+
+        while True:
+            with self._lock:
+                flight = self._flights.get(key)
+                is_leader = flight is None
+                if is_leader:
+                    flight = _Flight()
+                    self._flights[key] = flight
+                else:
+                    self.shared += 1
+
+            if is_leader:
+                break
+
+            deadline = current_deadline()
+            if deadline is None:
+                flight.done.wait()
+            elif not flight.done.wait(max(deadline.remaining(), 0)):
+                raise DeadlineExceeded(deadline.name)
+
+            if flight.error is None:
+                return flight.result
+
+            # The deadline that ran out was the one of the caller that made the call, not this one's: call again
+            if _is_deadline_error(flight.error):
+                with self._lock:
+                    self.shared -= 1
+                continue
+
+            raise _copy_error(flight.error)
+
+        try:
+            flight.result = function(*args, **kwargs)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+                self.executed += 1
+            flight.done.set()
+
+    def get_stats(self) -> dict:
+        """ Get how many calls were executed ('executed') and how many were saved by sharing another call's result ('shared') """
+        with self._lock:
+            return {'executed': self.executed, 'shared': self.shared, 'in_flight': len(self._flights)}
+
+
+def token_identity(headers) -> str:
+    """ Get an identity for the credentials on a set of request headers (without keeping the token itself) """
+
+    authorization = (headers or {}).get('Authorization', '')
+    return hashlib.sha256(authorization.encode('utf-8')).hexdigest()
+
+
+_SINGLE_FLIGHT = SingleFlight()
+
+
+def get_single_flight() -> SingleFlight:
+    """ Get the process-wide request coalescing layer """
+    return _SINGLE_FLIGHT
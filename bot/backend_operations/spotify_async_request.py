@@ -0,0 +1,358 @@
+"""
+asyncio client of the Spotify API, for sending many requests at once from a single thread.
+
+Like SpotifyRequest, each request is bounded by the current deadline (and by the 'http' timeouts of 'config.yaml'), goes
+throught the retry policy and circuit breaker of its endpoint class (see resilience.py) and waits for the shared rate limiter
+(without blocking the event loop or any thread while waiting). Unlike SpotifyRequest, requests don't go throught the fair
+queueing scheduler (request_scheduler.py), aren't coalesced (single_flight.py) and aren't cached (http_cache.py).
+"""
+
+import asyncio
+import collections
+import logging
+import random
+import threading
+import yaml
+
+import aiohttp
+
+from .redis_operations import RedisAcess
+from .spotify_request import SpotifyOperationException
+from .value_codec import json_loads
+from .rate_limiter import get_rate_limiter, get_retry_after
+from .resilience import get_resilience, CircuitOpenError
+from .http_transport import get_transport
+from .deadline import check_deadline, get_timeout, remaining_time, sleep_within_deadline_async
+from .spotify_endpoint_acess import SpotifyEndpointAcess
+
+LOGGER = logging.getLogger(__name__)
+
+# What is kept of an aiohttp response (which can't be used after its body is read)
+_Response = collections.namedtuple('_Response', ['status_code', 'reason', 'headers', 'body'])
+
+# Exceptions raised by aiohttp on connection errors and timeouts
+_TRANSPORT_ERRORS = (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+
+_SESSIONS = {} # One aiohttp session (and connection pool) per event loop
+_SESSIONS_LOCK = threading.Lock() # Each event loop runs on its own thread
+
+
+def _drop_closed_loops():
+    """ Forget the sessions of event loops already closed without awaiting 'close_sessions' (they can't be closed anymore,
+    as that needs their loop: their connections go away with them) """
+
+    with _SESSIONS_LOCK:
+        for loop in [loop for loop in _SESSIONS if loop.is_closed()]:
+            del _SESSIONS[loop]
+
+
+def _get_session() -> aiohttp.ClientSession:
+    """ Get the aiohttp session of the running event loop, creating it (and its connection pool) if needed. Pool limits
+    are read from the 'http' section of 'config.yaml' """
+
+    loop = asyncio.get_running_loop()
+
+    with _SESSIONS_LOCK:
+        session = _SESSIONS.get(loop)
+
+    if session is None or session.closed:
+        _drop_closed_loops()
+
+        with open('config.yaml', 'r') as f:
+            http_config = yaml.safe_load(f).get('http') or {}
+
+        connector = aiohttp.TCPConnector(
+            limit=http_config.get('asyncPoolMaxSize', 256),
+            limit_per_host=http_config.get('asyncPoolMaxSizePerHost', 100),
+            keepalive_timeout=http_config.get('keepAliveTimeout', 30)
+        )
+        session = aiohttp.ClientSession(connector=connector)
+        with _SESSIONS_LOCK:
+            _SESSIONS[loop] = session
+
+    return session
+
+
+async def close_sessions():
+    """ Close the aiohttp session of the running event loop. Should be awaited before the loop is stopped """
+
+    with _SESSIONS_LOCK:
+        session = _SESSIONS.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+class AsyncSpotifyRequest:
+    """ asyncio version of SpotifyRequest. Many of these can be in flight at the same time on a single thread, all of them
+    sharing the connection pool of the event loop.
+
+    Params:
+        method (string): Which HTTP Method (Verb) to use
+        url (string): URL to where send HTTP request
+        data (dictionary) (optional): Data to be sent as request body (for sending JSON-like structure, use parameter 'json')
+        headers (dictionary) (optional): Headers of the request
+        params (dictionary) (optional): Parameters to be sent with the URL (like a query string)
+        json (dictionary) (optional): JSON to be sent as request body
+
+    """
+
+    def __init__(self, method, url, data=None, headers=None, params=None, json=None):
+        self.method = method
+        self.url = url
+        self.data = data
+        self.headers = headers
+        self.params = params
+        self.json = json
+
+        self.prev_url = None
+
+    def change_data(self, new_data):
+        self.data = new_data
+
+    def change_json(self, new_json):
+        self.json = new_json
+
+    async def get_next_page(self):
+        """ Async generator over the pages of a paginated response (see SpotifyRequest.get_next_page)
+
+        Returns:
+            Decoded body of each page (dict)
+        """
+        while self.url is not None:
+            yield await self.send()
+
+    async def send(self):
+        """ Send request
+
+        Returns:
+            Decoded JSON body of the response (dict) or None, if the response has no JSON body
+
+        Raises:
+            SpotifyOperationException: Raised when request to Spotify API has failed in some way and returned some kind of error
+        """
+
+        if self.url is None:
+            return None
+
+        # aiohttp does not accept None as a query parameter value, differently from requests
+        params = None
+        if self.params is not None:
+            params = {key: (str(val) if not isinstance(val, str) else val) for key, val in self.params.items() if val is not None}
+
+        # Retries and circuit breaking are done per endpoint class
+        try:
+            response = await get_resilience().call_async(self.url, self.method, _TRANSPORT_ERRORS, self._send_rate_limited, params)
+        except CircuitOpenError as e:
+            LOGGER.error('Spotify call to URL {} not sent: {}'.format(self.url, e))
+            raise SpotifyOperationException() from e
+        except _TRANSPORT_ERRORS as e:
+            check_deadline() # A timeout caused by the end of the deadline is reported as such
+            LOGGER.error('Could not reach Spotify calling URL {}: {!r}'.format(self.url, e))
+            raise SpotifyOperationException() from e
+
+        try:
+            response_dict = json_loads(response.body) if response.body else None
+        except ValueError:
+            response_dict = None
+
+        if response.status_code >= 400:
+            try:
+                error_message = response_dict['error']['message']
+            except (TypeError, KeyError):
+                error_message = response.reason
+
+            LOGGER.error('Error code {} during Spotify call to URL {} : Message = {}'.format(response.status_code, self.url, error_message))
+            raise SpotifyOperationException()
+
+        # In case of response is paginated
+        self.prev_url = self.url
+        self.url = response_dict.get('next') if isinstance(response_dict, dict) else None
+
+        return response_dict
+
+    async def _send_rate_limited(self, params) -> _Response:
+        """ Send the request once the rate limiter allows it. Requests answered with 429 (Too Many Requests) are sent again
+        after the time asked by Spotify """
+
+        rate_limiter = get_rate_limiter()
+        loop = asyncio.get_running_loop()
+        transport = get_transport()
+
+        for attempt in range(rate_limiter.max_retries + 1):
+            # Only the check for a token is done on the default executor (a Redis call): waits are done on the event loop
+            waited = 0.0
+            wait = await loop.run_in_executor(None, rate_limiter.try_acquire)
+            while wait > 0:
+                await sleep_within_deadline_async(wait)
+                waited += wait
+                wait = await loop.run_in_executor(None, rate_limiter.try_acquire)
+            rate_limiter.record_acquired(waited)
+
+            # Bounded by the configured timeouts and by the current deadline
+            connect_timeout, read_timeout = get_timeout(transport.connect_timeout, transport.read_timeout)
+            timeout = aiohttp.ClientTimeout(total=remaining_time(), sock_connect=connect_timeout, sock_read=read_timeout)
+
+            async with _get_session().request(
+                method=self.method,
+                url=self.url,
+                data=self.data,
+                headers=self.headers,
+                params=params,
+                json=self.json,
+                timeout=timeout
+            ) as response:
+
+                response = _Response(response.status, response.reason, response.headers, await response.read())
+
+            if response.status_code != 429 or attempt == rate_limiter.max_retries:
+                return response
+
+            retry_after = get_retry_after(response)
+            await loop.run_in_executor(None, rate_limiter.block, retry_after)
+
+            wait = retry_after + random.uniform(0, rate_limiter.jitter)
+            LOGGER.warning('Spotify rate limit reached while calling URL {}. Trying again after {:.1f} seconds'.format(self.url, wait))
+            await sleep_within_deadline_async(wait)
+
+
+class AsyncSpotifyEndpointAcess:
+    """ asyncio counterpart of the most used SpotifyEndpointAcess methods (paginated track listing, track addition and deletion,
+    top items and recommendations). Token and database operations are done by the synchronous RedisAcess on the loop's default
+    executor, as they are fast local calls.
+
+    Args:
+        redis_instance (RedisAcess): Instance of RedisAcess class, representing an acess point to its internal functions
+            (related to DB interaction)
+        spotify_endpoint_acess (SpotifyEndpointAcess): Synchronous acess point, whose configuration and query builders are reused
+    """
+    def __init__(self, redis_instance=None, spotify_endpoint_acess=None):
+
+        if redis_instance is None:
+            self.redis_instance = RedisAcess()
+        else:
+            self.redis_instance = redis_instance
+
+        if spotify_endpoint_acess is None:
+            self.spotify_endpoint_acess = SpotifyEndpointAcess(self.redis_instance)
+        else:
+            self.spotify_endpoint_acess = spotify_endpoint_acess
+
+        self.spotify_url_list = self.spotify_endpoint_acess.spotify_url_list
+
+    @staticmethod
+    async def _run_blocking(function, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    async def _get_acess_token_valid(self, chat_id: str) -> str:
+        return await self._run_blocking(self.spotify_endpoint_acess._get_acess_token_valid, chat_id)
+
+    async def _get_playlist_id(self, chat_id: str, playlist_id: str = None) -> str:
+        if playlist_id is None:
+            playlist_id = await self._run_blocking(self.redis_instance.get_spotify_playlist_id, chat_id)
+        return playlist_id
+
+    async def _add_or_delete_tracks(self, chat_id: str, tracks: list, method: str, playlist_id=None):
+        """ See SpotifyEndpointAcess._add_or_delete_tracks. Pages of tracks are sent one after the other, so the order of
+        the tracks on the playlist is kept """
+
+        acess_token = await self._get_acess_token_valid(chat_id)
+        playlist_id = await self._get_playlist_id(chat_id, playlist_id)
+
+        header = {
+            'Authorization': 'Bearer ' + acess_token,
+            'Content-Type': 'application/json'
+        }
+
+        url = self.spotify_url_list['playlist']['tracksURL'].format(playlist_id = playlist_id)
+
+        request = AsyncSpotifyRequest(method, url, headers=header, json=None)
+
+        page = 0
+        try:
+            for page_tracks in SpotifyEndpointAcess._split_list_evenly(tracks, 100):
+                if method == 'POST':
+                    request.change_json({"uris": page_tracks})
+                elif method == 'DELETE':
+                    request.change_json({"tracks": [{"uri": uri} for uri in page_tracks]})
+
+                request.url = url
+                await request.send()
+                page += 1
+
+        except SpotifyOperationException:
+            if page != 0:
+                LOGGER.exception(""" Warning: Operation error occured in the middle of process. Partial result is to be expected""")
+            raise
+
+        finally:
+            # The tracks the playlist has now are not known here, so its copy on Redis (see
+            # SpotifyEndpointAcess._update_playlist_mirror) is removed: the next sync reads the playlist from Spotify
+            await self._run_blocking(self.spotify_endpoint_acess._update_playlist_mirror, chat_id, playlist_id, None, None)
+
+    async def add_tracks(self, chat_id: str, tracks: list, playlist_id: str = None):
+        """ Add tracks to a Spotify Playlist (see SpotifyEndpointAcess.add_tracks) """
+        await self._add_or_delete_tracks(chat_id, tracks, 'POST', playlist_id)
+
+    async def delete_tracks(self, chat_id: str, tracks: list, playlist_id: str = None):
+        """ Delete tracks from a Spotify Playlist (see SpotifyEndpointAcess.delete_tracks) """
+        await self._add_or_delete_tracks(chat_id, tracks, 'DELETE', playlist_id)
+
+    async def get_all_tracks(self, chat_id: str, playlist_id: str = None) -> list:
+        """ Get all tracks (URI's) from a Spotify Playlist (see SpotifyEndpointAcess.get_all_tracks) """
+
+        acess_token = await self._get_acess_token_valid(chat_id)
+        playlist_id = await self._get_playlist_id(chat_id, playlist_id)
+
+        header = {'Authorization': 'Bearer ' + acess_token}
+        query = {'fields': 'items(track(uri)),next'}
+        url = self.spotify_url_list['playlist']['tracksURL'].format(playlist_id = playlist_id)
+
+        all_tracks = []
+        async for page in AsyncSpotifyRequest('GET', url, headers=header, params=query).get_next_page():
+            for track in page.get('items', []):
+                all_tracks.append(track["track"]["uri"])
+
+        return all_tracks
+
+    async def delete_all_tracks(self, chat_id: str, playlist_id: str = None):
+        """ Deletes all tracks from a Spotify Playlist (see SpotifyEndpointAcess.delete_all_tracks) """
+
+        playlist_id = await self._get_playlist_id(chat_id, playlist_id)
+        all_tracks = await self.get_all_tracks(chat_id, playlist_id)
+        await self.delete_tracks(chat_id, all_tracks, playlist_id)
+
+    async def _personalization_endpoint(self, chat_id: str, amount: int, is_all_info: bool, type_entity: str) -> list:
+
+        acess_token = await self._get_acess_token_valid(chat_id)
+
+        header = {'Authorization': 'Bearer ' + acess_token}
+        url = self.spotify_url_list['topURL'].format(type = type_entity)
+        query = {
+            'limit': min(amount, 50),
+            'time_range': 'medium_term'
+        }
+
+        response_dict = await AsyncSpotifyRequest('GET', url, headers=header, params=query).send()
+        return SpotifyEndpointAcess._format_personalization_items(response_dict['items'], is_all_info, type_entity)
+
+    async def get_user_top_tracks(self, chat_id: str, amount: int, is_all_info: bool = False) -> list:
+        """ Gets user's top tracks (see SpotifyEndpointAcess.get_user_top_tracks) """
+        return await self._personalization_endpoint(chat_id, amount, is_all_info, 'tracks')
+
+    async def get_user_top_artists(self, chat_id: str, amount: int, is_all_info: bool = False) -> list:
+        """ Gets user's top artists (see SpotifyEndpointAcess.get_user_top_artists) """
+        return await self._personalization_endpoint(chat_id, amount, is_all_info, 'artists')
+
+    async def get_recommendations(self, chat_id: str) -> list:
+        """ Get tracks recommended by Spotify Web API (see SpotifyEndpointAcess.get_recommendations) """
+
+        acess_token = await self._get_acess_token_valid(chat_id)
+
+        header = {'Authorization': 'Bearer ' + acess_token}
+        url = self.spotify_url_list['recommendationURL']
+        profile = await self._run_blocking(self.redis_instance.get_user_profile, chat_id)
+        query = self.spotify_endpoint_acess._get_recommendation_endpoint_query_param(profile)
+
+        response_dict = await AsyncSpotifyRequest('GET', url, headers=header, params=query).send()
+        return [track['uri'] for track in response_dict['tracks']]
@@ -2,14 +2,24 @@ import string, secrets
 import os
 import yaml
 import logging
+import contextvars
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlencode
 
+from redis import RedisError
+
 from .redis_operations import RedisAcess, NotLoggedInException
 from .spotify_request import SpotifyRequest, SpotifyOperationException
+from .request_scheduler import INTERACTIVE, BULK
+from .top_items_cache import TopItemsCache
 
 LOGGER = logging.getLogger(__name__)
 
+# Most tracks sent on each request that adds, removes or replaces tracks of a playlist
+PLAYLIST_TRACKS_LIMIT = 100
+
 
 class SpotifyEndpointAcess:
     """ Class that encapsulate Spotify API endpoints interactions
@@ -31,17 +41,32 @@ class SpotifyEndpointAcess:
         self.spotify_config = config['spotify']
         self.spotify_url_list = config['spotify']['url'] # List of all Spotify API endpoints (URLs) used
 
+        # How many pages of a paginated endpoint are requested at the same time
+        self.pagination_concurrency = (config.get('http') or {}).get('paginationConcurrency', 4)
+
+        # Top tracks and artists of each user, kept on Redis
+        top_items_config = config.get('topItemsCache') or {}
+        self.top_items_cache = TopItemsCache(
+            self.redis_instance,
+            fresh_for=top_items_config.get('freshFor', 21600),
+            max_age=top_items_config.get('maxAge', 604800),
+            max_refreshes=top_items_config.get('maxRefreshes', 2)
+        )
+
+        self._stats_lock = threading.Lock()
+        self._sync_stats = {'syncs': 0, 'reads': 0, 'writes': 0, 'mirror_hits': 0, 'mirror_misses': 0}
+
     @staticmethod
     def _code_generator(size, chars=string.ascii_uppercase + string.digits):
         """Generates random string with specific size, as mentioned here:
         https://stackoverflow.com/questions/2257441/random-string-generation-with-upper-case-letters-and-digits/23728630#23728630"""
         return ''.join(secrets.choice(chars) for _ in range(size))
 
-    #! TODO: As this is called several time from most places, try getting this to be stored on memory for a while
     def _get_acess_token_valid(self, chat_id: str) -> str:
         """ Private method that gets a Spotify User Acess Token and, if it's not available because user is not registered, raises an \
         exception. For reducing repeated code (and maintaning the 'get_spotify_acess_token' return None on these cases). It differs from \
-        the function available on RedisAcess class because it generates an error if no acess token can be retrieved
+        the function available on RedisAcess class because it generates an error if no acess token can be retrieved. As this is called
+        by almost every method, tokens are served from memory while they are valid (see RedisAcess.token_cache)
 
         Args:
             chat_id (int or string): ID of Telegram Bot chat
@@ -120,7 +145,7 @@ class SpotifyEndpointAcess:
         acess_token = self._get_acess_token_valid(chat_id)
 
         header = {'Authorization': 'Bearer ' + acess_token}
-        response = SpotifyRequest('GET', self.spotify_url_list['userURL'], headers=header).send()
+        response = SpotifyRequest('GET', self.spotify_url_list['userURL'], headers=header, chat_id=chat_id).send()
 
         spotify_user_id = response.json().get('id')
         self.redis_instance.register_spotify_user_id(chat_id, spotify_user_id)
@@ -159,7 +184,7 @@ class SpotifyEndpointAcess:
             'description': playlist_description
         }
 
-        response = SpotifyRequest('POST', url, headers=header, json=body).send()
+        response = SpotifyRequest('POST', url, headers=header, json=body, chat_id=chat_id).send()
         playlist_id = response.json().get('id')
 
         self.redis_instance.register_spotify_playlist_id(chat_id, playlist_id)
@@ -188,7 +213,8 @@ class SpotifyEndpointAcess:
             'Authorization': 'Bearer ' + acess_token,
         }
 
-        SpotifyRequest('DELETE', url, headers=header).send()
+        SpotifyRequest('DELETE', url, headers=header, chat_id=chat_id).send()
+        self._update_playlist_mirror(chat_id, playlist_id, None, None)
 
 
     def playlist_already_registered(self, chat_id: str) -> bool:
@@ -223,10 +249,10 @@ class SpotifyEndpointAcess:
         header = {'Authorization': 'Bearer ' + acess_token}
         url = self.spotify_url_list['playlist']['currentUserURL']
 
-        request = SpotifyRequest('GET', url, headers=header)
+        request = SpotifyRequest('GET', url, headers=header, chat_id=chat_id, priority=BULK)
 
         # Iterate over pages and playlist to find match between local playlist id and real playlist id
-        for response in request.get_next_page():
+        for response in request.get_next_page(self.pagination_concurrency):
             playlist_list = response.json().get('items')
             if playlist_list is not None:
                 for playlist in playlist_list:
@@ -252,15 +278,21 @@ class SpotifyEndpointAcess:
 
         return list(chunks(lst, size_of_chunks))
 
-    def _add_or_delete_tracks(self, chat_id: str, tracks: list, method: str, playlist_id=None):
+    def _add_or_delete_tracks(self, chat_id: str, tracks: list, method: str, playlist_id=None, current_tracks=None) -> tuple:
         """ As the operations of adding or removing tracks from a playlist are similar(with a difference on the HTTP verb and \
         on the structure of body), this functions serves to avoid redundance
 
         Args:
             chat_id (int or string): ID of Telegram Bot chat
             tracks (list of strings): Tracks URI to be added to Playlist.
-            method (string): Which HTTP method will be used. 'POST' for adding tracks, 'DELETE' for removing tracks
+            method (string): Which HTTP method will be used. 'POST' for adding tracks, 'DELETE' for removing tracks, 'PUT' for
+                replacing all tracks of the playlist (by at most 100 tracks)
             playlist_id (string) (OPTIONAL): ID of Spotify Playlist to remove tracks from
+            current_tracks (list of strings) (OPTIONAL): URIs of the tracks on the playlist before this change, if known. With
+                them (or on a replacement), the copy of the playlist kept on Redis is updated; without them, it's removed
+
+        Returns:
+            Tuple (number of requests sent, URIs of the tracks on the playlist after this change (None if not known))
 
         Raises:
             NotLoggedInException: Raised if Telegram User with chat_id is not logged in (registered on DB)
@@ -283,27 +315,41 @@ class SpotifyEndpointAcess:
 
         # As the requested body parameter related to tracks are different between the add and delete operations, first convert tem to the right one
         formated_tracks_list = []
-        if method == 'POST':
+        if method in ('POST', 'PUT'):
             formated_tracks_list = tracks
         elif method == 'DELETE':
             for uri in tracks:
                 formated_tracks_list.append({"uri": uri})
 
         # If the number of tracks to be added is greater than the maximum that Spotify accepts per request, split list of tracks
-        page_tracks_list = SpotifyEndpointAcess._split_list_evenly(formated_tracks_list, 100)
-
-        # Iniciate request without any data (filled during loop throught pages on try block below)
-        request = SpotifyRequest(method, url, headers=header, json=None)
+        # (a replacement is a single request, even without tracks: it empties the playlist)
+        if method == 'PUT':
+            if len(formated_tracks_list) > PLAYLIST_TRACKS_LIMIT:
+                raise ValueError('Cannot replace a playlist by more than {} tracks at once'.format(PLAYLIST_TRACKS_LIMIT))
+            page_tracks_list = [formated_tracks_list]
+        else:
+            page_tracks_list = SpotifyEndpointAcess._split_list_evenly(formated_tracks_list, PLAYLIST_TRACKS_LIMIT)
+
+        # Tracks the playlist will have after this change
+        if method == 'PUT':
+            playlist_tracks = list(tracks)
+        elif current_tracks is None:
+            playlist_tracks = None
+        elif method == 'POST':
+            playlist_tracks = list(current_tracks) + list(tracks)
+        else: # Removing a track removes all of its occurrences
+            removed_tracks = set(tracks)
+            playlist_tracks = [uri for uri in current_tracks if uri not in removed_tracks]
 
         # Encapsulates set of Spotify Opearions that can cause an Exception (SpotifyOperationException)
         # If it occurs between pages, it should be noted.
+        page, snapshot_id, completed = 0, None, False
         try:
-            page = 0 # Keep tabs on page
 
             # looping throught the pages of music tracks, changing what data is sent
             for page_tracks in page_tracks_list:
                 new_json = {}
-                if method == 'POST':
+                if method in ('POST', 'PUT'):
                     new_json = {
                         "uris": page_tracks
                     }
@@ -314,15 +360,26 @@ class SpotifyEndpointAcess:
                         "tracks": page_tracks
                     }
 
-                request.change_json(new_json)
-                request.send()
+                # A new request for each page: sending a request changes its URL (to the next page of the response, None here)
+                response = SpotifyRequest(method, url, headers=header, json=new_json, chat_id=chat_id, priority=BULK).send()
+                snapshot_id = response.json().get('snapshot_id')
                 page += 1
 
+            completed = True
+
         except SpotifyOperationException:
             if page != 0:
                 LOGGER.exception(""" Warning: Operation error occured in the middle of process. Partial result is to be expected""")
             raise
 
+        finally:
+            # After a partial change, what is on the playlist is not known anymore
+            if page != 0:
+                self._update_playlist_mirror(chat_id, playlist_id, snapshot_id if completed else None,
+                                             playlist_tracks if completed else None)
+
+        return page, playlist_tracks
+
     def add_tracks(self, chat_id: str, tracks: list, playlist_id: str = None):
         """ Add tracks to a Spotify Playlist. If parameter 'playlist_id' is None, use Playlist associated with Telegram user \
         from chat with ID 'chat_id'. As we don't track version control, return value from addition operation is not returned.
@@ -382,7 +439,7 @@ class SpotifyEndpointAcess:
             playlist_id = self.redis_instance.get_spotify_playlist_id(chat_id)
 
         all_tracks = self.get_all_tracks(chat_id, playlist_id)
-        self.delete_tracks(chat_id, all_tracks, playlist_id)
+        self._add_or_delete_tracks(chat_id, all_tracks, 'DELETE', playlist_id, current_tracks=all_tracks)
 
 
     # ! NOTE: All tracks are returned; No paging on return object
@@ -406,6 +463,15 @@ class SpotifyEndpointAcess:
         """
 
 
+        return self._get_all_tracks(chat_id, playlist_id)[0]
+
+    def _get_all_tracks(self, chat_id: str, playlist_id: str = None) -> tuple:
+        """ Same as 'get_all_tracks', also returning how many pages (requests) it took
+
+        Returns:
+            Tuple (list of track URIs, number of pages)
+        """
+
         acess_token = self._get_acess_token_valid(chat_id)
         if playlist_id is None:
             playlist_id = self.redis_instance.get_spotify_playlist_id(chat_id)
@@ -414,11 +480,11 @@ class SpotifyEndpointAcess:
             'Authorization': 'Bearer ' + acess_token,
         }
         query = {
-            'fields': 'items(track(uri)),next' # Get only URI (necessary for track deletion)
+            'fields': 'items(track(uri)),next,total,limit,offset' # Get only URI (necessary for track deletion) and paging info
         }
 
         url = self.spotify_url_list['playlist']['tracksURL'].format(playlist_id = playlist_id)
-        request = SpotifyRequest('GET', url, headers=header, params=query)
+        request = SpotifyRequest('GET', url, headers=header, params=query, chat_id=chat_id, priority=BULK)
 
         # Encapsulates set of Spotify Opearions that can cause an Exception (SpotifyOperationException)
         try:
@@ -427,7 +493,7 @@ class SpotifyEndpointAcess:
 
             # Get all tracks and put their URI (on the format specified by the remove tracks operation)
             # (see https://developer.spotify.com/documentation/web-api/reference/playlists/remove-tracks-playlist/#removing-all-occurrences-of-specific-items)
-            for response in request.get_next_page():
+            for response in request.get_next_page(self.pagination_concurrency):
                 response_tracks = response.json().get('items')
                 for track in response_tracks:
                     all_tracks.append(track["track"]["uri"])
@@ -439,44 +505,221 @@ class SpotifyEndpointAcess:
                 LOGGER.exception(""" Warning: Operation error occured in the middle of process. Partial result is to be expected""")
             raise
 
-        return all_tracks
+        return all_tracks, page
+
+    def _read_playlist(self, chat_id: str, playlist_id: str, known_snapshot_id: str = None) -> tuple:
+        """ Read the version (snapshot ID) and the tracks of a Spotify Playlist. The first page of tracks comes on the same
+        response as the version, so both agree. If the playlist is still on version 'known_snapshot_id', only that first
+        request is sent
 
-    def _personalization_endpoint(self, chat_id: str, amount: int, is_all_info: bool, type_entity: str) -> list:
+        Returns:
+            Tuple (snapshot ID, list of track URIs, number of requests sent). The list is None if the playlist is on version
+            'known_snapshot_id', and the snapshot ID is None if the playlist changed while its pages were read
+        """
+
+        acess_token = self._get_acess_token_valid(chat_id)
+
+        header = {'Authorization': 'Bearer ' + acess_token}
+        tracks_fields = 'items(track(uri)),next,total,limit,offset' # Get only URI (necessary for track deletion) and paging info
+
+        url = self.spotify_url_list['playlist']['playlistURL'].format(playlist_id = playlist_id)
+        query = {'fields': 'snapshot_id,tracks({})'.format(tracks_fields)}
+        response_dict = SpotifyRequest('GET', url, headers=header, params=query, chat_id=chat_id, priority=BULK).send().json()
+
+        snapshot_id = response_dict.get('snapshot_id')
+        if known_snapshot_id is not None and snapshot_id == known_snapshot_id:
+            return snapshot_id, None, 1
+
+        first_page = response_dict.get('tracks') or {}
+        tracks = [item['track']['uri'] for item in first_page.get('items') or []]
+        total, limit = first_page.get('total', len(tracks)), first_page.get('limit') or PLAYLIST_TRACKS_LIMIT
+
+        tracks_url = self.spotify_url_list['playlist']['tracksURL'].format(playlist_id = playlist_id)
+
+        def read_page(offset):
+            params = {'fields': tracks_fields, 'offset': offset, 'limit': limit}
+            return SpotifyRequest('GET', tracks_url, headers=header, params=params, chat_id=chat_id, priority=BULK).send().json()
+
+        # The other pages are read at the same time (each with a copy of the caller's context, keeping its deadline)
+        offsets = list(range(limit, total, limit))
+        if len(offsets) > 0:
+            with ThreadPoolExecutor(max_workers=min(self.pagination_concurrency, len(offsets))) as executor:
+                futures = [executor.submit(contextvars.copy_context().run, read_page, offset) for offset in offsets]
+                pages = [future.result() for future in futures]
+
+            for page in pages:
+                tracks.extend(item['track']['uri'] for item in page.get('items') or [])
+
+                # A different total means the playlist changed after the first page: what was read is not that version
+                if page.get('total') != total:
+                    snapshot_id = None
+
+        return snapshot_id, tracks, 1 + len(offsets)
+
+    def _update_playlist_mirror(self, chat_id: str, playlist_id: str, snapshot_id: str, tracks: list):
+        """ Keep the copy of the tracks of a playlist on Redis (see RedisAcess.register_playlist_mirror) on its new version, or
+        remove it if the tracks or version are not known. The copy only saves requests, so failing to update it is only logged
+        (an outdated copy has an older snapshot ID than the playlist, so it's not used) """
+
+        try:
+            if snapshot_id is None or tracks is None:
+                self.redis_instance.remove_playlist_mirror(chat_id)
+            else:
+                self.redis_instance.register_playlist_mirror(chat_id, playlist_id, snapshot_id, tracks)
+        except RedisError:
+            LOGGER.exception('Could not update the playlist mirror of user %s', chat_id)
+
+    def _get_current_tracks(self, chat_id: str, playlist_id: str) -> tuple:
+        """ Tracks on a Spotify Playlist: from its copy on Redis if the playlist is still on the version copied (checked with a
+        single request), or else read from Spotify (and copied, for the next time)
+
+        Returns:
+            Tuple (list of track URIs, number of requests sent)
         """
-        Gets Spotify ID's for user's recommended tracks or artists (common endpoint for functions 'get_user_top_tracks' and
-        'get_user_top_artists')
+
+        try:
+            mirror_snapshot_id, mirror_tracks = self.redis_instance.get_playlist_mirror(chat_id, playlist_id)
+        except RedisError:
+            LOGGER.exception('Could not read the playlist mirror of user %s', chat_id)
+            mirror_snapshot_id, mirror_tracks = None, None
+
+        snapshot_id, tracks, requests = self._read_playlist(chat_id, playlist_id, mirror_snapshot_id)
+
+        if tracks is None:
+            with self._stats_lock:
+                self._sync_stats['mirror_hits'] += 1
+            return mirror_tracks, requests
+
+        with self._stats_lock:
+            self._sync_stats['mirror_misses'] += 1
+
+        # Copied even if nothing changes next (changes that follow update the copy)
+        if snapshot_id is not None:
+            self._update_playlist_mirror(chat_id, playlist_id, snapshot_id, tracks)
+
+        return tracks, requests
+
+    @staticmethod
+    def _count_playlist_writes(plan: tuple) -> int:
+        """ Number of requests needed by a plan of '_plan_playlist_sync' """
+
+        replacement, to_remove, to_add = plan
+        return ((1 if replacement is not None else 0) + -(-len(to_remove) // PLAYLIST_TRACKS_LIMIT)
+                + -(-len(to_add) // PLAYLIST_TRACKS_LIMIT))
+
+    @staticmethod
+    def _plan_playlist_sync(current_tracks: list, tracks: list) -> tuple:
+        """
+        Choose the changes (with fewest requests) that turn a playlist with 'current_tracks' into one with 'tracks', in that
+        order. Either the whole playlist is replaced (by the first 100 tracks, then the others are added), or only the tracks
+        not wanted anymore are removed and the missing ones are added at the end (possible only if the tracks kept are already
+        the first ones of 'tracks', on the same order)
+
+        Args:
+            current_tracks (list of strings): URIs of the tracks on the playlist (None if not known: it's replaced)
+            tracks (list of strings): URIs of the tracks the playlist should have
+
+        Returns:
+            Tuple (tracks to replace the playlist by (None if it's not replaced), tracks to remove, tracks to add after them)
+        """
+
+        replace_plan = (tracks[:PLAYLIST_TRACKS_LIMIT], [], tracks[PLAYLIST_TRACKS_LIMIT:])
+        if current_tracks is None:
+            return replace_plan
+
+        # Removing a track removes all of its occurrences
+        wanted_tracks = set(tracks)
+        kept_tracks = [uri for uri in current_tracks if uri in wanted_tracks]
+        if kept_tracks != tracks[:len(kept_tracks)]:
+            return replace_plan
+
+        to_remove = list(dict.fromkeys(uri for uri in current_tracks if uri not in wanted_tracks))
+        diff_plan = (None, to_remove, tracks[len(kept_tracks):])
+
+        if SpotifyEndpointAcess._count_playlist_writes(diff_plan) < SpotifyEndpointAcess._count_playlist_writes(replace_plan):
+            return diff_plan
+        return replace_plan
+
+    def sync_playlist_tracks(self, chat_id: str, tracks: list, playlist_id: str = None) -> dict:
+        """ Make a Spotify Playlist have exactly 'tracks' (on that order), sending as few requests as possible: a playlist of
+        up to 100 tracks is replaced with a single request. Longer ones are read first, so only the tracks that changed are
+        removed and added, if that takes fewer requests than replacing them all. If parameter 'playlist_id' is None, use
+        Playlist associated with Telegram user from chat with ID 'chat_id'.
 
         Args:
             chat_id (int or string): ID of Telegram Bot chat
-            amount (int): How many objects (artists or tracks) tor return
-            is_all_info (bool): If this function should return more informationa about the tracks selected (like name and artist)
-            type_entity (str): 'tracks' for User's top tracks, 'artists' for User's top artists
+            tracks (list of strings): URIs of the tracks the playlist should have
+            playlist_id (int) (OPTIONAL): ID of Spotify Playlist to change
 
         Returns:
-            List of Spotify ID's referencing artists or tracks
+            Dict with the requests sent for reading ('reads') and changing ('writes') the playlist, their sum ('calls'), if
+            the playlist was replaced ('replaced'), and how many tracks were removed ('removed') and added after that ('added')
 
+        Raises:
+            NotLoggedInException: Raised if Telegram User with chat_id is not logged in (registered on DB)
+            TokenRequestException: Raised when there was some error while getting Spotify Acess token from the Spotify endpoint
+            RedisError: Raised if there was some internal Redis error while getting the acess token or the Spotify's User ID
+            SpotifyOperationException: Raised when a Spotify Request has failed
         """
 
-        acess_token = self._get_acess_token_valid(chat_id)
+        if playlist_id is None:
+            playlist_id = self.redis_instance.get_spotify_playlist_id(chat_id)
 
-        header = {
-            'Authorization': 'Bearer ' + acess_token,
+        # A replacement by up to 100 tracks is a single request: reading the playlist first could only add requests. Longer
+        # playlists are read from their copy on Redis, while they are not changed by anything else
+        current_tracks, reads = None, 0
+        if len(tracks) > PLAYLIST_TRACKS_LIMIT:
+            current_tracks, reads = self._get_current_tracks(chat_id, playlist_id)
+
+        replacement, to_remove, to_add = SpotifyEndpointAcess._plan_playlist_sync(current_tracks, tracks)
+
+        # Each change starts from the tracks left by the previous one, so the copy on Redis follows all of them
+        writes = 0
+        if replacement is not None:
+            requests, current_tracks = self._add_or_delete_tracks(chat_id, replacement, 'PUT', playlist_id)
+            writes += requests
+        for method, changed_tracks in (('DELETE', to_remove), ('POST', to_add)):
+            requests, current_tracks = self._add_or_delete_tracks(chat_id, changed_tracks, method, playlist_id, current_tracks)
+            writes += requests
+
+        with self._stats_lock:
+            self._sync_stats['syncs'] += 1
+            self._sync_stats['reads'] += reads
+            self._sync_stats['writes'] += writes
+
+        return {
+            'reads': reads,
+            'writes': writes,
+            'calls': reads + writes,
+            'replaced': replacement is not None,
+            'removed': len(to_remove),
+            'added': len(to_add)
         }
 
-        url = self.spotify_url_list['topURL'].format(type = type_entity)
+    def get_playlist_sync_stats(self) -> dict:
+        """ Get metrics of 'sync_playlist_tracks': playlists synced ('syncs'), requests sent for reading ('reads') and changing
+        ('writes') them, the average of requests per sync ('calls_per_sync'), and how many times the tracks of a playlist were
+        taken from its copy on Redis ('mirror_hits') or had to be read from Spotify ('mirror_misses') """
 
-        # Limit the amount of things to return by what is acceptable from Spotify API
-        if amount > 50:
-            amount = 50
+        with self._stats_lock:
+            stats = dict(self._sync_stats)
 
-        query = {
-            'limit': amount,
-            'time_range': 'medium_term'
-        }
+        stats['calls_per_sync'] = (stats['reads'] + stats['writes']) / stats['syncs'] if stats['syncs'] > 0 else 0.0
+        return stats
 
-        request = SpotifyRequest('GET', url, headers=header, params=query)
-        response = request.send()
-        response_items = response.json()['items']
+    @staticmethod
+    def _format_personalization_items(response_items: list, is_all_info: bool, type_entity: str) -> list:
+        """
+        Selects, from the items returned by the Spotify personalization endpoint, the information used by the bot
+
+        Args:
+            response_items (list): Field 'items' of the personalization endpoint response
+            is_all_info (bool): If this function should return more informationa about the tracks selected (like name and artist)
+            type_entity (str): 'tracks' for User's top tracks, 'artists' for User's top artists
+
+        Returns:
+            List of Spotify ID's referencing artists or tracks (or list of dicts, if 'is_all_info' is True)
+        """
 
         item_list = []
 
@@ -510,6 +753,69 @@ class SpotifyEndpointAcess:
 
         return item_list
 
+    def _fetch_top_items(self, chat_id: str, type_entity: str, priority: str, offset: int = 0, limit: int = 50) -> tuple:
+        """ Gets 'limit' (<= 50) top tracks or artists of an user from Spotify (starting from rank 'offset' + 1), with all
+        information about them (see '_format_personalization_items')
+
+        Returns:
+            Tuple (list of items, total of top items of the user)
+        """
+
+        acess_token = self._get_acess_token_valid(chat_id)
+
+        header = {
+            'Authorization': 'Bearer ' + acess_token,
+        }
+
+        url = self.spotify_url_list['topURL'].format(type = type_entity)
+
+        # By default, the most that is acceptable from Spotify API (cached, so it serves any amount)
+        query = {
+            'limit': limit,
+            'offset': offset,
+            'time_range': 'medium_term'
+        }
+
+        request = SpotifyRequest('GET', url, headers=header, params=query, chat_id=chat_id, priority=priority)
+        response_dict = request.send().json()
+
+        items = SpotifyEndpointAcess._format_personalization_items(response_dict['items'], True, type_entity)
+        return items, response_dict.get('total', offset + len(items))
+
+    def _personalization_endpoint(self, chat_id: str, amount: int, is_all_info: bool, type_entity: str, miss_amount: int = None) -> list:
+        """
+        Gets Spotify ID's for user's recommended tracks or artists (common endpoint for functions 'get_user_top_tracks' and
+        'get_user_top_artists'). Served from cache when possible (see TopItemsCache): stale entries are returned right away
+        and refreshed in background
+
+        Args:
+            chat_id (int or string): ID of Telegram Bot chat
+            amount (int): How many objects (artists or tracks) tor return
+            is_all_info (bool): If this function should return more informationa about the tracks selected (like name and artist)
+            type_entity (str): 'tracks' for User's top tracks, 'artists' for User's top artists
+            miss_amount (int) (optional): On a cache miss, only this many items are fetched (and cached, as a partial entry:
+                see TopItemsCache.get)
+
+        Returns:
+            List of Spotify ID's referencing artists or tracks
+
+        """
+
+        # A miss is fetched while the user waits, but a background refresh is not urgent
+        items = self.top_items_cache.get(
+            chat_id, type_entity,
+            fetch=lambda: self._fetch_top_items(chat_id, type_entity, INTERACTIVE)[0],
+            refresh=lambda: self._fetch_top_items(chat_id, type_entity, BULK)[0],
+            fetch_first=(lambda: self._fetch_top_items(chat_id, type_entity, INTERACTIVE, limit=miss_amount)[0]) if miss_amount else None
+        )
+
+        # Limit the amount of things to return by what is acceptable from Spotify API
+        items = items[:min(amount, 50)]
+
+        if not is_all_info:
+            return [item['id'] for item in items]
+        return items
+
     # ! Note: This method will only get the first 50 items. Changes on internal implementation will need to be to in other to
     # ! support getting lower rank items
     def get_user_top_tracks(self, chat_id: str, amount: int, is_all_info: bool = False) -> list:
@@ -566,13 +872,84 @@ class SpotifyEndpointAcess:
 
         return self._personalization_endpoint(chat_id, amount, is_all_info, 'artists')
 
-    def _get_recommendation_endpoint_query_param(self, chat_id):
+    def get_user_top_items(self, chat_id: str, artists_amount: int, tracks_amount: int, is_all_info: bool = False, miss_amount: int = None) -> tuple:
+        """
+        Gets user's top artists and top tracks at the same time (so it takes as long as the slowest of both calls, not their sum).
+        If only one of them fails, the other is still returned
+
+        Args:
+            chat_id (int or string): ID of Telegram Bot chat
+            artists_amount (int): How many artists to return (<= 50)
+            tracks_amount (int): How many tracks to return (<= 50)
+            is_all_info (bool): If this function should return more information about the items (see 'get_user_top_artists'
+                and 'get_user_top_tracks')
+            miss_amount (int) (optional): If the items of an user are not cached, only this many of them are fetched while the
+                user waits (see '_personalization_endpoint')
+
+        Returns:
+            Tuple (top artists, top tracks, errors). 'errors' is a dict of 'artists' or 'tracks' to the exception raised while
+            getting them (and their list is None)
+
+        Raises:
+            Same exceptions as 'get_user_top_artists' and 'get_user_top_tracks', if both of them fail (the one of the artists)
+        """
+
+        results, errors = {}, {}
+
+        # Artists are fetched on another thread (keeping the deadline of the current one), tracks on this one
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            artists_future = executor.submit(contextvars.copy_context().run, self._personalization_endpoint, chat_id, artists_amount,
+                                             is_all_info, 'artists', miss_amount)
+
+            try:
+                results['tracks'] = self._personalization_endpoint(chat_id, tracks_amount, is_all_info, 'tracks', miss_amount)
+            except Exception as e:
+                errors['tracks'] = e
+
+            try:
+                results['artists'] = artists_future.result()
+            except Exception as e:
+                errors['artists'] = e
+
+        if len(errors) == 2:
+            raise errors['artists']
+
+        for type_entity, error in errors.items():
+            LOGGER.error('Could not get top %s of user %s: %s', type_entity, chat_id, error)
+
+        return results.get('artists'), results.get('tracks'), errors
+
+    def get_user_top_items_page(self, chat_id: str, type_entity: str, offset: int) -> tuple:
+        """
+        Gets the next 50 top tracks or artists of an user, after the first 'offset' ones (for going beyond the first 50, that
+        'get_user_top_tracks' and 'get_user_top_artists' return). Always sent to Spotify (these are not cached)
+
+        Args:
+            chat_id (int or string): ID of Telegram Bot chat
+            type_entity (str): 'tracks' for User's top tracks, 'artists' for User's top artists
+            offset (int): How many top items to skip
+
+        Returns:
+            Tuple (list of dicts with all information about each item (as with 'is_all_info' on 'get_user_top_tracks' and
+            'get_user_top_artists'), total of top items of the user). The list is empty if there are no more items
+
+        Raises:
+            Same exceptions as 'get_user_top_tracks'
+        """
+
+        return self._fetch_top_items(chat_id, type_entity, INTERACTIVE, offset)
+
+    @staticmethod
+    def _get_recommendation_endpoint_query_param(profile):
         """
         Auxilar function that constructs the query parameters for the Spotify tracks recommendation endpoint. Does great part of the
-        work of thsi endpoint.
+        work of thsi endpoint. Works only on the user profile given, without acessing the database.
 
         Note: This is where the bot's behavior of ignoring range values choices if a level value has been selected. This behavior is \
             separated from the DB acess behavior, which does not make any distinctions like this.
+
+        Args:
+            profile (UserProfileSnapshot): What is stored about the user (see RedisAcess.get_user_profile)
         """
 
 
@@ -581,11 +958,8 @@ class SpotifyEndpointAcess:
         #seed_artists = self.get_user_top_artists(chat_id, 2)
         #seed_tracks = self.get_user_top_tracks(chat_id, 3)
 
-        seed_artists = self.redis_instance.get_user_artists(chat_id)
-        seed_artists = [artist['id'] for artist in seed_artists]
-
-        seed_tracks = self.redis_instance.get_user_tracks(chat_id)
-        seed_tracks = [track['id'] for track in seed_tracks]
+        seed_artists = [artist['id'] for artist in profile.artists]
+        seed_tracks = [track['id'] for track in profile.tracks]
 
         params = {
             'limit': 20,
@@ -621,15 +995,15 @@ class SpotifyEndpointAcess:
             max_attribute_val = setup_value.get('max_val', None)
 
             if db_presense == 'both':
-                if self.redis_instance.get_survey_attribute(chat_id, attribute + '_level'):
+                if profile.get_survey_attribute(attribute + '_level'):
                     db_presense = 'level'
-                elif self.redis_instance.get_survey_attribute(chat_id, attribute + '_range'):
+                elif profile.get_survey_attribute(attribute + '_range'):
                     db_presense = 'range'
                 else:
                     continue
 
             if db_presense == 'level':
-                level_val_dict = self.redis_instance.get_survey_attribute(chat_id, attribute + '_level')
+                level_val_dict = profile.get_survey_attribute(attribute + '_level')
 
                 if level_val_dict is None:
                     continue
@@ -647,7 +1021,7 @@ class SpotifyEndpointAcess:
 
             elif db_presense == 'range':
 
-                range_val_dict = self.redis_instance.get_survey_attribute(chat_id, attribute + '_range')
+                range_val_dict = profile.get_survey_attribute(attribute + '_range')
                 if range_val_dict is None:
                     continue
 
@@ -691,9 +1065,9 @@ class SpotifyEndpointAcess:
         }
 
         url = self.spotify_url_list['recommendationURL']
-        query = self._get_recommendation_endpoint_query_param(chat_id)
+        query = self._get_recommendation_endpoint_query_param(self.redis_instance.get_user_profile(chat_id))
 
-        request = SpotifyRequest('GET', url, headers=header, params=query)
+        request = SpotifyRequest('GET', url, headers=header, params=query, chat_id=chat_id)
         response_dict = request.send().json()
 
 
@@ -709,6 +1083,6 @@ class SpotifyEndpointAcess:
         acess_token = self._get_acess_token_valid(chat_id)
 
         header = {'Authorization': 'Bearer ' + acess_token}
-        r = SpotifyRequest('GET', self.spotify_url_list['userURL'], headers=header).send()
+        r = SpotifyRequest('GET', self.spotify_url_list['userURL'], headers=header, chat_id=chat_id).send()
 
         return r.json()
\ No newline at end of file
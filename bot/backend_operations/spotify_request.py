@@ -1,10 +1,108 @@
 import requests
-import json
 
 import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from .http_transport import get_transport
+from .rate_limiter import get_rate_limiter
+from .request_scheduler import get_scheduler, INTERACTIVE
+from .resilience import get_resilience, CircuitOpenError
+from .deadline import check_deadline
+from .single_flight import get_single_flight, token_identity
+from .http_cache import get_http_cache
+from .value_codec import json_loads
 
 LOGGER = logging.getLogger(__name__)
 
+
+class SpotifyResponse:
+    """ Wrapper of a response from the Spotify API whose JSON body is decoded only once (the first time it's needed, with
+    'json_loads'), no matter how many times 'json' is called. Paging information (see Paging Object on
+    https://developer.spotify.com/documentation/web-api/reference/object-model/#paging-object) is available as properties.
+
+    Params:
+        response (requests.Response): Response being wrapped
+        cached_content (bytes) (optional): Body stored on the HTTP cache. If given, 'response' is a 304 (Not Modified) and
+            this object stands for a 200 (OK) response with this body
+    """
+
+    _NOT_DECODED = object()
+
+    def __init__(self, response, cached_content=None):
+        self.raw = response
+        self._cached_content = cached_content
+
+        self.from_cache = cached_content is not None
+        self.status_code = 200 if self.from_cache else response.status_code
+        self.ok = True if self.from_cache else response.ok
+        self.reason = 'OK' if self.from_cache else response.reason
+        self.headers = response.headers
+        self.url = response.url
+
+        self._decoded = self._NOT_DECODED
+        self._decode_error = None
+
+    @property
+    def content(self):
+        if self._cached_content is not None:
+            return self._cached_content
+        return self.raw.content
+
+    def json(self):
+        """ Get the decoded JSON body (the same object is returned on every call, so don't change it)
+
+        Raises:
+            ValueError: Raised if the body is not valid JSON
+        """
+
+        if self._decoded is self._NOT_DECODED:
+            try:
+                self._decoded = json_loads(self.content)
+            except ValueError as e:
+                self._decoded = None
+                self._decode_error = e
+
+        if self._decode_error is not None:
+            raise self._decode_error
+
+        return self._decoded
+
+    def _paging_field(self, field):
+        try:
+            body = self.json()
+        except ValueError:
+            return None
+
+        if isinstance(body, dict):
+            return body.get(field)
+        return None
+
+    @property
+    def is_paginated(self) -> bool:
+        return self._paging_field('total') is not None and self._paging_field('limit') is not None
+
+    @property
+    def next_url(self):
+        return self._paging_field('next')
+
+    @property
+    def total(self):
+        return self._paging_field('total')
+
+    @property
+    def limit(self):
+        return self._paging_field('limit')
+
+    @property
+    def offset(self):
+        return self._paging_field('offset') or 0
+
+    @property
+    def items(self):
+        return self._paging_field('items')
+
+
 # TODO: Test pagins mechanism
 # TODO: Treat API Endpoints erros better (raising, etc...)
 class SpotifyRequest:
@@ -17,10 +115,12 @@ class SpotifyRequest:
         headers (dictionary) (optional): Headers of the request
         params (dictionary) (optional): Parameters to be sent with the URL (like a query string)
         json (dictionary) (optional): JSON to be sent as request body
+        chat_id (int or string) (optional): ID of Telegram Bot chat on behalf of whom the request is sent (used for fair queueing)
+        priority (string) (optional): Priority class of the request (INTERACTIVE or BULK, see request_scheduler.py)
 
     """
 
-    def __init__(self, method, url, data=None, headers=None, params=None, json=None):
+    def __init__(self, method, url, data=None, headers=None, params=None, json=None, chat_id=None, priority=INTERACTIVE):
         self.method = method
         self.url = url
         self.data = data
@@ -28,6 +128,9 @@ class SpotifyRequest:
         self.params = params
         self.json = json
 
+        self.chat_id = chat_id
+        self.priority = priority
+
         self.prev_url = None
 
     def __check_response__(self, response):
@@ -39,7 +142,7 @@ class SpotifyRequest:
 
             try:
                 error_message = response.json()['error']['message']
-            except json.decoder.JSONDecodeError:
+            except (ValueError, KeyError, TypeError):
                 error_message = response.reason
 
             LOGGER.error('Error code: {}'.format(response.status_code))
@@ -63,41 +166,191 @@ class SpotifyRequest:
         """
         self.json = new_json
 
-    def get_next_page(self):
+    def get_next_page(self, concurrency=1):
         """ For requests that are paginated (see Pagin Object on \
         https://developer.spotify.com/documentation/web-api/reference/object-model/#paging-object)
 
         The way this works is: as pagination on the Spotify API consists of a field 'next' with the URL of the next page
         if there is another page, yield result and change this object's URL to be the next page
 
+        If 'concurrency' is greater than 1, the fields 'total', 'limit' and 'offset' of the first page are used to request
+        all remaining pages at once (with at most 'concurrency' requests in flight), still yielding them in order. Responses
+        without these fields fall back to following the 'next' URL.
+
+        Args:
+            concurrency (int) (optional): Maximum number of pages requested at the same time
+
         Returns:
-            Response object
+            SpotifyResponse object
         """
+        if concurrency > 1:
+            yield from self._get_pages_concurrently(concurrency)
+            return
+
         while self.url is not None:
             yield self.send()
 
-    def send(self):
+    def _send_page(self, url, offset, limit):
+        """ Send this request for the page starting at 'offset' of 'url' """
+
+        params = dict(self.params or {})
+        params['offset'] = offset
+        params['limit'] = limit
+
+        return SpotifyRequest(self.method, url, data=self.data, headers=self.headers, params=params, json=self.json,
+                              chat_id=self.chat_id, priority=self.priority).send()
+
+    def _get_pages_concurrently(self, concurrency):
+        """ Paginator mode of 'get_next_page' that fetches all pages after the first one concurrently """
 
         if self.url is None:
-            return None
+            return
+
+        base_url = self.url
+        first_response = self.send()
+        yield first_response
+
+        if not first_response.is_paginated:
+            yield from self.get_next_page()
+            return
 
-        response = requests.request(
-            method=self.method,
-            url=self.url,
-            data=self.data,
-            headers=self.headers,
-            params = self.params,
-            json = self.json
-        )
+        total, limit, offset = first_response.total, first_response.limit, first_response.offset
 
+        remaining_offsets = list(range(offset + limit, total, limit)) if limit else []
+        if len(remaining_offsets) == 0:
+            self.url = None
+            return
+
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(remaining_offsets))) as executor:
+            # Each page is sent with a copy of the caller's context, so the deadline of the caller is kept
+            futures = [
+                executor.submit(contextvars.copy_context().run, self._send_page, base_url, page_offset, limit)
+                for page_offset in remaining_offsets
+            ]
+            try:
+                for future in futures:
+                    yield future.result()
+            finally:
+                # If the caller stopped iterating (or some page failed), don't send requests for the pages left
+                for future in futures:
+                    future.cancel()
+
+        self.prev_url = self.url
+        self.url = None
+
+    def _send_rate_limited(self, headers=None):
+        """ Send request when the rate limiter allows it, through the fair queue. Requests answered with 429 (Too Many Requests)
+        are sent again after the time asked by Spotify. A slot of the fair queue is only held while the request is sent: never
+        while waiting for the rate limiter
+
+        Args:
+            headers (dictionary) (optional): Headers to send instead of this request's ones
+        """
+
+        rate_limiter = get_rate_limiter()
+
+        for attempt in range(rate_limiter.max_retries + 1):
+            rate_limiter.acquire()
+
+            response = get_scheduler().run(
+                self.chat_id,
+                self.priority,
+                get_transport().request,
+                method=self.method,
+                url=self.url,
+                data=self.data,
+                headers=headers if headers is not None else self.headers,
+                params = self.params,
+                json = self.json
+            )
+
+            if response.status_code != 429 or attempt == rate_limiter.max_retries:
+                break
+
+            waited = rate_limiter.wait_retry_after(response)
+            LOGGER.warning('Spotify rate limit reached while calling URL {}. Trying again after {:.1f} seconds'.format(self.url, waited))
+
+        return response
+
+    def _fetch(self):
+        """ Send request (throught retries, fair queueing and rate limiting) and check its response.
+
+        GET requests on behalf of an user to endpoints on the HTTP cache (see http_cache.py) are sent as conditional requests
+        when a response is stored: if Spotify answers 304 (Not Modified), the stored body is used.
+
+        Returns:
+            SpotifyResponse object
+        """
+
+        http_cache = get_http_cache()
+        cache_key, cache_entry, headers = None, None, None
+
+        if http_cache.is_cacheable(self.method, self.url, self.chat_id):
+            cache_key = http_cache.key_for(self.url, self.params)
+            cache_entry = http_cache.lookup(self.chat_id, cache_key)
+            if cache_entry is not None:
+                headers = dict(self.headers or {})
+                headers['If-None-Match'] = cache_entry[0]
+
+        # Retries (with backoff, outside of the scheduler slot) and circuit breaking are done per endpoint class
+        try:
+            response = get_resilience().call(self.url, self.method, self._send_rate_limited, headers)
+        except CircuitOpenError as e:
+            LOGGER.error('Spotify call to URL {} not sent: {}'.format(self.url, e))
+            raise SpotifyOperationException() from e
+        except requests.RequestException as e:
+            check_deadline() # A timeout caused by the end of the deadline is reported as such
+            LOGGER.error('Could not reach Spotify calling URL {}: {}'.format(self.url, e))
+            raise SpotifyOperationException() from e
+
+        if cache_entry is not None and response.status_code == 304:
+            http_cache.record_hit(cache_entry[1])
+            return SpotifyResponse(response, cached_content=cache_entry[1])
+
+        response = SpotifyResponse(response)
         self.__check_response__(response)
 
+        if cache_key is not None:
+            http_cache.record_miss()
+            etag = response.headers.get('ETag')
+            if etag is not None:
+                http_cache.store(self.chat_id, cache_key, etag, response.content)
+
+        return response
+
+    def _flight_key(self):
+        """ Identity of this request for coalescing: method, URL, query parameters and the credentials used """
+
+        params = tuple(sorted((str(key), str(val)) for key, val in (self.params or {}).items()))
+        return (self.method, self.url, params, token_identity(self.headers))
+
+    def send(self):
+        """ Send request. If the response is paginated, this object's URL becomes the URL of the next page.
+
+        Identical GET requests sent at the same time (same URL, parameters and acess token) are coalesced: only one is sent,
+        and all of them receive its response.
+
+        Returns:
+            SpotifyResponse object (or None, if there's no URL to send the request to)
+
+        Raises:
+            SpotifyOperationException: Raised when request to Spotify API has failed in some way and returned some kind of error
+        """
+
+        if self.url is None:
+            return None
+
+        if self.method.upper() == 'GET':
+            response = get_single_flight().do(self._flight_key(), self._fetch)
+        else:
+            response = self._fetch()
+
         try:
             # In case of response is paginated
-            next_url = response.json().get('next')
+            response.json()
             self.prev_url = self.url
-            self.url = next_url
-        except json.decoder.JSONDecodeError:
+            self.url = response.next_url
+        except ValueError:
             pass
 
         return response
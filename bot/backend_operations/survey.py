@@ -129,4 +129,16 @@ class SurveyManager:
 
         self.current_index = 0
 
+    def get_state(self) -> dict:
+        """ Get everything needed to rebuild this object (with 'from_state'), as values JSON can represent """
+        return {'questions': self.questions, 'options': self.options, 'current_index': self.current_index}
+
+    @classmethod
+    def from_state(cls, state):
+        """ Rebuild a SurveyManager from what 'get_state' returned """
+
+        survey = cls(state['questions'], state['options'])
+        survey.current_index = state['current_index']
+        return survey
+
 
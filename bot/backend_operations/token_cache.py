@@ -0,0 +1,87 @@
+import collections
+import threading
+import time
+
+
+class AccessTokenCache:
+    """ In-process cache of Spotify acess tokens, keyed by chat ID, in front of the ones stored on Redis.
+
+    A token is kept until 'safety_margin' seconds before it expires (so a token about to expire is never handed out to a
+    request that could take a while to be sent), and for at most 'max_ttl' seconds: a logout (or any change of the token on
+    Redis) done by another replica is only noticed by this one when its copy of the token stops being served. When there are
+    'max_size' tokens stored, the least recently used is evicted.
+
+    Thread-safe.
+
+    Params:
+        max_size (int): Maximum number of tokens kept
+        safety_margin (float): Seconds before expiration when a token stops being served
+        max_ttl (float): Longest, in seconds, a token is served from memory
+    """
+
+    def __init__(self, max_size=1024, safety_margin=60, max_ttl=30):
+        self.max_size = max_size
+        self.safety_margin = safety_margin
+        self.max_ttl = max_ttl
+
+        self._lock = threading.Lock()
+        self._tokens = collections.OrderedDict() # chat ID -> (acess token, monotonic time when it stops being served)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _key(chat_id):
+        return str(chat_id)
+
+    def get(self, chat_id):
+        """ Get the acess token of a chat, or None if there's none (or it's about to expire) """
+
+        key = self._key(chat_id)
+
+        with self._lock:
+            entry = self._tokens.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self._tokens.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            if entry is not None:
+                del self._tokens[key]
+            self.misses += 1
+            return None
+
+    def put(self, chat_id, acess_token, expires_in):
+        """ Store the acess token of a chat
+
+        Args:
+            chat_id (int or string): ID of Telegram Bot chat
+            acess_token (string): Spotify acess token
+            expires_in (float): Seconds until the token expires
+        """
+
+        ttl = min(expires_in - self.safety_margin, self.max_ttl)
+        if ttl <= 0:
+            return
+
+        key = self._key(chat_id)
+
+        with self._lock:
+            self._tokens[key] = (acess_token, time.monotonic() + ttl)
+            self._tokens.move_to_end(key)
+
+            while len(self._tokens) > self.max_size:
+                self._tokens.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, chat_id):
+        with self._lock:
+            self._tokens.pop(self._key(chat_id), None)
+
+    def get_stats(self) -> dict:
+        """ Get cache metrics: tokens served from memory ('hits'), lookups that had to go to Redis ('misses'), tokens
+        evicted for lack of space ('evictions') and tokens stored ('size') """
+
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self._tokens)}
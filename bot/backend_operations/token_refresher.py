@@ -0,0 +1,128 @@
+import threading
+import logging
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from redis import RedisError
+
+from .redis_operations import TOKEN_EXPIRY_KEY, USER_ACTIVITY_KEY
+from .user_layout import USER
+from .request_scheduler import BULK
+
+LOGGER = logging.getLogger(__name__)
+
+
+class TokenRefresher:
+    """ Background renewal of acess tokens, so handlers of user actions (almost) never have to wait for a token refresh.
+
+    On each run, the tokens that expire in the next 'refresh_ahead' seconds (from the sorted set of expiration times kept by
+    RedisAcess) are refreshed, but only for users active in the last 'active_window' seconds: tokens of inactive users are
+    left to expire and refreshed lazily, if they ever come back. Refreshes are done in batches, 'max_concurrent' at a time, as
+    bulk calls, and use the same per-user lock as lazy refreshes (so replicas running it at the same time don't repeat them).
+
+    Params:
+        redis_instance (RedisAcess): Acess point to the database
+        refresh_ahead (int): Seconds before expiration when a token is refreshed
+        active_window (int): Seconds since the last activity of a user for its token to be kept valid
+        batch_size (int): Maximum tokens refreshed on each run
+        max_concurrent (int): Maximum token refreshes at the same time
+    """
+
+    def __init__(self, redis_instance, refresh_ahead=300, active_window=86400, batch_size=50, max_concurrent=4):
+        self.redis_instance = redis_instance
+        self.refresh_ahead = refresh_ahead
+        self.active_window = active_window
+        self.batch_size = batch_size
+        self.max_concurrent = max_concurrent
+
+        self._lock = threading.Lock()
+        self._stats = {'runs': 0, 'refreshed': 0, 'failed': 0, 'skipped_inactive': 0}
+
+    def _count(self, stat, amount=1):
+        with self._lock:
+            self._stats[stat] += amount
+
+    def _refresh(self, chat_id, refresh_token):
+        try:
+            self.redis_instance._refresh_acess_token(chat_id, refresh_token, min_ttl=self.refresh_ahead, priority=BULK)
+            self._count('refreshed')
+        except Exception: # Runs on a worker thread: nothing up the stack would see it
+            self._count('failed')
+            LOGGER.exception('Could not refresh acess token of user %s in background', chat_id)
+
+    def _find_due(self, redis, now) -> list:
+        """ Find the tokens about to expire of active users stored on a shard (tokens of inactive users are forgotten)
+
+        Returns:
+            List of tuples (chat ID, refresh token)
+        """
+
+        # Tokens that have already expired are refreshed lazily, when needed
+        redis.zremrangebyscore(TOKEN_EXPIRY_KEY, '-inf', now)
+        expiring = [chat_id.decode('utf-8') for chat_id in
+                    redis.zrangebyscore(TOKEN_EXPIRY_KEY, now, now + self.refresh_ahead, start=0, num=self.batch_size)]
+        if len(expiring) == 0:
+            return []
+
+        pipeline = redis.pipeline(transaction=False)
+        parsers = []
+        for chat_id in expiring:
+            pipeline.zscore(USER_ACTIVITY_KEY, chat_id)
+            parsers.append(self.redis_instance.layout.queue_read(pipeline, chat_id, USER, ['refresh_token']))
+        results = iter(pipeline.execute())
+
+        due = []
+        inactive = []
+        for chat_id, parse in zip(expiring, parsers):
+            last_active = next(results)
+            refresh_token, = parse(results)
+            if refresh_token is None or last_active is None or last_active < now - self.active_window:
+                inactive.append(chat_id)
+            else:
+                due.append((chat_id, refresh_token))
+
+        if len(inactive) > 0:
+            redis.zrem(TOKEN_EXPIRY_KEY, *inactive)
+            self._count('skipped_inactive', len(inactive))
+
+        return due
+
+    def run_once(self) -> int:
+        """ Refresh the tokens about to expire of active users (up to 'batch_size' per Redis shard)
+
+        Returns:
+            Number of tokens that were due for a refresh on this run
+        """
+
+        now = time.time()
+
+        due = []
+        for redis in self.redis_instance.shards.get_nodes():
+            due += self._find_due(redis, now)
+
+        if len(due) == 0:
+            return 0
+
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrent, len(due))) as executor:
+            for chat_id, refresh_token in due:
+                executor.submit(self._refresh, chat_id, refresh_token)
+
+        self._count('runs')
+        return len(due)
+
+    def refresh(self, context):
+        """ Callback for the Telegram Bot job queue (see 'JobQueue.run_repeating') """
+
+        try:
+            refreshed = self.run_once()
+            if refreshed > 0:
+                LOGGER.info('Refreshed %s acess tokens in background', refreshed)
+        except RedisError:
+            LOGGER.exception('Could not look for acess tokens to refresh')
+
+    def get_stats(self) -> dict:
+        """ Get refresher metrics: runs that found tokens to refresh ('runs'), tokens refreshed ('refreshed'), refreshes that
+        failed ('failed') and tokens left to expire because their users were inactive ('skipped_inactive') """
+        with self._lock:
+            return dict(self._stats)
@@ -0,0 +1,176 @@
+import threading
+import logging
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from redis import RedisError
+
+from . import value_codec
+from .user_layout import legacy_key
+
+LOGGER = logging.getLogger(__name__)
+
+
+def top_items_key(chat_id, type_entity) -> str:
+    return legacy_key(chat_id, 'top_' + type_entity)
+
+
+def queue_invalidate_top_items(pipeline, chat_id):
+    """ Queue the removal of the cached top items of an user (when they may not be theirs anymore, like on a new login) """
+
+    pipeline.unlink(top_items_key(chat_id, 'tracks'), top_items_key(chat_id, 'artists'))
+
+
+class TopItemsCache:
+    """ Cache of the top tracks and artists of each user (from the Spotify personalization endpoint), stored on Redis (on the
+    shard of the user) with the time they were fetched. A user's top items change slowly, so:
+
+    - Entries fetched less than 'fresh_for' seconds ago are served as they are
+    - Older entries (up to 'max_age' seconds, when Redis removes them) are served right away too, while a refresh runs in
+      background (stale-while-revalidate). Only one refresh per entry runs at a time, across all bot replicas
+    - Without an entry, items are fetched while the caller waits, and stored
+
+    The whole list (with all information about each item) is stored, so the same entry serves any amount asked for. A caller
+    that only needs the first items can fetch just those on a miss: they are stored as a partial entry, served only to callers
+    like it (and completed by the next refresh). A Redis error never fails a call: it's treated as a cache miss.
+
+    Params:
+        redis_instance (RedisAcess): Acess point to the database
+        fresh_for (int): Seconds an entry is served without being refreshed
+        max_age (int): Seconds an entry is kept
+        max_refreshes (int): Maximum background refreshes at the same time
+    """
+
+    # Seconds a background refresh of an entry holds its lock (other replicas don't refresh it meanwhile)
+    REFRESH_LOCK_TIMEOUT = 60
+
+    def __init__(self, redis_instance, fresh_for=21600, max_age=604800, max_refreshes=2):
+        self.redis_instance = redis_instance
+        self.fresh_for = fresh_for
+        self.max_age = max_age
+
+        self._executor = ThreadPoolExecutor(max_workers=max_refreshes, thread_name_prefix='top-items-refresh')
+        self._refreshing = set() # (chat ID, type) of the refreshes running on this process
+
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'refreshes': 0, 'refresh_failures': 0}
+
+    def _count(self, stat, amount=1):
+        with self._lock:
+            self._stats[stat] += amount
+
+    def _lookup(self, chat_id, type_entity):
+        """ Get a stored entry
+
+        Returns:
+            Tuple (list of items, seconds since they were fetched, if only the first items are stored), or (None, None, None)
+            if nothing is stored
+        """
+
+        try:
+            fetched_at, items, partial = self.redis_instance.shard(chat_id).hmget(
+                top_items_key(chat_id, type_entity), 't', 'items', 'partial')
+        except RedisError:
+            LOGGER.exception('Could not read top %s of user %s from cache', type_entity, chat_id)
+            return None, None, None
+
+        if fetched_at is None or items is None:
+            return None, None, None
+
+        try:
+            return value_codec.decode_seeds(items, type_entity), time.time() - float(fetched_at), partial is not None
+        except value_codec.CodecException:
+            LOGGER.exception('Invalid top %s of user %s on cache', type_entity, chat_id)
+            return None, None, None
+
+    def _store(self, chat_id, type_entity, items, partial=False):
+        key = top_items_key(chat_id, type_entity)
+        try:
+            pipeline = self.redis_instance.shard(chat_id).pipeline(transaction=False)
+            pipeline.hset(key, mapping={'t': time.time(), 'items': value_codec.encode_seeds(items, type_entity)})
+            if partial:
+                pipeline.hset(key, 'partial', 1)
+            else:
+                pipeline.hdel(key, 'partial')
+            pipeline.expire(key, self.max_age)
+            pipeline.execute()
+        except RedisError:
+            LOGGER.exception('Could not write top %s of user %s on cache', type_entity, chat_id)
+
+    def _refresh(self, chat_id, type_entity, fetch):
+        redis = self.redis_instance.shard(chat_id)
+        lock_key = top_items_key(chat_id, type_entity) + ':refresh'
+
+        try:
+            if not redis.set(lock_key, 1, nx=True, ex=self.REFRESH_LOCK_TIMEOUT):
+                return # Being refreshed by another replica
+
+            try:
+                self._store(chat_id, type_entity, fetch())
+                self._count('refreshes')
+            finally:
+                redis.delete(lock_key)
+        except Exception: # Runs on a worker thread: nothing up the stack would see it
+            self._count('refresh_failures')
+            LOGGER.exception('Could not refresh top %s of user %s', type_entity, chat_id)
+        finally:
+            with self._lock:
+                self._refreshing.discard((str(chat_id), type_entity))
+
+    def _schedule_refresh(self, chat_id, type_entity, refresh):
+        with self._lock:
+            is_refreshing = (str(chat_id), type_entity) in self._refreshing
+            self._refreshing.add((str(chat_id), type_entity))
+        if not is_refreshing:
+            self._executor.submit(self._refresh, chat_id, type_entity, refresh)
+
+    def get(self, chat_id, type_entity, fetch, refresh=None, fetch_first=None) -> list:
+        """
+        Get the top items of an user, from cache or (on a miss) from 'fetch'
+
+        Args:
+            chat_id (int or string): ID of Telegram Bot chat
+            type_entity (str): 'tracks' or 'artists'
+            fetch (function): Function without arguments that gets the items from Spotify (list of dicts, with all
+                information about each item)
+            refresh (function) (optional): Same as 'fetch', called in background for refreshing stale entries. If not
+                given, 'fetch' is used
+            fetch_first (function) (optional): Called instead of 'fetch' on a miss, for getting only the first items while the
+                caller waits. They are stored as a partial entry (the whole list is stored by the next refresh, or 'fetch'
+                of a caller without 'fetch_first')
+
+        Returns:
+            List of dicts (as returned by 'fetch', or by 'fetch_first' if given)
+        """
+
+        items, age, partial = self._lookup(chat_id, type_entity)
+
+        # A partial entry does not have what a caller of the whole list needs
+        if items is None or (partial and fetch_first is None):
+            self._count('misses')
+            partial = fetch_first is not None
+            items = fetch_first() if partial else fetch()
+            self._store(chat_id, type_entity, items, partial)
+            return items
+
+        if age < self.fresh_for:
+            self._count('hits')
+            return items
+
+        self._count('stale_hits')
+        self._schedule_refresh(chat_id, type_entity, refresh or fetch)
+
+        return items
+
+    def get_stats(self) -> dict:
+        """ Get cache metrics: fresh entries served ('hits'), stale entries served while refreshed in background ('stale_hits'),
+        calls that waited for Spotify ('misses'), background refreshes done ('refreshes') and failed ('refresh_failures'), and
+        the share of calls answered from cache ('hit_ratio') """
+
+        with self._lock:
+            stats = dict(self._stats)
+
+        calls = stats['hits'] + stats['stale_hits'] + stats['misses']
+        stats['hit_ratio'] = (stats['hits'] + stats['stale_hits']) / calls if calls > 0 else 0.0
+        return stats
@@ -0,0 +1,190 @@
+import time
+
+# Key layouts of the data of each user
+# - LEGACY: up to four keys per user: hash 'user:[id]' (refresh token, Spotify user and playlist IDs), string 'user:[id]:acess_token'
+#   (with a TTL), hash 'user:[id]:seeds' and hash 'user:[id]:attributes'
+# - COMPACT: a single small hash per user, 'u:[id]', with short field names. The acess token expiration is a field too (its TTL
+#   can't be the one of the key): expired tokens are ignored when read and, on Redis 7.4 or newer, can also be removed by Redis
+#   with per-field TTLs (HEXPIRE)
+# - DUAL: for migrating from one layout to the other while the bot is running. Writes go to both layouts, reads prefer the compact one
+LEGACY, DUAL, COMPACT = 'legacy', 'dual', 'compact'
+
+# Sections of the data of an user: the user hash itself, seeds and survey attributes
+USER, SEEDS, ATTRIBUTES = '', 'seeds', 'attributes'
+
+_USER_FIELDS = {'refresh_token': 'rt', 'user_id': 'uid', 'playlist_id': 'pid'}
+_SECTION_PREFIXES = {SEEDS: 's:', ATTRIBUTES: 'a:'}
+_TOKEN_FIELD, _TOKEN_EXPIRATION_FIELD = 't', 'te'
+
+# Removes all fields of a hash starting with a prefix
+_DELETE_PREFIX_SCRIPT = """
+local fields = redis.call('HKEYS', KEYS[1])
+local removed = 0
+for _, field in ipairs(fields) do
+    if string.sub(field, 1, string.len(ARGV[1])) == ARGV[1] then
+        removed = removed + redis.call('HDEL', KEYS[1], field)
+    end
+end
+return removed
+"""
+
+
+def legacy_key(chat_id, section=USER) -> str:
+    return 'user' + ':' + str(chat_id) + (':' + section if section else '')
+
+
+def compact_key(chat_id) -> str:
+    return 'u' + ':' + str(chat_id)
+
+
+def compact_field(section, field) -> str:
+    if section == USER:
+        return _USER_FIELDS.get(field, field)
+    return _SECTION_PREFIXES[section] + field
+
+
+class UserKeyLayout:
+    """ Where (and how) the data of each user is stored on Redis, for one of the layouts above.
+
+    Operations are queued on a pipeline given by the caller, so they can be sent together with others on a single round trip.
+    Reads return a function that, given an iterator over the results of the pipeline, consumes the results of that read
+    and returns its value.
+
+    Params:
+        redis (Redis): Redis client (used for registering scripts)
+        mode (string): LEGACY, DUAL or COMPACT
+        field_ttl (bool): If the acess token fields should also get a per-field TTL (needs Redis 7.4 or newer)
+    """
+
+    def __init__(self, redis, mode=LEGACY, field_ttl=False):
+        if mode not in (LEGACY, DUAL, COMPACT):
+            raise ValueError('Unknown Redis key layout: {}'.format(mode))
+
+        self.mode = mode
+        self.field_ttl = field_ttl
+        self.reads_legacy = mode != COMPACT
+        self.reads_compact = mode != LEGACY
+
+        self._delete_prefix = redis.register_script(_DELETE_PREFIX_SCRIPT)
+
+    def queue_read(self, pipeline, chat_id, section, fields):
+        """ Queue the read of some fields of a section. The parser returns a list of values (bytes or None) """
+
+        if self.reads_compact:
+            pipeline.hmget(compact_key(chat_id), [compact_field(section, field) for field in fields])
+        if self.reads_legacy:
+            pipeline.hmget(legacy_key(chat_id, section), fields)
+
+        def parse(results):
+            compact_values = next(results) if self.reads_compact else [None] * len(fields)
+            legacy_values = next(results) if self.reads_legacy else [None] * len(fields)
+            return [compact if compact is not None else legacy for compact, legacy in zip(compact_values, legacy_values)]
+
+        return parse
+
+    def queue_read_section(self, pipeline, chat_id, section):
+        """ Queue the read of all fields of a section. The parser returns a dict of field name (string) to value (bytes) """
+
+        if self.reads_compact:
+            pipeline.hgetall(compact_key(chat_id))
+        if self.reads_legacy:
+            pipeline.hgetall(legacy_key(chat_id, section))
+
+        def parse(results):
+            values = {}
+            compact_values = next(results) if self.reads_compact else {}
+
+            if self.reads_legacy:
+                values.update((field.decode('utf-8'), value) for field, value in next(results).items())
+
+            if section == USER:
+                fields_by_compact = {compact: field for field, compact in _USER_FIELDS.items()}
+                for field, value in compact_values.items():
+                    field = field.decode('utf-8')
+                    if field in fields_by_compact:
+                        values[fields_by_compact[field]] = value
+            else:
+                prefix = _SECTION_PREFIXES[section]
+                for field, value in compact_values.items():
+                    field = field.decode('utf-8')
+                    if field.startswith(prefix):
+                        values[field[len(prefix):]] = value
+
+            return values
+
+        return parse
+
+    def queue_write(self, pipeline, chat_id, section, mapping):
+        """ Queue the write of some fields (dict of field name to value) of a section """
+
+        if self.mode != LEGACY:
+            pipeline.hset(compact_key(chat_id), mapping={compact_field(section, field): value for field, value in mapping.items()})
+        if self.mode != COMPACT:
+            pipeline.hset(legacy_key(chat_id, section), mapping=mapping)
+
+    def queue_delete_fields(self, pipeline, chat_id, section, fields):
+        if self.mode != LEGACY:
+            pipeline.hdel(compact_key(chat_id), *[compact_field(section, field) for field in fields])
+        if self.mode != COMPACT:
+            pipeline.hdel(legacy_key(chat_id, section), *fields)
+
+    def queue_delete_section(self, pipeline, chat_id, section):
+        """ Queue the removal of all fields of a section (seeds or attributes) """
+
+        if self.mode != LEGACY:
+            self._delete_prefix(keys=[compact_key(chat_id)], args=[_SECTION_PREFIXES[section]], client=pipeline)
+        if self.mode != COMPACT:
+            pipeline.unlink(legacy_key(chat_id, section))
+
+    def queue_read_token(self, pipeline, chat_id):
+        """ Queue the read of the acess token. The parser returns a tuple (token as bytes, seconds until it expires), or
+        (None, None) if there's no valid token """
+
+        if self.reads_compact:
+            pipeline.hmget(compact_key(chat_id), [_TOKEN_FIELD, _TOKEN_EXPIRATION_FIELD])
+        if self.reads_legacy:
+            pipeline.get(legacy_key(chat_id, 'acess_token'))
+            pipeline.ttl(legacy_key(chat_id, 'acess_token'))
+
+        def parse(results):
+            if self.reads_compact:
+                token, expiration = next(results)
+                if token is not None and expiration is not None:
+                    expires_in = int(float(expiration) - time.time())
+                    if expires_in > 0:
+                        if self.reads_legacy:
+                            next(results), next(results)
+                        return token, expires_in
+
+            if self.reads_legacy:
+                token, expires_in = next(results), next(results)
+                if token is not None:
+                    return token, expires_in
+
+            return None, None
+
+        return parse
+
+    def queue_write_token(self, pipeline, chat_id, acess_token, expires_in):
+        if self.mode != LEGACY:
+            key = compact_key(chat_id)
+            pipeline.hset(key, mapping={_TOKEN_FIELD: acess_token, _TOKEN_EXPIRATION_FIELD: int(time.time() + expires_in)})
+            if self.field_ttl:
+                pipeline.execute_command('HEXPIRE', key, expires_in, 'FIELDS', 2, _TOKEN_FIELD, _TOKEN_EXPIRATION_FIELD)
+        if self.mode != COMPACT:
+            pipeline.set(name = legacy_key(chat_id, 'acess_token'), value = acess_token, ex = expires_in)
+
+    def queue_delete_user(self, pipeline, chat_id):
+        """ Queue the removal of all data of an user (on both layouts, so nothing is left behind by a migration) """
+
+        pipeline.unlink(
+            compact_key(chat_id),
+            legacy_key(chat_id, SEEDS),
+            legacy_key(chat_id, ATTRIBUTES),
+            legacy_key(chat_id, 'acess_token'),
+            legacy_key(chat_id),
+            legacy_key(chat_id, 'top_tracks'), # Cache of top items (see top_items_cache.py)
+            legacy_key(chat_id, 'top_artists'),
+            legacy_key(chat_id, 'playlist'), # Copy of the tracks of the playlist (see RedisAcess.register_playlist_mirror)
+            legacy_key(chat_id, 'http_cache') # Spotify responses stored for the user (see http_cache.py)
+        )
@@ -0,0 +1,117 @@
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Values stored on Redis are either JSON text (the original format, never starting with this byte) or this header
+# followed by a MessagePack body. New versions of the format get new header bytes
+MSGPACK_V1 = b'\x01'
+
+# Seeds are stored as [id, name, artists (tracks) or genres (artists), link]. The link is left out (None) when it's the one
+# Spotify gives to every track or artist, as it can be rebuilt from the ID
+_SEED_LIST_FIELD = {'tracks': 'artists', 'artists': 'genres'}
+_SEED_LINK = {'tracks': 'https://open.spotify.com/track/{}', 'artists': 'https://open.spotify.com/artist/{}'}
+
+
+class CodecException(Exception):
+    """ Exception raised when a stored value can't be decoded """
+
+
+def json_loads(body):
+    """ Decode a JSON body (bytes or string) with orjson, if it's installed, or with the standard library otherwise (used
+    for stored values and for Spotify responses)
+
+    Raises:
+        ValueError: Raised if the body is not valid JSON
+    """
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def encode(value) -> bytes:
+    """ Encode a value (anything JSON can represent) in the compact format. If msgpack is not installed, compact JSON is used """
+
+    if msgpack is None:
+        return json.dumps(value, separators=(',', ':')).encode('utf-8')
+    return MSGPACK_V1 + msgpack.packb(value, use_bin_type=True)
+
+
+def decode(raw):
+    """ Decode a value stored by 'encode', or stored as JSON text by older versions of the bot
+
+    Raises:
+        CodecException: Raised if the value is invalid (or is in the compact format and msgpack is not installed)
+    """
+
+    if raw[:1] == MSGPACK_V1:
+        if msgpack is None:
+            raise CodecException('Value stored as MessagePack, but msgpack is not installed')
+        try:
+            return msgpack.unpackb(raw[1:], raw=False)
+        except ValueError as e: # Errors of msgpack are subclasses of ValueError
+            raise CodecException('Invalid MessagePack value') from e
+
+    try:
+        return json_loads(raw)
+    except ValueError as e:
+        raise CodecException('Invalid JSON value') from e
+
+
+def is_compact(raw) -> bool:
+    """ If a stored value is already on the current compact format """
+    return raw[:1] == MSGPACK_V1
+
+
+def encode_seeds(seeds, type_entity) -> bytes:
+    """ Encode seed tracks or artists (as selected by SpotifyEndpointAcess._format_personalization_items)
+
+    Args:
+        seeds (list of dicts): Seeds
+        type_entity (str): 'tracks' or 'artists'
+    """
+
+    if msgpack is None:
+        return encode(seeds)
+
+    list_field = _SEED_LIST_FIELD[type_entity]
+    link_format = _SEED_LINK[type_entity]
+
+    rows = []
+    for seed in seeds:
+        link = seed.get('link', '')
+        rows.append([
+            seed['id'],
+            seed.get('name', ''),
+            seed.get(list_field, []),
+            None if link == link_format.format(seed['id']) else link
+        ])
+
+    return encode(rows)
+
+
+def decode_seeds(raw, type_entity) -> list:
+    """ Decode seed tracks or artists stored by 'encode_seeds' (or as JSON text by older versions of the bot)
+
+    Raises:
+        CodecException: Raised if the value is invalid
+    """
+
+    value = decode(raw)
+    if not is_compact(raw):
+        return value
+
+    list_field = _SEED_LIST_FIELD[type_entity]
+    link_format = _SEED_LINK[type_entity]
+
+    return [
+        {'id': seed_id, 'name': name, list_field: list_values, 'link': link_format.format(seed_id) if link is None else link}
+        for seed_id, name, list_values, link in value
+    ]
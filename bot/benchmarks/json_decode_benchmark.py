@@ -0,0 +1,79 @@
+"""
+Micro-benchmark of the decoding of large playlist pages: the old behavior (requests' 'Response.json' called twice per
+response, once by SpotifyRequest.send and once by the caller) against SpotifyResponse (decoded once), with the standard
+library and, if installed, with orjson.
+
+Run from the 'bot' folder: python -m benchmarks.json_decode_benchmark [--pages 200] [--items 100]
+"""
+
+import argparse
+import json
+import timeit
+
+import requests
+
+from backend_operations import value_codec
+from backend_operations.spotify_request import SpotifyResponse
+from benchmarks.spotify_stand_in import _playlist_track
+
+
+def make_response(body):
+    response = requests.Response()
+    response.status_code = 200
+    response._content = body
+    response.encoding = 'utf-8'
+    return response
+
+
+def make_page(page, items):
+    """ Full playlist tracks page (no 'fields' filter), as in Spotify's Paging Object """
+    return json.dumps({
+        'href': 'https://api.spotify.com/v1/playlists/benchmark/tracks',
+        'items': [_playlist_track(page * items + i) for i in range(items)],
+        'limit': items,
+        'offset': page * items,
+        'total': 100000,
+        'next': 'https://api.spotify.com/v1/playlists/benchmark/tracks?offset={}&limit={}'.format((page + 1) * items, items),
+        'previous': None
+    }).encode('utf-8')
+
+
+def double_decode(bodies):
+    for body in bodies:
+        response = make_response(body)
+        response.json().get('next')
+        [track['track']['uri'] for track in response.json()['items']]
+
+
+def single_decode(bodies):
+    for body in bodies:
+        response = SpotifyResponse(make_response(body))
+        response.next_url
+        [track['track']['uri'] for track in response.json()['items']]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--items', type=int, default=100, help='Tracks per page')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    bodies = [make_page(page, args.items) for page in range(args.pages)]
+    print('{} pages of {} tracks ({:.1f} KB per page)'.format(args.pages, args.items, sum(map(len, bodies)) / len(bodies) / 1024))
+
+    orjson_module = value_codec.orjson
+    cases = [('requests .json() twice', double_decode, None), ('SpotifyResponse, json', single_decode, None)]
+    if orjson_module is not None:
+        cases.append(('SpotifyResponse, orjson', single_decode, orjson_module))
+
+    for name, function, decoder in cases:
+        value_codec.orjson = decoder
+        best = min(timeit.repeat(lambda: function(bodies), number=1, repeat=args.repeat))
+        print('{:>24}: {:.1f} ms ({:.3f} ms per page)'.format(name, best * 1000, best * 1000 / args.pages))
+
+    value_codec.orjson = orjson_module
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Compares sequential pagination (following the 'next' URL) against concurrent pagination (using 'total', 'limit' and
+'offset') of SpotifyRequest, on a local Spotify stand-in.
+
+Run from the 'bot' folder: python -m benchmarks.pagination_benchmark [--items 2000] [--latency 0.05] [--concurrency 4 8]
+"""
+
+import argparse
+import time
+
+from backend_operations.spotify_request import SpotifyRequest
+from benchmarks.spotify_stand_in import start_stand_in
+
+
+def fetch_all(url, concurrency):
+    request = SpotifyRequest('GET', url, params={'limit': 100})
+
+    start = time.perf_counter()
+    items = []
+    for response in request.get_next_page(concurrency):
+        items.extend(response.json()['items'])
+
+    return time.perf_counter() - start, len(items)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=2000, help='Total of tracks on the playlist')
+    parser.add_argument('--latency', type=float, default=0.05, help='Latency of each request, in seconds')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[2, 4, 8], help='Concurrency levels to measure')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    server, base_url = start_stand_in(args.latency, args.items)
+    url = base_url + '/playlists/benchmark/tracks'
+
+    print('{} tracks, {} pages, {:.0f} ms per request'.format(args.items, -(-args.items // 100), args.latency * 1000))
+
+    for concurrency in [1] + args.concurrency:
+        timings = []
+        for _ in range(args.repeat):
+            elapsed, total = fetch_all(url, concurrency)
+            assert total == args.items
+            timings.append(elapsed)
+
+        mode = 'sequential' if concurrency == 1 else 'concurrency {}'.format(concurrency)
+        print('{:>16}: best {:.3f} s'.format(mode, min(timings)))
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Compares regenerating a playlist by removing all of its tracks and adding the new ones (as '/generate_playlist' used to do)
+against SpotifyEndpointAcess.sync_playlist_tracks, counting the requests each sends to a local Spotify stand-in. Before each sync, the playlist is
+filled by a sync too, as on the bot: if the Redis server of config.yaml is reachable, a copy of it is kept there
+(RedisAcess.register_playlist_mirror) and used instead of reading the playlist again.
+
+Run from the 'bot' folder: python -m benchmarks.playlist_sync_benchmark [--latency 0.05] [--sizes 20 150 400]
+"""
+
+import argparse
+import time
+
+from backend_operations.spotify_endpoint_acess import SpotifyEndpointAcess
+from benchmarks.spotify_stand_in import start_stand_in
+
+
+def uris(start, amount):
+    return ['spotify:track:{:022d}'.format(i) for i in range(start, start + amount)]
+
+
+def scenarios(size):
+    """ Pairs of (tracks on the playlist, tracks it should have) """
+
+    return {
+        'all new': (uris(0, size), uris(size, size)),
+        'unchanged': (uris(0, size), uris(0, size)),
+        'last 10% new': (uris(0, size), uris(0, size - size // 10) + uris(size, size // 10))
+    }
+
+
+def delete_then_add(server, spotify_endpoint_acess, current_tracks, tracks):
+    server.playlists['benchmark'] = list(current_tracks)
+    return measure(server, lambda: (spotify_endpoint_acess.delete_all_tracks(None, 'benchmark'),
+                                    spotify_endpoint_acess.add_tracks(None, tracks, 'benchmark')))
+
+
+def sync(server, spotify_endpoint_acess, current_tracks, tracks):
+    spotify_endpoint_acess.sync_playlist_tracks(None, current_tracks, 'benchmark')
+    return measure(server, lambda: spotify_endpoint_acess.sync_playlist_tracks(None, tracks, 'benchmark'))
+
+
+def measure(server, function):
+    """ Requests sent and seconds taken by 'function' """
+
+    requests_before = server.request_count
+    start = time.perf_counter()
+    function()
+    return server.request_count - requests_before, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--latency', type=float, default=0.05, help='Latency of each request, in seconds')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[20, 150, 400], help='Tracks on the playlist')
+    args = parser.parse_args()
+
+    server, base_url = start_stand_in(args.latency)
+
+    spotify_endpoint_acess = SpotifyEndpointAcess()
+    spotify_endpoint_acess.spotify_url_list = dict(spotify_endpoint_acess.spotify_url_list, playlist=dict(
+        spotify_endpoint_acess.spotify_url_list['playlist'], tracksURL=base_url + '/playlists/{playlist_id}/tracks',
+        playlistURL=base_url + '/playlists/{playlist_id}'))
+    spotify_endpoint_acess._get_acess_token_valid = lambda chat_id: 'benchmark'
+
+    print('{:.0f} ms per request'.format(args.latency * 1000))
+
+    for size in args.sizes:
+        for scenario, (current_tracks, tracks) in scenarios(size).items():
+            results = []
+            for function in (delete_then_add, sync):
+                requests, elapsed = function(server, spotify_endpoint_acess, current_tracks, tracks)
+                assert server.playlists['benchmark'] == tracks
+                results.append('{:>3} requests, {:.3f} s'.format(requests, elapsed))
+
+            print('{:>4} tracks, {:>12}: delete then add {} | sync {}'.format(size, scenario, *results))
+
+    print('Playlist copies used: {mirror_hits}, playlists read: {mirror_misses}'.format(**spotify_endpoint_acess.get_playlist_sync_stats()))
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
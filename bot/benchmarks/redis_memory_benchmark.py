@@ -0,0 +1,77 @@
+"""
+Benchmark of the memory used per user on a real Redis server by each key layout of backend_operations/user_layout.py
+(legacy: four keys per user, compact: a single hash per user), with seeds and attributes on the compact value format.
+
+Synthetic users are written through RedisAcess, so what's measured is what the bot stores. Uses a database of its own (15,
+by default), which is flushed at the end. Run from the 'bot' folder:
+python -m benchmarks.redis_memory_benchmark [--host localhost] [--port 6379] [--db 15] [--users 10000]
+"""
+
+import argparse
+
+from redis import Redis
+
+from backend_operations.redis_operations import RedisAcess
+from backend_operations.sharding import ConsistentHashRing
+from backend_operations.user_layout import UserKeyLayout, LEGACY, COMPACT, legacy_key, compact_key
+
+FIRST_CHAT_ID = 100000000
+ATTRIBUTES = ['acousticness_level', 'danceability_range', 'energy_level', 'popularity_range', 'valance_level', 'duration_range']
+
+
+def seeds(type_entity, chat_id):
+    list_field = 'artists' if type_entity == 'tracks' else 'genres'
+    link = 'https://open.spotify.com/{}/{{}}'.format(type_entity[:-1])
+    return [
+        {'id': '{:022d}'.format(chat_id + i), 'name': 'Seed {}'.format(i), list_field: ['Name {}'.format(i)], 'link': link.format('{:022d}'.format(chat_id + i))}
+        for i in range(5)
+    ]
+
+
+def fill_users(redis_acess, users):
+    for chat_id in range(FIRST_CHAT_ID, FIRST_CHAT_ID + users):
+        with redis_acess.write_batch(chat_id, transaction=False) as pipeline:
+            redis_acess.layout.queue_write_token(pipeline, chat_id, 'B' * 200, 3600)
+            redis_acess.layout.queue_write(pipeline, chat_id, '', {'refresh_token': 'A' * 130, 'user_id': 'user{}'.format(chat_id),
+                                                                    'playlist_id': '{:022d}'.format(chat_id)})
+        redis_acess.register_user_seeds(chat_id, seeds('artists', chat_id), seeds('tracks', chat_id))
+        for attribute in ATTRIBUTES:
+            redis_acess.register_survey_attribute(chat_id, attribute, {'min_val': 0.2, 'max_val': 0.8})
+
+
+def measure(redis_acess, mode, users):
+    redis = redis_acess.redis
+    redis.flushdb()
+    redis_acess.layout = UserKeyLayout(redis, mode)
+
+    memory_before = redis.info('memory')['used_memory']
+    fill_users(redis_acess, users)
+    memory_after = redis.info('memory')['used_memory']
+
+    keys = [compact_key(FIRST_CHAT_ID)] if mode == COMPACT else [legacy_key(FIRST_CHAT_ID, section) for section in ('', 'seeds', 'attributes', 'acess_token')]
+    encodings = ', '.join('{} {}'.format(key, redis.object('encoding', key).decode('utf-8')) for key in keys)
+
+    print('{:8} {:8.0f} bytes per user ({})'.format(mode, (memory_after - memory_before) / users, encodings))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=15)
+    parser.add_argument('--users', type=int, default=10000)
+    args = parser.parse_args()
+
+    redis_acess = RedisAcess()
+    redis_acess.redis = Redis(host=args.host, port=args.port, db=args.db)
+    redis_acess.shards = ConsistentHashRing({'benchmark': redis_acess.redis})
+
+    try:
+        for mode in (LEGACY, COMPACT):
+            measure(redis_acess, mode, args.users)
+    finally:
+        redis_acess.redis.flushdb()
+
+
+if __name__ == '__main__':
+    main()
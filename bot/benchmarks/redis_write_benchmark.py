@@ -0,0 +1,146 @@
+"""
+Benchmark of the multi-key write flows of RedisAcess (seeds confirmation, user deletion, token registration and survey
+attributes removal) against a real Redis server: one command per round trip, as they used to be written, against the
+batched versions (pipelines, MULTI / EXEC and UNLINK).
+
+Uses a database of its own (15, by default), which is flushed at the end. Run from the 'bot' folder:
+python -m benchmarks.redis_write_benchmark [--host localhost] [--port 6379] [--db 15] [--iterations 500]
+"""
+
+import argparse
+import json
+import statistics
+import time
+
+from redis import Redis
+
+from backend_operations.redis_operations import RedisAcess
+from backend_operations.sharding import ConsistentHashRing
+
+CHAT_ID = 123456789
+SEEDS = [{'id': '{:022d}'.format(i), 'name': 'Seed {}'.format(i)} for i in range(5)]
+ATTRIBUTES = ['acousticness_level', 'danceability_range', 'energy_level', 'popularity_range', 'valance_level', 'duration_range']
+
+
+def fill_user(redis):
+    redis.set('user:{}:acess_token'.format(CHAT_ID), 'acess-token', ex=3600)
+    redis.hset('user:{}'.format(CHAT_ID), mapping={'refresh_token': 'refresh-token', 'user_id': 'user', 'playlist_id': 'playlist'})
+    redis.hset('user:{}:seeds'.format(CHAT_ID), mapping={'artists': json.dumps(SEEDS), 'tracks': json.dumps(SEEDS)})
+    redis.hset('user:{}:attributes'.format(CHAT_ID), mapping={attribute: json.dumps({'min_val': 0.2, 'max_val': 0.8}) for attribute in ATTRIBUTES})
+
+
+# Flows as they used to be: one round trip per command
+
+def old_setup_confirm(redis_acess):
+    redis = redis_acess.redis
+    redis.hdel('user:{}:seeds'.format(CHAT_ID), 'artists')
+    redis.hdel('user:{}:seeds'.format(CHAT_ID), 'tracks')
+    redis.hset('user:{}:seeds'.format(CHAT_ID), 'artists', json.dumps(SEEDS))
+    redis.hset('user:{}:seeds'.format(CHAT_ID), 'tracks', json.dumps(SEEDS))
+
+
+def old_delete_user(redis_acess):
+    redis = redis_acess.redis
+    redis.delete('user:{}:seeds'.format(CHAT_ID))
+    redis.delete('user:{}:attributes'.format(CHAT_ID))
+    redis.delete('user:{}:acess_token'.format(CHAT_ID))
+    redis.delete('user:{}'.format(CHAT_ID))
+
+
+def old_register_tokens(redis_acess):
+    redis, memcache = redis_acess.redis, redis_acess.memcache
+    memcache.get('benchmark-hash')
+    memcache.delete('benchmark-hash')
+    redis.hget('user:{}'.format(CHAT_ID), 'refresh_token')
+    redis.set('user:{}:acess_token'.format(CHAT_ID), 'acess-token', ex=3600)
+    redis.hset('user:{}'.format(CHAT_ID), 'refresh_token', 'refresh-token')
+
+
+def old_remove_attributes(redis_acess):
+    redis = redis_acess.redis
+    attributes = redis.hgetall('user:{}:attributes'.format(CHAT_ID))
+    keys = [key for key, val in attributes.items() if val != b'{}']
+    if len(keys) != 0:
+        redis.hdel('user:{}:attributes'.format(CHAT_ID), *keys)
+
+
+# Batched flows
+
+def new_setup_confirm(redis_acess):
+    redis_acess.register_user_seeds(CHAT_ID, SEEDS, SEEDS)
+
+
+def new_delete_user(redis_acess):
+    redis_acess.delete_user(CHAT_ID)
+
+
+def new_register_tokens(redis_acess):
+    redis_acess.register_spotify_tokens(CHAT_ID, 'benchmark-hash')
+
+
+def new_remove_attributes(redis_acess):
+    redis_acess.remove_all_survey_attributes(CHAT_ID)
+
+
+def measure(redis_acess, function, setup, iterations):
+    samples = []
+    for _ in range(iterations):
+        setup()
+        start = time.perf_counter()
+        function(redis_acess)
+        samples.append(time.perf_counter() - start)
+
+    samples.sort()
+    return statistics.mean(samples), samples[int(0.99 * (len(samples) - 1))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=15)
+    parser.add_argument('--iterations', type=int, default=500)
+    args = parser.parse_args()
+
+    redis = Redis(host=args.host, port=args.port, db=args.db)
+    redis.ping()
+
+    redis_acess = RedisAcess()
+    redis_acess.redis = redis
+    redis_acess.memcache = redis
+    redis_acess.shards = ConsistentHashRing({'benchmark': redis})
+
+    # No Spotify account here: the token endpoint answers with fixed tokens
+    redis_acess.__user_token_request_process__ = lambda form, is_refresh, chat_id=None: {
+        'acess_token': 'acess-token', 'refresh_token': 'refresh-token', 'expires_in': 3600
+    }
+
+    def setup_full_user():
+        fill_user(redis)
+
+    def setup_new_user():
+        redis.delete('user:{}'.format(CHAT_ID))
+        redis.set('benchmark-hash', 'spotify-code')
+
+    flows = [
+        ('setup_confirm', old_setup_confirm, new_setup_confirm, setup_full_user),
+        ('delete_user', old_delete_user, new_delete_user, setup_full_user),
+        ('register_spotify_tokens', old_register_tokens, new_register_tokens, setup_new_user),
+        ('remove_all_survey_attributes', old_remove_attributes, new_remove_attributes, setup_full_user),
+    ]
+
+    try:
+        print('{:>30} | {:>20} | {:>20}'.format('flow (ms, mean / p99)', 'one command per call', 'batched'))
+        for name, old_function, new_function, setup in flows:
+            old_mean, old_p99 = measure(redis_acess, old_function, setup, args.iterations)
+            redis_acess.token_cache.invalidate(CHAT_ID)
+            new_mean, new_p99 = measure(redis_acess, new_function, setup, args.iterations)
+
+            print('{:>30} | {:>9.3f} / {:>8.3f} | {:>9.3f} / {:>8.3f}'.format(
+                name, old_mean * 1000, old_p99 * 1000, new_mean * 1000, new_p99 * 1000))
+    finally:
+        redis.flushdb()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""
+Local stand-in for the Spotify Web API, used by the benchmarks of this folder. It only implements what they need,
+answering with fixed data after an artificial latency (simulating the round trip to api.spotify.com). Playlists put on
+'server.playlists' keep their tracks, changed by the requests that add, remove or replace them
+"""
+
+import hashlib
+import json
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+
+    # Needed for keeping connections alive between requests
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, body, status=200, etag=False):
+        encoded_body = json.dumps(body).encode('utf-8')
+
+        # Like Spotify, GET responses have an ETag and conditional requests for unchanged resources get a 304 without body
+        if etag:
+            etag_value = '"{}"'.format(hashlib.md5(encoded_body).hexdigest())
+            if self.headers.get('If-None-Match') == etag_value:
+                self.send_response(304)
+                self.send_header('ETag', etag_value)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if etag:
+            self.send_header('ETag', etag_value)
+        self.send_header('Content-Length', str(len(encoded_body)))
+        self.end_headers()
+        self.wfile.write(encoded_body)
+
+    def _count_request(self):
+        with self.server.lock:
+            self.server.request_count += 1
+
+    def _stored_playlist(self, path, resource='tracks'):
+        """ ID of the playlist with stored tracks on 'path' (None if it's not one of them). 'resource' is what comes after the
+        playlist ID on the path ('tracks', or None for the playlist itself) """
+
+        parts = path.split('/')
+        if (len(parts) == (5 if resource else 4) and parts[2] == 'playlists' and parts[3] in self.server.playlists
+                and (resource is None or parts[4] == resource)):
+            return parts[3]
+        return None
+
+    def _snapshot_id(self, playlist_id):
+        """ Version of a playlist with stored tracks: changes whenever its tracks do """
+
+        with self.server.lock:
+            return hashlib.md5('\n'.join(self.server.playlists[playlist_id]).encode('utf-8')).hexdigest()
+
+    def _paging_object(self, path, query, items_generator, default_limit, total=None):
+        total = self.server.total_items if total is None else total
+        offset = int(query.get('offset', ['0'])[0])
+        limit = int(query.get('limit', [str(default_limit)])[0])
+
+        next_url = None
+        if offset + limit < total:
+            next_url = 'http://{}:{}{}?offset={}&limit={}'.format(*self.server.server_address, path, offset + limit, limit)
+
+        return {
+            'href': path,
+            'items': [items_generator(i) for i in range(offset, min(offset + limit, total))],
+            'limit': limit,
+            'offset': offset,
+            'total': total,
+            'next': next_url,
+            'previous': None
+        }
+
+    def do_GET(self):
+        self._count_request()
+        time.sleep(self.server.latency)
+
+        parsed_url = urlparse(self.path)
+        query = parse_qs(parsed_url.query)
+        path = parsed_url.path
+
+        if self._stored_playlist(path, None) is not None:
+            playlist_id = self._stored_playlist(path, None)
+            with self.server.lock:
+                uris = list(self.server.playlists[playlist_id])
+            # Like Spotify, the playlist comes with its first page of tracks (further pages are on the 'tracks' path)
+            body = {
+                'snapshot_id': self._snapshot_id(playlist_id),
+                'tracks': self._paging_object(path + '/tracks', {}, lambda i: {'track': {'uri': uris[i]}}, 100, len(uris))
+            }
+        elif self._stored_playlist(path) is not None:
+            with self.server.lock:
+                uris = list(self.server.playlists[self._stored_playlist(path)])
+            body = self._paging_object(path, query, lambda i: {'track': {'uri': uris[i]}}, 100, len(uris))
+        elif path.endswith('/tracks') and '/playlists/' in path:
+            body = self._paging_object(path, query, _playlist_track, 100)
+        elif path.startswith('/v1/me/top/'):
+            body = self._paging_object(path, query, _top_track if path.endswith('tracks') else _top_artist, 20)
+        elif path == '/v1/me/playlists':
+            body = self._paging_object(path, query, lambda i: {'id': 'playlist{}'.format(i), 'name': str(i)}, 20)
+        else:
+            body = {'error': {'status': 404, 'message': 'Not found'}}
+            return self._send_json(body, 404)
+
+        self._send_json(body, etag=True)
+
+    def _write_ok(self):
+        self._count_request()
+        time.sleep(self.server.latency)
+
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+
+        playlist_id = self._stored_playlist(urlparse(self.path).path)
+        if playlist_id is not None:
+            body = json.loads(body)
+            with self.server.lock:
+                uris = self.server.playlists[playlist_id]
+                if self.command == 'PUT':
+                    uris[:] = body['uris']
+                elif self.command == 'POST':
+                    uris.extend(body['uris'])
+                elif self.command == 'DELETE':
+                    removed = {track['uri'] for track in body['tracks']}
+                    uris[:] = [uri for uri in uris if uri not in removed]
+
+            return self._send_json({'snapshot_id': self._snapshot_id(playlist_id)}, 201 if self.command == 'POST' else 200)
+
+        self._send_json({'snapshot_id': 'stand-in-snapshot'}, 201 if self.command == 'POST' else 200)
+
+    do_POST = _write_ok
+    do_PUT = _write_ok
+    do_DELETE = _write_ok
+
+
+def _playlist_track(i):
+    return {
+        'added_at': '2020-12-01T00:00:00Z',
+        'track': {
+            'uri': 'spotify:track:{:022d}'.format(i),
+            'id': '{:022d}'.format(i),
+            'name': 'Track {}'.format(i),
+            'artists': [{'name': 'Artist {}'.format(i % 50), 'id': '{:022d}'.format(i % 50)}],
+            'external_urls': {'spotify': 'https://open.spotify.com/track/{:022d}'.format(i)},
+            'popularity': i % 100
+        }
+    }
+
+
+def _top_track(i):
+    return _playlist_track(i)['track']
+
+
+def _top_artist(i):
+    return {
+        'id': '{:022d}'.format(i),
+        'name': 'Artist {}'.format(i),
+        'genres': ['genre {}'.format(i % 7), 'genre {}'.format(i % 11)],
+        'external_urls': {'spotify': 'https://open.spotify.com/artist/{:022d}'.format(i)}
+    }
+
+
+def start_stand_in(latency=0.05, total_items=1000):
+    """
+    Start the stand-in server on a random local port (on a daemon thread)
+
+    Args:
+        latency (float): Seconds waited before answering each request
+        total_items (int): Total of items of every paginated endpoint
+
+    Returns:
+        Tuple (server, base URL). Call 'server.shutdown()' to stop it
+    """
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _StandInHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.total_items = total_items
+    server.playlists = {}
+    server.request_count = 0
+    server.lock = threading.Lock()
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, 'http://{}:{}/v1'.format(*server.server_address)
@@ -0,0 +1,57 @@
+"""
+Compares getting the top artists and the top tracks of an user one after the other (as the setup conversation used to do)
+against getting both at the same time (SpotifyEndpointAcess.get_user_top_items), on a local Spotify stand-in. The cache of
+top items is skipped, so every call reaches the stand-in.
+
+Run from the 'bot' folder: python -m benchmarks.top_items_benchmark [--latency 0.15] [--repeat 5]
+"""
+
+import argparse
+import time
+
+from backend_operations.spotify_endpoint_acess import SpotifyEndpointAcess
+from benchmarks.spotify_stand_in import start_stand_in
+
+
+def sequential(spotify_endpoint_acess):
+    artists = spotify_endpoint_acess.get_user_top_artists(None, 30, is_all_info=True)
+    tracks = spotify_endpoint_acess.get_user_top_tracks(None, 50, is_all_info=True)
+    return artists, tracks
+
+
+def combined(spotify_endpoint_acess):
+    artists, tracks, errors = spotify_endpoint_acess.get_user_top_items(None, 30, 50, is_all_info=True)
+    assert len(errors) == 0
+    return artists, tracks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--latency', type=float, default=0.15, help='Latency of each request, in seconds')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    server, base_url = start_stand_in(args.latency)
+
+    spotify_endpoint_acess = SpotifyEndpointAcess()
+    spotify_endpoint_acess.spotify_url_list = dict(spotify_endpoint_acess.spotify_url_list, topURL=base_url + '/me/top/{type}')
+    spotify_endpoint_acess._get_acess_token_valid = lambda chat_id: 'benchmark'
+    spotify_endpoint_acess.top_items_cache.get = lambda chat_id, type_entity, fetch, refresh=None: fetch()
+
+    print('{:.0f} ms per request'.format(args.latency * 1000))
+
+    for name, function in (('sequential', sequential), ('combined', combined)):
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            artists, tracks = function(spotify_endpoint_acess)
+            timings.append(time.perf_counter() - start)
+            assert len(artists) == 30 and len(tracks) == 50
+
+        print('{:>12}: best {:.3f} s'.format(name, min(timings)))
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,9 @@ from telegram.ext import (
 
 from backend_operations.redis_operations import RedisAcess
 from backend_operations.spotify_endpoint_acess import SpotifyEndpointAcess
+from backend_operations.deadline import with_deadline, TimedQueue
+from backend_operations.token_refresher import TokenRefresher
+from backend_operations.redis_persistence import RedisPersistence
 
 from bot_general_callbacks import BotGeneralCallbacks
 from bot_seed_callbacks import BotSeedCallbacks
@@ -69,6 +72,43 @@ def check_config_vars():
 
     return status
 
+def deadline_exceeded(update, context):
+    """ Called when handling an Update took longer than its deadline. The conversation (if any) stays on the same state """
+    if update is not None and update.effective_chat is not None:
+        context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="""Sorry, this operation took too long to complete. Please try again later"""
+        )
+
+def apply_deadlines(handler, deadline_config):
+    """
+    Wraps the callback of a handler (or the callbacks of all handlers of a ConversationHandler) so every Update is handled
+    under a deadline: all Spotify and Redis calls made while handling it share its time budget
+
+    Args:
+        handler (Handler): Telegram handler
+        deadline_config (dict): 'deadline' section of the configuration file
+
+    Returns:
+        The same handler
+    """
+
+    if isinstance(handler, ConversationHandler):
+        inner_handlers = handler.entry_points + handler.fallbacks
+        for state_handlers in handler.states.values():
+            inner_handlers += state_handlers
+
+        for inner_handler in inner_handlers:
+            apply_deadlines(inner_handler, deadline_config)
+
+        return handler
+
+    name = handler.callback.__name__
+    budget = (deadline_config.get('handlers') or {}).get(name, deadline_config.get('default', 20))
+    handler.callback = with_deadline(handler.callback, budget, name, on_exceeded=deadline_exceeded)
+
+    return handler
+
 def load_handlers(dispatcher):
     """ Load Telegram Bot Handlers """
     start_handler = CommandHandler('start', BOT_GENERAL_CALLBACKS.start, filters=~Filters.update.edited_message)
@@ -81,14 +121,14 @@ def load_handlers(dispatcher):
         states={
             SELECT_ARTISTS: [
                 CallbackQueryHandler(BOT_SEED_CALLBACKS.select_artists, pattern='^' + 'Start|Previous|Next|Tracks' + '$'),
-                MessageHandler(filters=Filters.text & Filters.regex('^\d{1,2} *(, *\d{1,2} *)*$'), callback=BOT_SEED_CALLBACKS.selected_artists), # Numbers separated by comma
+                MessageHandler(filters=Filters.text & Filters.regex('^\d{1,3} *(, *\d{1,3} *)*$'), callback=BOT_SEED_CALLBACKS.selected_artists), # Numbers separated by comma
                 MessageHandler(filters=Filters.text, callback=BOT_SEED_CALLBACKS.wrong_selection_input),
                 CallbackQueryHandler(BOT_SEED_CALLBACKS.ask_cancel, pattern='^' + 'Cancel' + '$'),
                 CallbackQueryHandler(BOT_SEED_CALLBACKS.setup_done, pattern='^' + 'Done' + '$')
             ],
             SELECT_TRACKS: [
                 CallbackQueryHandler(BOT_SEED_CALLBACKS.select_tracks, pattern='^' + 'Previous|Next|Artists' + '$'),
-                MessageHandler(filters=Filters.text & Filters.regex('^\d{1,2} *(, *\d{1,2} *)*$'), callback=BOT_SEED_CALLBACKS.selected_tracks), # Numbers separated by comma]
+                MessageHandler(filters=Filters.text & Filters.regex('^\d{1,3} *(, *\d{1,3} *)*$'), callback=BOT_SEED_CALLBACKS.selected_tracks), # Numbers separated by comma]
                 MessageHandler(filters=Filters.text, callback=BOT_SEED_CALLBACKS.wrong_selection_input),
                 CallbackQueryHandler(BOT_SEED_CALLBACKS.ask_cancel, pattern='^' + 'Cancel' + '$'),
                 CallbackQueryHandler(BOT_SEED_CALLBACKS.setup_done, pattern='^' + 'Done' + '$')
@@ -101,7 +141,9 @@ def load_handlers(dispatcher):
                 CallbackQueryHandler(BOT_SEED_CALLBACKS.setup_confirm)
             ]
         },
-        fallbacks=[CallbackQueryHandler(BOT_SEED_CALLBACKS.stop_setup)]
+        fallbacks=[CallbackQueryHandler(BOT_SEED_CALLBACKS.stop_setup)],
+        name='setup_seed',
+        persistent=True
     )
 
     #start_survey_handler = CommandHandler('setup_attributes', BOT_SURVEY_CALLBACKS.start_survey, filters=~Filters.update.edited_message)
@@ -117,7 +159,9 @@ def load_handlers(dispatcher):
                 MessageHandler(filters=Filters.text, callback=BOT_SURVEY_CALLBACKS.wrong_selection_input),
             ]
         },
-        fallbacks=[CommandHandler('cancel', BOT_SURVEY_CALLBACKS.cancel, filters=~Filters.update.edited_message)]
+        fallbacks=[CommandHandler('cancel', BOT_SURVEY_CALLBACKS.cancel, filters=~Filters.update.edited_message)],
+        name='setup_attributes',
+        persistent=True
     )
 
     get_setup_handler = CommandHandler('get_setup', BOT_GENERAL_CALLBACKS.get_setup, filters=~Filters.update.edited_message)
@@ -130,7 +174,9 @@ def load_handlers(dispatcher):
                 CallbackQueryHandler(BOT_PLAYLIST_CALLBACKS.end, pattern='^' + 'No' + '$')
             ]
         },
-        fallbacks=[CallbackQueryHandler(BOT_PLAYLIST_CALLBACKS.end)]
+        fallbacks=[CallbackQueryHandler(BOT_PLAYLIST_CALLBACKS.end)],
+        name='generate_playlist',
+        persistent=True
     )
 
     logout_handler = ConversationHandler (
@@ -142,11 +188,21 @@ def load_handlers(dispatcher):
                 CallbackQueryHandler(BOT_LOGOUT_CALLBACKS.delete_user, pattern='^' + 'No' + '$')
             ]
         },
-        fallbacks=[CallbackQueryHandler(BOT_LOGOUT_CALLBACKS.stop_logout)]
+        fallbacks=[CallbackQueryHandler(BOT_LOGOUT_CALLBACKS.stop_logout)],
+        name='logout',
+        persistent=True
     )
 
     unknown_command_handler = MessageHandler(Filters.text, BOT_GENERAL_CALLBACKS.unknown_command)
 
+    deadline_config = yaml.safe_load(open('config.yaml')).get('deadline') or {}
+    for handler in [start_handler, login_handler, help_handler, setup_handler, survey_handler, get_setup_handler,
+                    generate_playlist_handler, logout_handler, unknown_command_handler]:
+        apply_deadlines(handler, deadline_config)
+
+    # Conversation states and chat_data of the chat of each Update are loaded from Redis before any other handler runs
+    dispatcher.add_handler(dispatcher.persistence.get_load_handler(), group=-1)
+
     dispatcher.add_handler(start_handler)
     dispatcher.add_handler(login_handler)
     dispatcher.add_handler(help_handler)
@@ -157,6 +213,9 @@ def load_handlers(dispatcher):
     dispatcher.add_handler(generate_playlist_handler)
     dispatcher.add_handler(logout_handler)
 
+    for handler in [setup_handler, survey_handler, generate_playlist_handler, logout_handler]:
+        dispatcher.persistence.register_conversation_handler(handler)
+
     # MUST BE PLACE LAST
     dispatcher.add_handler(unknown_command_handler)
 
@@ -168,11 +227,38 @@ def start_bot():
     telegram_webhook_url = yaml.safe_load(open('config.yaml'))['telegram']['webhookURL']
     telegram_bot_token = os.environ.get('TELEGRAM_TOKEN')
 
+    # Conversation states and chat_data are kept on Redis, written in batches
+    persistence_config = yaml.safe_load(open('config.yaml')).get('persistence') or {}
+    persistence = RedisPersistence(
+        REDIS_INSTANCE,
+        flush_interval=persistence_config.get('flushInterval', 5),
+        ttl=persistence_config.get('ttl', 604800),
+        compress_above=persistence_config.get('compressAbove', 512)
+    )
+
     # Prepare bot and its functions
-    updater = Updater(token=telegram_bot_token)
+    updater = Updater(token=telegram_bot_token, persistence=persistence)
     dispatcher = updater.dispatcher
+
+    # Deadlines of handlers start when the Update is received (before waiting for the dispatcher and loading its chat), not
+    # when the handler is called. The webhook puts Updates on the queue given to it on 'start_webhook'
+    updater.update_queue = dispatcher.update_queue = TimedQueue()
     load_handlers(dispatcher)
 
+    # Keep acess tokens of active users valid in background
+    refresher_config = (yaml.safe_load(open('config.yaml')).get('tokenRefresh') or {}).get('background') or {}
+    token_refresher = TokenRefresher(
+        REDIS_INSTANCE,
+        refresh_ahead=refresher_config.get('refreshAhead', 300),
+        active_window=refresher_config.get('activeWindow', 86400),
+        batch_size=refresher_config.get('batchSize', 50),
+        max_concurrent=refresher_config.get('maxConcurrent', 4)
+    )
+    updater.job_queue.run_repeating(token_refresher.refresh, interval=refresher_config.get('interval', 60), first=10)
+
+    if persistence.flush_interval > 0:
+        updater.job_queue.run_repeating(persistence.write_pending, interval=persistence.flush_interval)
+
     # Start Webhook and set it to a domain (https://[domain]/[token])
     updater.start_webhook(listen='0.0.0.0', port=5001, url_path=telegram_bot_token)
     updater.bot.setWebhook(telegram_webhook_url + telegram_bot_token) # ! If bot not communication with Telegram, try commenting here!
@@ -69,8 +69,9 @@ class BotPlaylistCallbacks:
             update.callback_query.message.reply_text(message)
             return ConversationHandler.END
 
-        self.spotify_endpoint_acess.delete_all_tracks(update.effective_chat.id)
-        self.spotify_endpoint_acess.add_tracks(update.effective_chat.id, recommended_tracks)
+        sync_result = self.spotify_endpoint_acess.sync_playlist_tracks(update.effective_chat.id, recommended_tracks)
+        LOGGER.info('Playlist of user %s regenerated with %d Spotify API calls (%d reads, %d writes)', update.effective_chat.id,
+                    sync_result['calls'], sync_result['reads'], sync_result['writes'])
 
         update.callback_query.message.reply_text(""" Playlist generated sucessfuly """)
 
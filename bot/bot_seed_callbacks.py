@@ -1,6 +1,10 @@
 
+import contextvars
 import logging
 import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from emoji import emojize
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
@@ -8,6 +12,7 @@ from telegram.ext import CallbackContext, ConversationHandler
 from telegram.utils.helpers import escape_markdown
 from telegram.error import BadRequest as telegramBadRequest
 
+from backend_operations.deadline import remaining_time
 from backend_operations.redis_operations import RedisAcess
 from backend_operations.spotify_endpoint_acess import SpotifyEndpointAcess
 
@@ -20,6 +25,11 @@ GENERATE_PLAYLIST = 7
 
 class BotSeedCallbacks:
 
+    # Candidates (top artists and tracks) fetched on each request to Spotify: the most it returns at once
+    CANDIDATES_FETCH_SIZE = 50
+    # Seconds after which a prefetch not used (like of an abandoned setup) is dropped
+    PREFETCH_TTL = 300
+
     def __init__(self, redis_instace=None, spotify_acess_point=None):
         if redis_instace is not None:
             self.redis_instance = redis_instace
@@ -31,6 +41,11 @@ class BotSeedCallbacks:
         else:
             self.spotify_endpoint_acess = SpotifyEndpointAcess(self.redis_instance)
 
+        # Next candidates of each chat being selected, fetched in background before they are shown
+        self._prefetch_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='seed-candidates-prefetch')
+        self._prefetches = {} # (chat ID, item type) -> (offset, future, time it was started)
+        self._prefetches_lock = threading.Lock() # Updates of different chats are handled on different worker threads
+
     # ========================================= SETUP CONVERSATION ============================================ #
 
     def setup (self, update: Update, context: CallbackContext):
@@ -57,19 +72,32 @@ class BotSeedCallbacks:
         # Set how many entries are goind to be shown at a given time
         context.chat_data['page_lenght'] = 10
 
-        context.chat_data['total_artists'] = 30
-        context.chat_data['total_tracks'] = 50
-
         context.chat_data['current_message_id'] = None
 
         context.chat_data['artists_list_page'], context.chat_data['tracks_list_page'] = 0, 0
         context.chat_data['selected_artists_index'], context.chat_data['selected_tracks_index'] = set(), set()
 
-        context.chat_data['artists_list'] = self.spotify_endpoint_acess.get_user_top_artists(
-            update.effective_chat.id, amount=context.chat_data['total_artists'], is_all_info=True)
+        # Only the first candidates are loaded now: the others are loaded as the user goes through pages. If the top items
+        # of the user are cached, all of them (50) are kept, since they cost no request; if not, only the first page is
+        # fetched (and cached)
+        artists_list, tracks_list, errors = self.spotify_endpoint_acess.get_user_top_items(
+            update.effective_chat.id, artists_amount=self.CANDIDATES_FETCH_SIZE,
+            tracks_amount=self.CANDIDATES_FETCH_SIZE, is_all_info=True,
+            miss_amount=context.chat_data['page_lenght'])
 
-        context.chat_data['tracks_list'] = self.spotify_endpoint_acess.get_user_top_tracks(
-            update.effective_chat.id, amount=context.chat_data['total_tracks'], is_all_info=True)
+        context.chat_data['artists_list'] = artists_list or []
+        context.chat_data['tracks_list'] = tracks_list or []
+
+        # Whether there are more candidates is only known when loading the next ones (see '_load_candidates')
+        context.chat_data['artists_list_complete'] = len(context.chat_data['artists_list']) == 0
+        context.chat_data['tracks_list_complete'] = len(context.chat_data['tracks_list']) == 0
+        self._drop_prefetches(update.effective_chat.id)
+
+        # Only one of them failed: the other can still be selected
+        if len(errors) > 0:
+            failed = next(iter(errors))
+            update.message.reply_text("Could not load your top {} right now. You can still select {}".format(
+                failed, 'tracks' if failed == 'artists' else 'artists'))
 
         return SELECT_ARTISTS
 
@@ -94,6 +122,15 @@ class BotSeedCallbacks:
             button_pressed = update.callback_query.data
             if button_pressed == 'Next':
                 context.chat_data[item_type + '_list_page'] += 1
+                try:
+                    self._load_candidates(update.effective_chat.id, context, item_type)
+                except Exception:
+                    context.chat_data[item_type + '_list_page'] -= 1
+                    raise
+
+                # There were no more candidates to load: stay on the last page
+                if context.chat_data[item_type + '_list_page'] * context.chat_data['page_lenght'] >= len(context.chat_data[item_type + '_list']):
+                    context.chat_data[item_type + '_list_page'] -= 1
             elif button_pressed == 'Previous':
                 context.chat_data[item_type + '_list_page'] -= 1
 
@@ -118,7 +155,7 @@ class BotSeedCallbacks:
 
         current_page = context.chat_data[item_type + '_list_page']
         page_lenght = context.chat_data['page_lenght']
-        total_items = context.chat_data['total_' + item_type]
+        total_items = len(context.chat_data[item_type + '_list'])
 
         # Artists on this page
         page_range = (page_lenght * current_page, min((page_lenght * (current_page + 1) - 1), total_items - 1))
@@ -129,8 +166,9 @@ class BotSeedCallbacks:
         buttons_list = []
         if context.chat_data[item_type + '_list_page'] > 0:
             buttons_list.append(InlineKeyboardButton(text='Previous', callback_data='Previous'))
-        # TODO: CHECK IF THIS BREAKS ANYTHING
-        if context.chat_data[item_type + '_list_page'] < math.ceil(len(context.chat_data[item_type + '_list']) / context.chat_data['page_lenght']) - 1:
+        # There is a next page if it's loaded, or if there are more candidates to load
+        if (context.chat_data[item_type + '_list_page'] < math.ceil(len(context.chat_data[item_type + '_list']) / context.chat_data['page_lenght']) - 1
+            or not context.chat_data[item_type + '_list_complete']):
             buttons_list.append(InlineKeyboardButton(text='Next', callback_data='Next'))
 
         selection_option = ''
@@ -164,6 +202,8 @@ class BotSeedCallbacks:
         else:
             update.callback_query.edit_message_text(text=page_text, reply_markup=keyboard, parse_mode='MarkdownV2', disable_web_page_preview=True)
 
+        self._prefetch_candidates(update.effective_chat.id, context, item_type)
+
         if item_type == 'artists':
             return SELECT_ARTISTS
         elif item_type == 'tracks':
@@ -171,6 +211,68 @@ class BotSeedCallbacks:
 
         return END_STATE
 
+    def _load_candidates(self, chat_id, context: CallbackContext, item_type: str):
+        """ Load candidates of 'item_type' (from the prefetched ones, or from Spotify) until the current page is filled, or
+        there are no more of them """
+
+        items = context.chat_data[item_type + '_list']
+        page_end = (context.chat_data[item_type + '_list_page'] + 1) * context.chat_data['page_lenght']
+
+        while len(items) < page_end and not context.chat_data[item_type + '_list_complete']:
+            new_items, total = None, None
+
+            with self._prefetches_lock:
+                offset, prefetch, _ = self._prefetches.pop((chat_id, item_type), (None, None, None))
+            if prefetch is not None and offset == len(items):
+                # Not waiting for the prefetch longer than what is left of the Update: fetching them directly instead
+                try:
+                    new_items, total = prefetch.result(timeout=remaining_time())
+                except Exception:
+                    LOGGER.exception('Could not prefetch top %s of user %s', item_type, chat_id)
+                    prefetch.cancel()
+                    new_items, total = None, None
+
+            if new_items is None:
+                new_items, total = self.spotify_endpoint_acess.get_user_top_items_page(chat_id, item_type, len(items))
+
+            items.extend(new_items)
+            context.chat_data[item_type + '_list_complete'] = len(new_items) == 0 or len(items) >= total
+
+    def _prefetch_candidates(self, chat_id, context: CallbackContext, item_type: str):
+        """ Start fetching the next candidates of 'item_type' in background, if the page after the current one is not loaded """
+
+        items = context.chat_data[item_type + '_list']
+        next_page_end = (context.chat_data[item_type + '_list_page'] + 2) * context.chat_data['page_lenght']
+
+        if len(items) >= next_page_end or context.chat_data[item_type + '_list_complete']:
+            return
+
+        with self._prefetches_lock:
+            self._drop_expired_prefetches()
+
+            offset, _, _ = self._prefetches.get((chat_id, item_type), (None, None, None))
+            if offset != len(items):
+                # Running it in a copy of the context, so the prefetch keeps the deadline of the Update that started it
+                self._prefetches[(chat_id, item_type)] = (len(items), self._prefetch_executor.submit(
+                    contextvars.copy_context().run, self.spotify_endpoint_acess.get_user_top_items_page,
+                    chat_id, item_type, len(items)), time.monotonic())
+
+    def _drop_prefetches(self, chat_id):
+        for item_type in ('artists', 'tracks'):
+            with self._prefetches_lock:
+                prefetch = self._prefetches.pop((chat_id, item_type), None)
+            if prefetch is not None:
+                prefetch[1].cancel()
+
+    def _drop_expired_prefetches(self):
+        """ Drop prefetches never used (their setup was abandoned, or timed out). Called holding _prefetches_lock """
+
+        now = time.monotonic()
+        for key, (_, prefetch, started_at) in list(self._prefetches.items()):
+            if now - started_at > self.PREFETCH_TTL:
+                prefetch.cancel()
+                self._prefetches.pop(key, None)
+
     def _assemble_message(self, context: CallbackContext, page_items, page_items_rank, item_type: str):
         # Setting up message to be shown
         page_text = """__Select up to {n} {item_type}__\n\n""".format(n = context.chat_data['max_num_items'], item_type = item_type)
@@ -241,7 +343,7 @@ class BotSeedCallbacks:
             is_ok = False
 
         for rank in selected_ranks:
-            if rank < 1 or rank > context.chat_data['total_' + item_type]:
+            if rank < 1 or rank > len(context.chat_data[item_type + '_list']):
                 update.message.reply_text("""Item of type '{item_type}' of rank {rank} does not exist". Try again without it""".format(
                     item_type = item_type, rank = rank))
                 is_ok = False
@@ -278,15 +380,17 @@ class BotSeedCallbacks:
 
         return self.select_artists(update, context)
 
-    def _delete_setup_context_variables(self, context: CallbackContext):
+    def _delete_setup_context_variables(self, context: CallbackContext, chat_id):
         context_variables_created = [
-            'page_lenght', 'max_num_items', 'total_artists', 'total_tracks', 'current_message_id',
+            'page_lenght', 'max_num_items', 'current_message_id',
             'artists_list_page', 'tracks_list_page', 'selected_artists_index', 'selected_tracks_index',
-            'artists_list', 'tracks_list'
+            'artists_list', 'tracks_list', 'artists_list_complete', 'tracks_list_complete'
         ]
 
         for var_name in context_variables_created:
-            del context.chat_data[var_name]
+            context.chat_data.pop(var_name, None)
+
+        self._drop_prefetches(chat_id)
 
     def ask_cancel(self, update: Update, context: CallbackContext):
         update.callback_query.answer()
@@ -302,7 +406,7 @@ class BotSeedCallbacks:
         update.callback_query.answer()
         context.bot.edit_message_reply_markup(chat_id=update.callback_query.message.chat_id, message_id=update.callback_query.message.message_id)
 
-        self._delete_setup_context_variables(context)
+        self._delete_setup_context_variables(context, update.callback_query.message.chat_id)
         update.callback_query.message.reply_text(""" Seed selection process was canceled!""")
         return ConversationHandler.END
 
@@ -344,14 +448,10 @@ class BotSeedCallbacks:
 
         if update.callback_query.data == 'Yes':
 
-            # Remove old configuration and put new on DB
-            self.redis_instance.remove_user_artists(update.callback_query.message.chat_id)
-            self.redis_instance.remove_user_tracks(update.callback_query.message.chat_id)
-
-            self.redis_instance.register_user_artists(update.callback_query.message.chat_id, selected_artists)
-            self.redis_instance.register_user_tracks(update.callback_query.message.chat_id, selected_tracks)
+            # Replace old configuration by the new one on DB
+            self.redis_instance.register_user_seeds(update.callback_query.message.chat_id, selected_artists, selected_tracks)
 
-        self._delete_setup_context_variables(context)
+        self._delete_setup_context_variables(context, update.callback_query.message.chat_id)
 
         if update.callback_query.data == 'Yes':
             update.callback_query.message.reply_text(""" Seeds were sucessfuly registered to your user!""")
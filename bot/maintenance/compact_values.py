@@ -0,0 +1,147 @@
+"""
+Migration of the seeds ('user:[id]:seeds', or fields 's:*' of 'u:[id]' on the compact key layout) and survey attributes
+('user:[id]:attributes', or fields 'a:*' of 'u:[id]') stored as JSON text to the compact format of
+backend_operations/value_codec.py. Values already migrated are left as they are, so it can be run again (or stopped and
+resumed) at any time, while the bot is running.
+
+Runs on every shard of 'redis.shards' (or the configured Redis server), converting keys as SCAN finds them. Reports the
+memory used by these keys (Redis' MEMORY USAGE) per user, before and after. Run from the 'bot' folder:
+python -m maintenance.compact_values [--batch 100] [--dry-run]
+"""
+
+import argparse
+
+from redis import ResponseError
+
+from backend_operations import value_codec
+from backend_operations.sharding import get_user_shards
+
+
+def memory_usage(redis, keys):
+    """ Bytes used by 'keys' (as estimated by Redis) """
+
+    pipeline = redis.pipeline(transaction=False)
+    for key in keys:
+        pipeline.memory_usage(key, samples=0)
+    return sum(usage or 0 for usage in pipeline.execute())
+
+
+def field_kind(key, field):
+    """ What a field of a hash stores: ('seeds', 'artists' or 'tracks'), ('attribute', None) or None (something else) """
+
+    field = field.decode('utf-8')
+
+    if key.startswith(b'u:'):
+        if field.startswith('s:'):
+            return 'seeds', field[2:]
+        if field.startswith('a:'):
+            return 'attribute', None
+        return None
+
+    if key.endswith(b':seeds'):
+        return 'seeds', field
+    return 'attribute', None
+
+
+def migrate_hash(redis, key, dry_run):
+    """ Re-encode the seeds and attributes fields of a hash still stored as JSON text
+
+    Returns:
+        Number of fields (re-)encoded
+    """
+
+    values = redis.hgetall(key)
+
+    new_values = {}
+    for field, raw in values.items():
+        kind = field_kind(key, field)
+        if kind is None or value_codec.is_compact(raw):
+            continue
+
+        try:
+            if kind[0] == 'seeds':
+                new_values[field] = value_codec.encode_seeds(value_codec.decode_seeds(raw, kind[1]), kind[1])
+            else:
+                new_values[field] = value_codec.encode(value_codec.decode(raw))
+        except (value_codec.CodecException, KeyError) as e:
+            print('Skipping field {} of {}: {}'.format(field, key, e))
+
+    if len(new_values) == 0 or dry_run:
+        return len(new_values)
+
+    # Only fields that were not changed since they were read are replaced
+    with redis.pipeline(transaction=True) as pipeline:
+        try:
+            pipeline.watch(key)
+            if pipeline.hmget(key, *new_values.keys()) != [values[field] for field in new_values]:
+                return 0
+            pipeline.multi()
+            pipeline.hset(key, mapping=new_values)
+            pipeline.execute()
+        except Exception as e:
+            print('Skipping {}: {}'.format(key, e))
+            return 0
+
+    return len(new_values)
+
+
+def scan_batches(redis, batch):
+    """ Keys of seeds and attributes of a Redis server, in lists of up to 'batch' keys (as SCAN finds them) """
+
+    keys = []
+    for pattern in ('user:*:seeds', 'user:*:attributes', 'u:*'):
+        for key in redis.scan_iter(match=pattern, count=batch):
+            keys.append(key)
+            if len(keys) == batch:
+                yield keys
+                keys = []
+    if len(keys) > 0:
+        yield keys
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch', type=int, default=100, help='Keys fetched on each SCAN, and converted together')
+    parser.add_argument('--dry-run', action='store_true', help='Only count what would be migrated')
+    args = parser.parse_args()
+
+    if value_codec.msgpack is None:
+        parser.error('msgpack is not installed: values would be stored as JSON again')
+
+    users, keys, migrated_fields = set(), 0, 0
+    # MEMORY USAGE may be disabled (as on some managed Redis services): None if so
+    memory_before, memory_after = 0, 0
+
+    for name, redis in get_user_shards().nodes.items():
+        for batch in scan_batches(redis, args.batch):
+            users.update((name, key.split(b':')[1]) for key in batch)
+            keys += len(batch)
+
+            if memory_before is not None:
+                try:
+                    memory_before += memory_usage(redis, batch)
+                except ResponseError:
+                    memory_before = None
+
+            for key in batch:
+                migrated_fields += migrate_hash(redis, key, args.dry_run)
+
+            if memory_before is not None and not args.dry_run:
+                memory_after += memory_usage(redis, batch)
+
+    if len(users) == 0:
+        print('Nothing to migrate')
+        return
+
+    print('{} users, {} keys, {} fields {}'.format(len(users), keys, migrated_fields,
+                                                   'to migrate' if args.dry_run else 'migrated'))
+
+    if memory_before is not None and not args.dry_run:
+        print('Memory per user: {:.0f} bytes before, {:.0f} bytes after ({:.1f}% less)'.format(
+            memory_before / len(users), memory_after / len(users), 100 * (1 - memory_after / memory_before)))
+    elif memory_before is not None:
+        print('Memory per user: {:.0f} bytes'.format(memory_before / len(users)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Migration of the data of every user from the legacy key layout (four keys per user) to the compact one (a single hash,
+'u:[id]'), as described in backend_operations/user_layout.py. Steps, with the bot running all along:
+
+1. Set 'redis.keyLayout' to 'dual' on 'config.yaml' and restart every bot replica (new writes go to both layouts)
+2. Run this command: users are copied to the compact layout (fields already there, written by the bot, are kept)
+3. Set 'redis.keyLayout' to 'compact' and restart every bot replica
+4. Run this command again with '--delete-legacy' to copy what was left and remove the legacy keys
+
+Runs on every shard of 'redis.shards' (or the configured Redis server). Run from the 'bot' folder:
+python -m maintenance.migrate_layout [--batch 100] [--delete-legacy] [--dry-run]
+"""
+
+import argparse
+
+from backend_operations.sharding import get_user_shards
+from backend_operations.user_layout import USER, SEEDS, ATTRIBUTES, legacy_key, compact_key, compact_field
+
+
+def find_users(redis, batch):
+    """ Chat IDs of all users with some data on the legacy layout """
+
+    users = set()
+    for key in redis.scan_iter(match='user:*', count=batch):
+        parts = key.decode('utf-8').split(':')
+        if len(parts) == 2 or parts[2] in (SEEDS, ATTRIBUTES, 'acess_token'):
+            users.add(parts[1])
+    return users
+
+
+def migrate_users(redis, chat_ids, delete_legacy, dry_run):
+    """ Copy the data of some users to the compact layout (in two round trips)
+
+    Returns:
+        Number of fields copied (or to be copied, on a dry run)
+    """
+
+    pipeline = redis.pipeline(transaction=False)
+    for chat_id in chat_ids:
+        for section in (USER, SEEDS, ATTRIBUTES):
+            pipeline.hgetall(legacy_key(chat_id, section))
+        pipeline.get(legacy_key(chat_id, 'acess_token'))
+        pipeline.ttl(legacy_key(chat_id, 'acess_token'))
+        pipeline.hexists(compact_key(chat_id), 't')
+    results = iter(pipeline.execute())
+
+    copied = 0
+    pipeline = redis.pipeline(transaction=False)
+    for chat_id in chat_ids:
+        key = compact_key(chat_id)
+
+        for section in (USER, SEEDS, ATTRIBUTES):
+            for field, value in next(results).items():
+                pipeline.hsetnx(key, compact_field(section, field.decode('utf-8')), value)
+                copied += 1
+
+        acess_token, expires_in, has_token = next(results), next(results), next(results)
+        if acess_token is not None and expires_in > 0 and not has_token:
+            pipeline.hset(key, mapping={'t': acess_token, 'te': int(redis.time()[0]) + expires_in})
+            copied += 1
+
+        if delete_legacy:
+            pipeline.unlink(*[legacy_key(chat_id, section) for section in (USER, SEEDS, ATTRIBUTES, 'acess_token')])
+
+    if not dry_run:
+        pipeline.execute()
+    return copied
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch', type=int, default=100, help='Users migrated on each round')
+    parser.add_argument('--delete-legacy', action='store_true',
+                        help='Remove the legacy keys after copying them. Only when every replica uses the compact layout')
+    parser.add_argument('--dry-run', action='store_true', help='Only count what would be migrated')
+    args = parser.parse_args()
+
+    users, copied = 0, 0
+    for redis in get_user_shards().get_nodes():
+        shard_users = sorted(find_users(redis, args.batch))
+        users += len(shard_users)
+        for start in range(0, len(shard_users), args.batch):
+            copied += migrate_users(redis, shard_users[start:start + args.batch], args.delete_legacy, args.dry_run)
+
+    if args.dry_run:
+        print('{} users, {} fields to copy'.format(users, copied))
+    else:
+        print('{} users migrated ({} fields copied{})'.format(users, copied, ', legacy keys removed' if args.delete_legacy else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+Moves the data of each user to the Redis shard it belongs to, after shards were added to (or removed from) 'redis.shards' on
+'config.yaml' (see backend_operations/sharding.py). Only the users whose shard changed are moved (about 1/N of them when a
+shard is added to N - 1 others). Keys are moved with MIGRATE (all keys of an user at once, keeping their TTLs), along with the
+entries of the user on the token sorted sets.
+
+Users being moved are not found by the bot until they reach their new shard, so stop the bot, update 'config.yaml' (keeping
+the removed shards listed with '--previous'), run this command and start the bot again. Shards must reach each other with the
+hosts on 'config.yaml'. Run from the 'bot' folder:
+python -m maintenance.rebalance_shards [--previous name:host:port ...] [--batch 100] [--dry-run]
+"""
+
+import argparse
+import collections
+import os
+
+import yaml
+from redis import Redis, ResponseError
+
+from backend_operations.redis_operations import TOKEN_EXPIRY_KEY, USER_ACTIVITY_KEY
+from backend_operations.sharding import ConsistentHashRing
+
+
+def load_shards(previous):
+    """ Shards of 'config.yaml', and the ones only listed on 'previous'
+
+    Returns:
+        Tuple (ring of the configured shards, dict of name -> endpoint of all shards)
+    """
+
+    with open('config.yaml', 'r') as f:
+        redis_config = yaml.safe_load(f).get('redis') or {}
+
+    endpoints = {shard['name']: {'host': shard['host'], 'port': shard.get('port', 6379), 'db': shard.get('db', 0)}
+                 for shard in redis_config.get('shards') or []}
+    if len(endpoints) == 0:
+        raise ValueError("No shards on 'redis.shards' of config.yaml")
+
+    ring = ConsistentHashRing(endpoints, redis_config.get('shardReplicas', 160))
+
+    for shard in previous:
+        name, host, port = shard.split(':')
+        endpoints.setdefault(name, {'host': host, 'port': int(port), 'db': 0})
+
+    return ring, endpoints
+
+
+def find_misplaced_users(redis, name, ring, batch):
+    """ Keys of the users stored on shard 'name' that belong to other shards
+
+    Returns:
+        Dict of destination shard name -> dict of chat ID -> list of keys
+    """
+
+    misplaced = collections.defaultdict(lambda: collections.defaultdict(list))
+    for pattern in ('user:*', 'u:*'):
+        for key in redis.scan_iter(match=pattern, count=batch):
+            chat_id = key.decode('utf-8').split(':')[1]
+            destination = ring.get_name(chat_id)
+            if destination != name:
+                misplaced[destination][chat_id].append(key)
+    return misplaced
+
+
+def move_token_entries(redis, name, ring, destinations, dry_run):
+    """ Move the entries of the token sorted sets of users that belong to other shards
+
+    Returns:
+        Number of entries moved
+    """
+
+    moved = 0
+    for sorted_set in (TOKEN_EXPIRY_KEY, USER_ACTIVITY_KEY):
+        entries = collections.defaultdict(dict)
+        for member, score in redis.zscan_iter(sorted_set):
+            destination = ring.get_name(member.decode('utf-8'))
+            if destination != name:
+                entries[destination][member] = score
+
+        for destination, members in entries.items():
+            moved += len(members)
+            if not dry_run:
+                # Greater scores win: the destination may already have newer entries
+                destinations[destination].zadd(sorted_set, members, gt=True)
+                redis.zrem(sorted_set, *members.keys())
+
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--previous', nargs='*', default=[], help="Shards removed from config.yaml, as 'name:host:port'")
+    parser.add_argument('--batch', type=int, default=100, help='Keys fetched on each SCAN')
+    parser.add_argument('--timeout', type=int, default=5000, help='Milliseconds for each MIGRATE')
+    parser.add_argument('--dry-run', action='store_true', help='Only count what would be moved')
+    args = parser.parse_args()
+
+    ring, endpoints = load_shards(args.previous)
+    password = os.environ.get('REDIS_PASSWORD') or None
+    clients = {name: Redis(password=password, **endpoint) for name, endpoint in endpoints.items()}
+
+    for name, redis in clients.items():
+        misplaced = find_misplaced_users(redis, name, ring, args.batch)
+
+        for destination, users in misplaced.items():
+            endpoint = endpoints[destination]
+            failed = 0
+            if not args.dry_run:
+                for chat_id, keys in users.items():
+                    try:
+                        redis.migrate(endpoint['host'], endpoint['port'], keys, endpoint['db'], args.timeout, auth=password)
+                    except ResponseError as e: # As BUSYKEY: the user already has data on the destination
+                        print('Could not move user {} to {}: {}'.format(chat_id, destination, e))
+                        failed += 1
+
+            print('{}: {} users {} to {}{}'.format(name, len(users) - failed, 'to move' if args.dry_run else 'moved', destination,
+                                                   ' ({} failed)'.format(failed) if failed > 0 else ''))
+
+        moved_entries = move_token_entries(redis, name, ring, clients, args.dry_run)
+        if moved_entries > 0:
+            print('{}: {} token entries {}'.format(name, moved_entries, 'to move' if args.dry_run else 'moved'))
+
+
+if __name__ == '__main__':
+    main()
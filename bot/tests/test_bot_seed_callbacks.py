@@ -0,0 +1,62 @@
+import threading
+import unittest
+from types import SimpleNamespace
+
+from backend_operations.deadline import deadline_scope, remaining_time
+from bot_seed_callbacks import BotSeedCallbacks
+
+
+class _SpotifyEndpointAcess:
+    """ Top items pages of 50 candidates, counting the calls made to Spotify """
+
+    def __init__(self, total):
+        self.total = total
+        self.calls = []
+        self.deadlines = []
+        self.called = threading.Event()
+
+    def get_user_top_items_page(self, chat_id, type_entity, offset):
+        self.calls.append(offset)
+        self.deadlines.append(remaining_time(None))
+        self.called.set()
+        items = [{'id': str(i)} for i in range(offset, min(offset + 50, self.total))]
+        return items, self.total
+
+
+class PrefetchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spotify_endpoint_acess = _SpotifyEndpointAcess(total=120)
+        self.callbacks = BotSeedCallbacks(SimpleNamespace(), self.spotify_endpoint_acess)
+        # First page (of 50) already shown, as 'setup' leaves it
+        self.context = SimpleNamespace(chat_data={
+            'page_lenght': 50, 'artists_list': [{'id': str(i)} for i in range(50)], 'artists_list_page': 0,
+            'artists_list_complete': False})
+
+    def tearDown(self):
+        self.callbacks._prefetch_executor.shutdown(wait=True)
+
+    def test_next_page_is_served_from_the_prefetch(self):
+        with deadline_scope(10, 'test'):
+            self.callbacks._prefetch_candidates(1, self.context, 'artists')
+        self.assertTrue(self.spotify_endpoint_acess.called.wait(5))
+
+        self.context.chat_data['artists_list_page'] = 1
+        self.callbacks._load_candidates(1, self.context, 'artists')
+
+        self.assertEqual(self.spotify_endpoint_acess.calls, [50])
+        self.assertEqual(len(self.context.chat_data['artists_list']), 100)
+        # The prefetch ran with the deadline of the Update that started it
+        self.assertIsNotNone(self.spotify_endpoint_acess.deadlines[0])
+
+    def test_prefetch_is_started_once_per_page(self):
+        with deadline_scope(10, 'test'):
+            self.callbacks._prefetch_candidates(1, self.context, 'artists')
+            self.callbacks._prefetch_candidates(1, self.context, 'artists')
+        self.callbacks._prefetch_executor.shutdown(wait=True)
+
+        self.assertEqual(self.spotify_endpoint_acess.calls, [50])
+
+
+if __name__ == '__main__':
+    unittest.main()
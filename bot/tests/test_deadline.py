@@ -0,0 +1,47 @@
+import threading
+import time
+import unittest
+
+from backend_operations.deadline import TimedQueue, check_deadline, remaining_time, with_deadline
+
+
+class DeadlineStartTest(unittest.TestCase):
+
+    def _in_other_thread(self, function):
+        """ Run 'function' on a new thread (that has not got anything from a TimedQueue) and get what it returns """
+
+        result = {}
+        thread = threading.Thread(target=lambda: result.setdefault('value', function()))
+        thread.start()
+        thread.join(5)
+        return result['value']
+
+    def _handle_queued(self, updates, handler):
+        update = updates.get(timeout=1)
+        return handler(update)
+
+    def test_deadline_counts_the_time_waited_on_queue(self):
+        updates = TimedQueue()
+        updates.put('update')
+        time.sleep(0.2)
+
+        remaining = self._in_other_thread(lambda: self._handle_queued(updates, with_deadline(lambda update: remaining_time(), 1)))
+
+        self.assertLess(remaining, 0.85)
+
+    def test_update_waiting_longer_than_its_budget_is_not_handled(self):
+        updates = TimedQueue()
+        updates.put('update')
+        time.sleep(0.1)
+
+        handler = with_deadline(lambda update: check_deadline(), 0.05, 'handler', on_exceeded=lambda update: 'exceeded')
+        self.assertEqual(self._in_other_thread(lambda: self._handle_queued(updates, handler)), 'exceeded')
+
+    def test_deadline_starts_on_call_without_queue(self):
+        remaining = self._in_other_thread(with_deadline(remaining_time, 1))
+
+        self.assertGreater(remaining, 0.9)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+
+from backend_operations.http_cache import SpotifyHTTPCache, http_cache_key
+from backend_operations.sharding import ConsistentHashRing
+from backend_operations.user_layout import UserKeyLayout
+
+
+class _Pipeline:
+    def __init__(self, server):
+        self.server = server
+        self.commands = []
+
+    def hset(self, key, mapping):
+        self.commands.append(lambda: self.server.hashes.setdefault(key, {}).update(
+            {field.encode(): value if isinstance(value, bytes) else value.encode() for field, value in mapping.items()}))
+
+    def expire(self, key, ttl):
+        self.commands.append(lambda: True)
+
+    def unlink(self, *keys):
+        self.commands.append(lambda: [self.server.hashes.pop(key, None) for key in keys])
+
+    def execute(self):
+        return [command() for command in self.commands]
+
+
+class _Redis:
+    """ The commands used by SpotifyHTTPCache and UserKeyLayout.queue_delete_user, on a dict of hashes """
+
+    def __init__(self):
+        self.hashes = {}
+
+    def pipeline(self, transaction=True):
+        return _Pipeline(self)
+
+    def hmget(self, key, *fields):
+        return [self.hashes.get(key, {}).get(field.encode()) for field in fields]
+
+    def register_script(self, script):
+        return None
+
+
+class SpotifyHTTPCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.shards = {'a': _Redis(), 'b': _Redis()}
+        self.ring = ConsistentHashRing(self.shards)
+        self.cache = SpotifyHTTPCache(self.ring, endpoints=[])
+
+    def _store(self, chat_id, url):
+        key = self.cache.key_for(url, {'limit': 50})
+        self.cache.store(chat_id, key, '"etag"', b'{"items": []}')
+        return key
+
+    def test_responses_are_stored_on_the_shard_of_the_user(self):
+        key = self._store(1, 'https://api.spotify.com/v1/me/playlists')
+
+        self.assertEqual(self.cache.lookup(1, key), ('"etag"', b'{"items": []}'))
+        self.assertIsNone(self.cache.lookup(2, key)) # The same resource of other user
+        self.assertIn(http_cache_key(1), self.ring.get_node(1).hashes)
+
+    def test_responses_are_deleted_with_the_user(self):
+        key = self._store(1, 'https://api.spotify.com/v1/me/playlists')
+
+        redis = self.ring.get_node(1)
+        pipeline = redis.pipeline()
+        UserKeyLayout(redis).queue_delete_user(pipeline, 1)
+        pipeline.execute()
+
+        self.assertIsNone(self.cache.lookup(1, key))
+
+    def test_requests_without_user_are_not_cached(self):
+        self.assertFalse(self.cache.is_cacheable('GET', 'https://api.spotify.com/v1/me/playlists', None))
+
+
+if __name__ == '__main__':
+    unittest.main()
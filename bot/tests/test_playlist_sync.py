@@ -0,0 +1,55 @@
+import unittest
+
+from backend_operations.spotify_endpoint_acess import SpotifyEndpointAcess
+
+
+def _uris(start, end):
+    return ['spotify:track:{}'.format(i) for i in range(start, end)]
+
+
+class PlanPlaylistSyncTest(unittest.TestCase):
+
+    def _plan(self, current_tracks, tracks):
+        plan = SpotifyEndpointAcess._plan_playlist_sync(current_tracks, tracks)
+        return plan, SpotifyEndpointAcess._count_playlist_writes(plan)
+
+    def test_unknown_playlist_is_replaced(self):
+        plan, requests = self._plan(None, _uris(0, 250))
+
+        self.assertEqual(plan, (_uris(0, 100), [], _uris(100, 250)))
+        self.assertEqual(requests, 3)
+
+    def test_unchanged_playlist_needs_no_request(self):
+        self.assertEqual(self._plan(_uris(0, 250), _uris(0, 250)), ((None, [], []), 0))
+
+    def test_new_tracks_at_the_end_are_only_added(self):
+        self.assertEqual(self._plan(_uris(0, 250), _uris(0, 260)), ((None, [], _uris(250, 260)), 1))
+
+    def test_tracks_not_wanted_are_removed(self):
+        current_tracks = _uris(0, 250)
+        tracks = [uri for uri in current_tracks if uri not in ('spotify:track:3', 'spotify:track:200')] + _uris(300, 305)
+
+        plan, requests = self._plan(current_tracks, tracks)
+
+        self.assertEqual(plan, (None, ['spotify:track:3', 'spotify:track:200'], _uris(300, 305)))
+        self.assertEqual(requests, 2)
+
+    def test_repeated_tracks_are_removed_once(self):
+        current_tracks = _uris(0, 150) + ['spotify:track:0', 'spotify:track:0']
+        tracks = _uris(1, 150)
+
+        self.assertEqual(self._plan(current_tracks, tracks)[0], (None, ['spotify:track:0'], []))
+
+    def test_reordered_playlist_is_replaced(self):
+        tracks = _uris(0, 250)
+        current_tracks = list(reversed(tracks))
+
+        self.assertEqual(self._plan(current_tracks, tracks)[0], (_uris(0, 100), [], _uris(100, 250)))
+
+    def test_small_playlist_is_replaced_when_that_is_fewer_requests(self):
+        # Removing and adding would be two requests: a single replacement is enough
+        self.assertEqual(self._plan(_uris(0, 50), _uris(1, 51)), ((_uris(1, 51), [], []), 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import time
+import unittest
+import uuid
+
+from redis import RedisError
+
+from backend_operations.rate_limiter import SpotifyRateLimiter
+from backend_operations.redis_connection import get_redis
+
+# The token bucket is a Lua script run by Redis: these tests need the Redis server of config.yaml (its last database is used)
+_TEST_DB = 15
+
+
+def _get_test_redis():
+    try:
+        redis = get_redis(db = _TEST_DB)
+        redis.ping()
+        return redis
+    except RedisError:
+        return None
+
+
+class TokenBucketScriptTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.redis = _get_test_redis()
+        if cls.redis is None:
+            raise unittest.SkipTest('Redis is not reachable')
+
+    def setUp(self):
+        self.key_prefix = 'test:rate_limit:' + uuid.uuid4().hex
+
+    def tearDown(self):
+        self.redis.delete(self.key_prefix + ':bucket', self.key_prefix + ':blocked')
+
+    def _take(self, rate_limiter):
+        """ Run the token bucket script once: (allowed, seconds to wait, tokens left) """
+
+        allowed, wait, tokens = rate_limiter._script(keys=[rate_limiter.bucket_key, rate_limiter.block_key],
+                                                     args=[rate_limiter.rate, rate_limiter.capacity])
+        return int(allowed), float(wait), float(tokens)
+
+    def _rate_limiter(self, rate, capacity):
+        return SpotifyRateLimiter(self.redis, rate=rate, capacity=capacity, jitter=0, key_prefix=self.key_prefix)
+
+    def test_burst_up_to_capacity_then_wait_for_a_token(self):
+        rate_limiter = self._rate_limiter(rate=1, capacity=3)
+
+        self.assertEqual([self._take(rate_limiter)[0] for _ in range(3)], [1, 1, 1])
+
+        allowed, wait, _ = self._take(rate_limiter)
+        self.assertEqual(allowed, 0)
+        self.assertAlmostEqual(wait, 1, delta=0.1) # One token at 1 per second
+
+    def test_tokens_are_refilled_with_time(self):
+        rate_limiter = self._rate_limiter(rate=50, capacity=1)
+
+        self.assertEqual(self._take(rate_limiter)[0], 1)
+        self.assertEqual(self._take(rate_limiter)[0], 0)
+
+        time.sleep(0.05)
+        self.assertEqual(self._take(rate_limiter)[0], 1)
+
+    def test_bucket_is_shared_by_limiters_with_the_same_keys(self):
+        self.assertEqual(self._take(self._rate_limiter(rate=1, capacity=1))[0], 1)
+        self.assertEqual(self._take(self._rate_limiter(rate=1, capacity=1))[0], 0)
+
+    def test_no_token_is_given_while_blocked(self):
+        rate_limiter = self._rate_limiter(rate=10, capacity=5)
+        rate_limiter.block(2)
+
+        allowed, wait, tokens = self._take(rate_limiter)
+        self.assertEqual(allowed, 0)
+        self.assertAlmostEqual(wait, 2, delta=0.1)
+        self.assertEqual(tokens, 5) # Kept for when the block ends
+
+        # A shorter block does not end it earlier
+        rate_limiter.block(0.1)
+        self.assertGreater(self._take(rate_limiter)[1], 1)
+
+
+class _DownRedis:
+    def register_script(self, script):
+        def run(keys, args):
+            raise RedisError('Redis is down')
+        return run
+
+
+class RedisDownTest(unittest.TestCase):
+
+    def test_requests_are_let_through_without_redis(self):
+        rate_limiter = SpotifyRateLimiter(_DownRedis())
+
+        with self.assertLogs('backend_operations.rate_limiter', 'ERROR'):
+            self.assertEqual(rate_limiter.acquire(), 0)
+        self.assertEqual(rate_limiter.try_acquire(), 0) # Redis not tried again for a while
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+
+from redis import ConnectionError as RedisConnectionError
+
+from backend_operations.redis_operations import RedisAcess, USER_ACTIVITY_KEY
+from backend_operations.sharding import ConsistentHashRing
+
+
+class _Redis:
+    def __init__(self, fail):
+        self.fail = fail
+        self.activity = []
+
+    def zadd(self, key, mapping):
+        if self.fail:
+            raise RedisConnectionError('Redis is down')
+        self.activity.append((key, mapping))
+
+
+class ActivityMarkTest(unittest.TestCase):
+
+    def _redis_acess(self, fail):
+        redis_acess = RedisAcess()
+        self.shard = _Redis(fail)
+        redis_acess.shards = ConsistentHashRing({'default': self.shard})
+        redis_acess.token_cache.put(1, 'token', 3600)
+        return redis_acess
+
+    def test_user_is_marked_active_when_its_token_is_used(self):
+        redis_acess = self._redis_acess(fail=False)
+
+        self.assertEqual(redis_acess.get_spotify_acess_token(1), 'token')
+        self.assertEqual(redis_acess.get_spotify_acess_token(1), 'token')
+
+        self.assertEqual([key for key, _ in self.shard.activity], [USER_ACTIVITY_KEY]) # Once per interval
+
+    def test_redis_error_on_mark_does_not_fail_token_served_from_memory(self):
+        redis_acess = self._redis_acess(fail=True)
+
+        with self.assertLogs('backend_operations.redis_operations', 'ERROR'):
+            self.assertEqual(redis_acess.get_spotify_acess_token(1), 'token')
+
+        # Marked on the next call
+        self.shard.fail = False
+        redis_acess.get_spotify_acess_token(1)
+        self.assertEqual(len(self.shard.activity), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
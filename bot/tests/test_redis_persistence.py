@@ -0,0 +1,194 @@
+import pickle
+import threading
+import unittest
+from types import SimpleNamespace
+
+from backend_operations.redis_persistence import RedisPersistence, chat_key
+from backend_operations.survey import SurveyManager
+
+
+class _Pipeline:
+    """ The pipeline commands used by RedisPersistence, on a dict of hashes """
+
+    def __init__(self, server):
+        self.server = server
+        self.commands = []
+
+    def hdel(self, key, *fields):
+        self.commands.append(lambda: [self.server.hashes.get(key, {}).pop(field.encode(), None) for field in fields])
+
+    def hset(self, key, mapping):
+        self.commands.append(lambda: self.server.hashes.setdefault(key, {}).update(
+            {field.encode(): value if isinstance(value, bytes) else value.encode() for field, value in mapping.items()}))
+
+    def expire(self, key, ttl):
+        self.commands.append(lambda: True)
+
+    def hgetall(self, key):
+        self.commands.append(lambda: dict(self.server.hashes.get(key, {})))
+
+    def execute(self):
+        self.server.round_trips += 1
+        return [command() for command in self.commands]
+
+
+class _Redis:
+    def __init__(self):
+        self.hashes = {}
+        self.round_trips = 0
+
+    def pipeline(self, transaction=False):
+        return _Pipeline(self)
+
+
+class _Data(dict):
+    """ chat_data that counts how many times it was serialized """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.serializations = 0
+
+    def __reduce_ex__(self, protocol):
+        self.serializations += 1
+        return super().__reduce_ex__(protocol)
+
+
+class UpdateWritesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = _Redis()
+        self.persistence = RedisPersistence(SimpleNamespace(redis=self.redis), flush_interval=5)
+
+    def _in_other_thread(self, function, *args):
+        thread = threading.Thread(target=function, args=args)
+        thread.start()
+        thread.join(5)
+
+    def test_update_changes_are_written_when_it_is_done(self):
+        chat_data = {}
+        self.persistence.load_chat(1, chat_data)
+        chat_data['page'] = 2
+        self.persistence.update_chat_data(1, chat_data)
+
+        self.assertIn(b'd', self.redis.hashes[chat_key(1)])
+        self.assertEqual(self.persistence.get_stats()['writes'], 1)
+
+    def test_job_calls_for_chats_not_being_handled_are_ignored(self):
+        data = _Data(page=2)
+        self.persistence.update_chat_data(1, data) # Like Dispatcher.update_persistence after a job
+
+        self.assertEqual(data.serializations, 0)
+        self.assertEqual(self.redis.round_trips, 0)
+        self.persistence.write_pending()
+        self.assertNotIn(chat_key(1), self.redis.hashes)
+
+    def test_job_call_during_update_does_not_write_it(self):
+        chat_data = {}
+        self.persistence.load_chat(1, chat_data)
+        round_trips = self.redis.round_trips
+
+        # A job ends (on its own thread) while the Update is halfway through
+        chat_data['page'] = 1
+        self._in_other_thread(self.persistence.update_chat_data, 1, chat_data)
+        self.assertEqual(self.redis.round_trips, round_trips)
+
+        # The end of the Update still writes its data right away
+        chat_data['page'] = 2
+        self.persistence.update_chat_data(1, chat_data)
+        self.assertEqual(self.redis.round_trips, round_trips + 1)
+
+        restored = {}
+        RedisPersistence(SimpleNamespace(redis=self.redis)).load_chat(1, restored)
+        self.assertEqual(restored, {'page': 2})
+
+    def test_chat_data_saved_by_jobs_is_written_in_batches(self):
+        self.persistence.save_chat_data(1, {'page': 1})
+        self.persistence.save_chat_data(2, {'page': 2})
+        self.assertEqual(self.redis.round_trips, 0)
+
+        self.persistence.write_pending()
+        self.assertEqual(self.redis.round_trips, 1)
+        self.assertEqual(set(self.redis.hashes), {chat_key(1), chat_key(2)})
+
+
+class _RecordingLock:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.acquired = 0
+
+    def __enter__(self):
+        self._lock.acquire()
+        self.acquired += 1
+
+    def __exit__(self, *args):
+        self._lock.release()
+
+
+def _run_code():
+    _RUN_CODE.append(True)
+
+
+_RUN_CODE = []
+
+
+class _Exploit:
+    def __reduce__(self):
+        return (_run_code, ())
+
+
+class LoadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = _Redis()
+        self.persistence = RedisPersistence(SimpleNamespace(redis=self.redis), compress_above=64)
+
+    def _save_and_load(self, data):
+        self.persistence.save_chat_data(1, data)
+        self.persistence.write_pending()
+
+        loaded = {}
+        RedisPersistence(SimpleNamespace(redis=self.redis)).refresh_chat_data(1, loaded)
+        return loaded
+
+    def test_chat_data_round_trip(self):
+        survey = SurveyManager([{'text': 'Energy', 'options_set': 'levels', 'attribute': 'energy'}],
+                               {'levels': [{'text': 'Low', 'max_val': 0.3}]})
+        survey.go_next_poll()
+        data = {'selected_artists_index': {0, 3}, 'artists_list': [{'id': 'a', 'genres': ['rock'] * 20}], 'page': 1,
+                'current_message_id': None, 'spotify_survey': survey}
+
+        loaded = self._save_and_load(data)
+
+        self.assertEqual(loaded['selected_artists_index'], {0, 3})
+        self.assertEqual(loaded['artists_list'], data['artists_list'])
+        self.assertIsNone(loaded['current_message_id'])
+        self.assertEqual(loaded['spotify_survey'].get_state(), survey.get_state())
+
+    def test_pickles_are_not_loaded(self):
+        self.redis.hashes[chat_key(1)] = {b'd': b'\x01' + pickle.dumps({'page': _Exploit()})}
+
+        loaded = {}
+        self.persistence.refresh_chat_data(1, loaded)
+
+        self.assertEqual(_RUN_CODE, [])
+        self.assertEqual(loaded, {})
+
+    def test_refresh_updates_chat_data_and_conversations_in_place(self):
+        handler = SimpleNamespace(name='setup', _conversations_lock=_RecordingLock())
+        conversations = self.persistence.get_conversations('setup')
+        conversations[(1, 1)] = 3
+        conversations[(2, 2)] = 4
+        self.persistence.register_conversation_handler(handler)
+        self.redis.hashes[chat_key(1)] = {b'c:setup:1,1': b'5'}
+        self._save_and_load({'page': 1})
+
+        chat_data = {'page': 0, 'stale': True}
+        self.persistence.refresh_chat_data(1, chat_data)
+
+        self.assertEqual(chat_data, {'page': 1})
+        self.assertEqual(conversations, {(1, 1): 5, (2, 2): 4})
+        self.assertEqual(handler._conversations_lock.acquired, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
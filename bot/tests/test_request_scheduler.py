@@ -0,0 +1,89 @@
+import threading
+import time
+import unittest
+
+from backend_operations.deadline import DeadlineExceeded, deadline_scope
+from backend_operations.request_scheduler import SpotifyRequestScheduler, INTERACTIVE, BULK
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = SpotifyRequestScheduler(max_concurrent=1, class_weights={INTERACTIVE: 4, BULK: 1})
+        self.order = []
+        self.threads = []
+
+        # Holds the only slot, so the calls that follow are queued
+        self.release_blocker = threading.Event()
+        self._start(None, INTERACTIVE, self.release_blocker.wait, 5)
+        self._wait_for(lambda: self.scheduler.get_stats()['free_slots'] == 0)
+
+    def tearDown(self):
+        self.release_blocker.set()
+        for thread in self.threads:
+            thread.join(5)
+
+    def _wait_for(self, condition):
+        give_up_at = time.monotonic() + 5
+        while not condition():
+            if time.monotonic() > give_up_at:
+                self.fail('Scheduler did not reach the expected state')
+            time.sleep(0.001)
+
+    def _start(self, chat_id, priority, function, *args):
+        thread = threading.Thread(target=self.scheduler.run, args=(chat_id, priority, function) + args)
+        thread.start()
+        self.threads.append(thread)
+
+    def _queue(self, chat_id, priority, label):
+        """ Queue a call that records 'label' when sent (queued calls keep the order they are made in) """
+
+        queued = self.scheduler.get_stats()['queued']
+        self._start(chat_id, priority, self.order.append, label)
+        self._wait_for(lambda: self.scheduler.get_stats()['queued'] == queued + 1)
+
+    def _run_queued(self):
+        self.release_blocker.set()
+        for thread in self.threads:
+            thread.join(5)
+
+    def test_interactive_calls_get_more_slots_than_bulk_ones(self):
+        for i in range(2):
+            self._queue(1, BULK, 'bulk')
+        for i in range(8):
+            self._queue(2, INTERACTIVE, 'interactive')
+
+        self._run_queued()
+
+        # Four interactive calls per bulk one, without starving the bulk ones
+        self.assertEqual(self.order, ['interactive'] * 3 + ['bulk'] + ['interactive'] * 4 + ['bulk'] + ['interactive'])
+
+    def test_chats_share_the_slots(self):
+        for i in range(4):
+            self._queue(1, BULK, 'chat 1')
+        self._queue(2, BULK, 'chat 2')
+
+        self._run_queued()
+
+        # Chat 2 does not wait for all calls of chat 1
+        self.assertEqual(self.order, ['chat 1', 'chat 2', 'chat 1', 'chat 1', 'chat 1'])
+
+    def test_calls_that_ran_out_of_time_leave_the_queue(self):
+        def run_with_deadline():
+            with deadline_scope(0.05, 'test'):
+                with self.assertRaises(DeadlineExceeded):
+                    self.scheduler.run(1, BULK, self.order.append, 'timed out')
+
+        thread = threading.Thread(target=run_with_deadline)
+        thread.start()
+        thread.join(5)
+
+        self.assertEqual(self.scheduler.get_stats()['queued'], 0)
+        self._queue(2, BULK, 'chat 2')
+        self._run_queued()
+        self.assertEqual(self.order, ['chat 2'])
+        self.assertEqual(self.scheduler.get_stats()['free_slots'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
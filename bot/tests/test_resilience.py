@@ -0,0 +1,66 @@
+import unittest
+
+import requests
+
+from backend_operations.deadline import DeadlineExceeded, deadline_scope
+from backend_operations.resilience import CircuitBreaker, CircuitOpenError, EndpointResilience
+
+
+class _Response:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class HalfOpenBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.resilience = EndpointResilience(
+            {'topURL': 'https://api.spotify.com/v1/me/top/{type}'},
+            {'default': {'maxAttempts': 1, 'failureThreshold': 1, 'resetTimeout': 0}}
+        )
+        self.url = 'https://api.spotify.com/v1/me/top/tracks'
+        self.breaker = self.resilience._breakers['topURL']
+
+        # Open the breaker: with no reset timeout, the next call is its half-open trial
+        self.resilience.call(self.url, 'GET', lambda: _Response(503))
+        self.assertEqual(self.breaker.get_state()['state'], CircuitBreaker.OPEN)
+
+    def _raise(self, exception):
+        def function():
+            raise exception
+        return function
+
+    def test_trial_interrupted_by_deadline_is_released(self):
+        with self.assertRaises(DeadlineExceeded):
+            self.resilience.call(self.url, 'GET', self._raise(DeadlineExceeded('test')))
+
+        state = self.breaker.get_state()
+        self.assertEqual(state['state'], CircuitBreaker.HALF_OPEN)
+        self.assertEqual(state['total_failures'], 1) # Only the one that opened it
+
+        # Another trial goes through and closes the breaker
+        self.assertEqual(self.resilience.call(self.url, 'GET', lambda: _Response(200)).status_code, 200)
+        self.assertEqual(self.breaker.get_state()['state'], CircuitBreaker.CLOSED)
+
+    def test_connection_error_after_deadline_is_released(self):
+        with deadline_scope(0, 'test'):
+            with self.assertRaises(DeadlineExceeded):
+                self.resilience.call(self.url, 'GET', self._raise(requests.ConnectionError()))
+
+        self.assertEqual(self.breaker.get_state()['total_failures'], 1)
+        self.assertEqual(self.resilience.call(self.url, 'GET', lambda: _Response(200)).status_code, 200)
+
+    def test_connection_error_on_trial_opens_breaker(self):
+        with self.assertRaises(requests.ConnectionError):
+            self.resilience.call(self.url, 'GET', self._raise(requests.ConnectionError()))
+
+        self.assertEqual(self.breaker.get_state()['total_failures'], 2)
+
+    def test_trial_in_flight_rejects_other_calls(self):
+        self.breaker.before_call()
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_call()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import collections
+import unittest
+
+from backend_operations.sharding import ConsistentHashRing
+
+_CHAT_IDS = [str(chat_id) for chat_id in range(100000, 110000)]
+
+
+class ConsistentHashRingTest(unittest.TestCase):
+
+    def _ring(self, names):
+        return ConsistentHashRing({name: 'client of ' + name for name in names})
+
+    def test_adding_a_shard_only_moves_keys_to_it(self):
+        before = self._ring(['a', 'b', 'c'])
+        after = self._ring(['a', 'b', 'c', 'd'])
+
+        moved = [chat_id for chat_id in _CHAT_IDS if before.get_name(chat_id) != after.get_name(chat_id)]
+
+        self.assertEqual({after.get_name(chat_id) for chat_id in moved}, {'d'})
+        self.assertAlmostEqual(len(moved) / len(_CHAT_IDS), 1 / 4, delta=0.05) # About 1/N of the keys
+
+    def test_removing_a_shard_only_moves_its_keys(self):
+        before = self._ring(['a', 'b', 'c', 'd'])
+        after = self._ring(['a', 'b', 'c'])
+
+        for chat_id in _CHAT_IDS:
+            if before.get_name(chat_id) != 'd':
+                self.assertEqual(after.get_name(chat_id), before.get_name(chat_id))
+
+    def test_keys_are_spread_evenly(self):
+        ring = self._ring(['a', 'b', 'c', 'd'])
+
+        counts = collections.Counter(ring.get_name(chat_id) for chat_id in _CHAT_IDS)
+
+        for name in 'abcd':
+            self.assertAlmostEqual(counts[name] / len(_CHAT_IDS), 1 / 4, delta=0.05)
+
+    def test_placement_depends_on_names_only(self):
+        ring = self._ring(['a', 'b'])
+        moved_endpoints = ConsistentHashRing({'a': 'new client of a', 'b': 'client of b'})
+
+        for chat_id in _CHAT_IDS[:1000]:
+            self.assertEqual(ring.get_name(chat_id), moved_endpoints.get_name(chat_id))
+        self.assertEqual(ring.get_node(1), 'client of ' + ring.get_name(1))
+        self.assertEqual(ring.get_name(1), ring.get_name('1')) # Integer and string chat IDs
+
+    def test_single_shard_gets_every_key(self):
+        ring = self._ring(['only'])
+
+        self.assertEqual({ring.get_name(chat_id) for chat_id in _CHAT_IDS[:100]}, {'only'})
+
+    def test_ring_needs_a_shard(self):
+        with self.assertRaises(ValueError):
+            ConsistentHashRing({})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import threading
+import time
+import unittest
+
+from backend_operations.deadline import DeadlineExceeded
+from backend_operations.single_flight import SingleFlight
+
+
+class _OperationError(Exception):
+    pass
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.single_flight = SingleFlight()
+        self.leader_started = threading.Event()
+        self.release_leader = threading.Event()
+
+    def _leader(self, error):
+        def function():
+            self.leader_started.set()
+            self.release_leader.wait(5)
+            raise error
+        return function
+
+    def _follow(self, function, outcome):
+        try:
+            outcome['result'] = self.single_flight.do('key', function)
+        except Exception as e:
+            outcome['error'] = e
+
+    def _run_follower_behind(self, leader_error):
+        """ Make a call that fails with 'leader_error' while another one, with the same key, waits for it """
+
+        leader_outcome, follower_outcome = {}, {}
+        leader = threading.Thread(target=self._follow, args=(self._leader(leader_error), leader_outcome))
+        leader.start()
+        self.leader_started.wait(5)
+
+        follower = threading.Thread(target=self._follow, args=(lambda: 'follower result', follower_outcome))
+        follower.start()
+        give_up_at = time.monotonic() + 5
+        while self.single_flight.get_stats()['shared'] == 0:
+            if time.monotonic() > give_up_at:
+                self.release_leader.set()
+                self.fail('Follower did not wait for the leader')
+            time.sleep(0.001)
+        self.release_leader.set()
+
+        leader.join(5)
+        follower.join(5)
+        return leader_outcome, follower_outcome
+
+    def test_follower_calls_again_when_leader_deadline_ran_out(self):
+        leader_outcome, follower_outcome = self._run_follower_behind(DeadlineExceeded('leader'))
+
+        self.assertIsInstance(leader_outcome['error'], DeadlineExceeded)
+        self.assertEqual(follower_outcome, {'result': 'follower result'})
+        self.assertEqual(self.single_flight.get_stats()['executed'], 2)
+
+    def test_follower_calls_again_when_leader_error_was_caused_by_its_deadline(self):
+        error = _OperationError()
+        error.__cause__ = DeadlineExceeded('leader')
+        _, follower_outcome = self._run_follower_behind(error)
+
+        self.assertEqual(follower_outcome, {'result': 'follower result'})
+
+    def test_follower_raises_copy_of_leader_error(self):
+        leader_outcome, follower_outcome = self._run_follower_behind(_OperationError('failed'))
+
+        self.assertIsInstance(follower_outcome['error'], _OperationError)
+        self.assertIsNot(follower_outcome['error'], leader_outcome['error'])
+        self.assertEqual(self.single_flight.get_stats()['executed'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from backend_operations.spotify_async_request import AsyncSpotifyEndpointAcess, AsyncSpotifyRequest
+from backend_operations.spotify_request import SpotifyOperationException
+
+
+class PlaylistMirrorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mirror_updates = []
+        spotify_endpoint_acess = SimpleNamespace(
+            spotify_url_list={'playlist': {'tracksURL': 'https://api.spotify.com/v1/playlists/{playlist_id}/tracks'}},
+            _get_acess_token_valid=lambda chat_id: 'token',
+            _update_playlist_mirror=lambda *args: self.mirror_updates.append(args)
+        )
+        redis_instance = SimpleNamespace(get_spotify_playlist_id=lambda chat_id: 'playlist')
+        self.endpoint_acess = AsyncSpotifyEndpointAcess(redis_instance, spotify_endpoint_acess)
+
+    def _run(self, coroutine, send):
+        with mock.patch.object(AsyncSpotifyRequest, 'send', send):
+            asyncio.run(coroutine)
+
+    def test_changes_remove_the_mirror(self):
+        async def send(request):
+            return {'snapshot_id': 'new'}
+
+        self._run(self.endpoint_acess.add_tracks(1, ['spotify:track:a']), send)
+        self._run(self.endpoint_acess.delete_tracks(1, ['spotify:track:a']), send)
+
+        self.assertEqual(self.mirror_updates, [(1, 'playlist', None, None)] * 2)
+
+    def test_failed_change_removes_the_mirror(self):
+        async def send(request):
+            raise SpotifyOperationException()
+
+        with self.assertRaises(SpotifyOperationException):
+            self._run(self.endpoint_acess.add_tracks(1, ['spotify:track:a']), send)
+
+        self.assertEqual(self.mirror_updates, [(1, 'playlist', None, None)])
+
+
+if __name__ == '__main__':
+    unittest.main()
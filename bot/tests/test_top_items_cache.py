@@ -0,0 +1,123 @@
+import time
+import unittest
+from types import SimpleNamespace
+
+from backend_operations.top_items_cache import TopItemsCache, top_items_key
+
+
+class _Pipeline:
+    def __init__(self, server):
+        self.server = server
+        self.commands = []
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        self.commands.append(lambda: self.server.hset(key, field, value, mapping))
+
+    def hdel(self, key, *fields):
+        self.commands.append(lambda: [self.server.hashes.get(key, {}).pop(field, None) for field in fields])
+
+    def expire(self, key, ttl):
+        self.commands.append(lambda: True)
+
+    def execute(self):
+        return [command() for command in self.commands]
+
+
+class _Redis:
+    """ The commands used by TopItemsCache, on a dict of hashes """
+
+    def __init__(self):
+        self.hashes = {}
+        self.locks = set()
+
+    def pipeline(self, transaction=True):
+        return _Pipeline(self)
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        values = dict(mapping or {})
+        if field is not None:
+            values[field] = value
+        self.hashes.setdefault(key, {}).update({field: str(value).encode() if not isinstance(value, bytes) else value
+                                                for field, value in values.items()})
+
+    def hmget(self, key, *fields):
+        return [self.hashes.get(key, {}).get(field) for field in fields]
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.locks:
+            return None
+        self.locks.add(key)
+        return True
+
+    def delete(self, key):
+        self.locks.discard(key)
+
+
+class _Spotify:
+    """ Top artists of an user, counting the calls made to get them """
+
+    def __init__(self):
+        self.calls = []
+
+    def fetch(self, limit=50):
+        self.calls.append(limit)
+        return [{'id': 'artist{}'.format(i), 'name': 'Artist', 'genres': []} for i in range(limit)]
+
+
+class TopItemsCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = _Redis()
+        self.cache = TopItemsCache(SimpleNamespace(shard=lambda chat_id: self.redis), fresh_for=60)
+        self.spotify = _Spotify()
+
+    def tearDown(self):
+        self.cache._executor.shutdown(wait=True)
+
+    def _get(self, fetch_first=False):
+        return self.cache.get(1, 'artists', fetch=self.spotify.fetch,
+                              fetch_first=(lambda: self.spotify.fetch(limit=10)) if fetch_first else None)
+
+    def _age_entry(self, seconds):
+        entry = self.redis.hashes[top_items_key(1, 'artists')]
+        entry['t'] = str(float(entry['t']) - seconds).encode()
+
+    def test_miss_then_hit(self):
+        self.assertEqual(len(self._get()), 50)
+        self.assertEqual(len(self._get()), 50)
+
+        self.assertEqual(self.spotify.calls, [50])
+        stats = self.cache.get_stats()
+        self.assertEqual((stats['misses'], stats['hits'], stats['stale_hits']), (1, 1, 0))
+        self.assertEqual(stats['hit_ratio'], 0.5)
+
+    def test_stale_entry_is_served_and_refreshed_in_background(self):
+        self._get()
+        self._age_entry(120)
+
+        self.assertEqual(len(self._get()), 50)
+        self.cache._executor.shutdown(wait=True)
+
+        self.assertEqual(self.spotify.calls, [50, 50])
+        stats = self.cache.get_stats()
+        self.assertEqual((stats['misses'], stats['stale_hits'], stats['refreshes']), (1, 1, 1))
+        fetched_at, = self.redis.hmget(top_items_key(1, 'artists'), 't')
+        self.assertLess(time.time() - float(fetched_at), 60)
+
+    def test_miss_of_first_items_is_a_single_call(self):
+        self.assertEqual(len(self._get(fetch_first=True)), 10)
+        self.cache._executor.shutdown(wait=True)
+        self.assertEqual(self.spotify.calls, [10])
+
+        # The partial entry serves callers of the first items only
+        self.assertEqual(len(self._get(fetch_first=True)), 10)
+        self.assertEqual(len(self._get()), 50)
+        self.assertEqual(len(self._get()), 50)
+
+        self.assertEqual(self.spotify.calls, [10, 50])
+        stats = self.cache.get_stats()
+        self.assertEqual((stats['misses'], stats['hits']), (2, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+import time
+import unittest
+
+from backend_operations.user_layout import (UserKeyLayout, LEGACY, DUAL, COMPACT, USER, SEEDS, ATTRIBUTES, legacy_key,
+                                            compact_key)
+
+
+def _to_bytes(value):
+    return value if isinstance(value, bytes) else str(value).encode()
+
+
+class _Redis:
+    """ The commands used by UserKeyLayout, on dicts of hashes and strings. Commands queued on its pipelines run right away """
+
+    def __init__(self):
+        self.hashes = {}
+        self.strings = {}
+        self.results = []
+
+    def pipeline(self, transaction=True):
+        self.results = []
+        return self
+
+    def execute(self):
+        return self.results
+
+    def _reply(self, result):
+        self.results.append(result)
+
+    def register_script(self, script):
+        # Only the script of UserKeyLayout: removes the fields of a hash starting with a prefix
+        def delete_prefix(keys, args, client):
+            fields = self.hashes.get(keys[0], {})
+            for field in [field for field in fields if field.startswith(args[0].encode())]:
+                del fields[field]
+        return delete_prefix
+
+    def hmget(self, key, fields):
+        self._reply([self.hashes.get(key, {}).get(field.encode()) for field in fields])
+
+    def hgetall(self, key):
+        self._reply(dict(self.hashes.get(key, {})))
+
+    def hset(self, key, mapping):
+        self.hashes.setdefault(key, {}).update({field.encode(): _to_bytes(value) for field, value in mapping.items()})
+        self._reply(len(mapping))
+
+    def hdel(self, key, *fields):
+        self._reply(len([self.hashes.get(key, {}).pop(field.encode(), None) for field in fields]))
+
+    def get(self, name):
+        self._reply(self.strings.get(name, (None, None))[0])
+
+    def ttl(self, name):
+        self._reply(self.strings[name][1] if name in self.strings else -2)
+
+    def set(self, name, value, ex):
+        self.strings[name] = (_to_bytes(value), ex)
+        self._reply(True)
+
+    def unlink(self, *keys):
+        self._reply(len([key for key in keys if self.hashes.pop(key, None) is not None or self.strings.pop(key, None) is not None]))
+
+
+class UserKeyLayoutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = _Redis()
+
+    def _layout(self, mode):
+        return UserKeyLayout(self.redis, mode)
+
+    def _read(self, layout, section, fields):
+        parse = layout.queue_read(self.redis.pipeline(), 1, section, fields)
+        return parse(iter(self.redis.execute()))
+
+    def _read_section(self, layout, section):
+        parse = layout.queue_read_section(self.redis.pipeline(), 1, section)
+        return parse(iter(self.redis.execute()))
+
+    def _write(self, layout, section, mapping):
+        layout.queue_write(self.redis.pipeline(), 1, section, mapping)
+
+    def test_each_mode_writes_its_layouts(self):
+        self._write(self._layout(LEGACY), USER, {'user_id': 'legacy'})
+        self.assertEqual(set(self.redis.hashes), {legacy_key(1)})
+
+        self._write(self._layout(COMPACT), USER, {'user_id': 'compact'})
+        self.assertEqual(self.redis.hashes[compact_key(1)], {b'uid': b'compact'})
+        self.assertEqual(self.redis.hashes[legacy_key(1)], {b'user_id': b'legacy'})
+
+        self._write(self._layout(DUAL), SEEDS, {'artists': 'both'})
+        self.assertEqual(self.redis.hashes[compact_key(1)][b's:artists'], b'both')
+        self.assertEqual(self.redis.hashes[legacy_key(1, SEEDS)], {b'artists': b'both'})
+
+    def test_dual_reads_prefer_compact_and_fall_back_to_legacy(self):
+        self._write(self._layout(LEGACY), USER, {'user_id': 'old', 'playlist_id': 'not migrated'})
+        self._write(self._layout(COMPACT), USER, {'user_id': 'new'})
+
+        self.assertEqual(self._read(self._layout(DUAL), USER, ['user_id', 'playlist_id', 'refresh_token']),
+                         [b'new', b'not migrated', None])
+        self.assertEqual(self._read(self._layout(LEGACY), USER, ['user_id']), [b'old'])
+        self.assertEqual(self._read(self._layout(COMPACT), USER, ['playlist_id']), [None])
+
+    def test_dual_section_reads_merge_both_layouts(self):
+        self._write(self._layout(LEGACY), ATTRIBUTES, {'energy': 'old', 'tempo': 'not migrated'})
+        self._write(self._layout(COMPACT), ATTRIBUTES, {'energy': 'new'})
+        self._write(self._layout(COMPACT), SEEDS, {'artists': 'other section'})
+
+        self.assertEqual(self._read_section(self._layout(DUAL), ATTRIBUTES), {'energy': b'new', 'tempo': b'not migrated'})
+
+    def test_dual_section_delete_removes_it_from_both_layouts(self):
+        layout = self._layout(DUAL)
+        self._write(layout, ATTRIBUTES, {'energy': 'value'})
+        self._write(layout, SEEDS, {'artists': 'value'})
+
+        layout.queue_delete_section(self.redis.pipeline(), 1, ATTRIBUTES)
+
+        self.assertEqual(self._read_section(layout, ATTRIBUTES), {})
+        self.assertEqual(self._read_section(layout, SEEDS), {'artists': b'value'})
+
+    def test_dual_token_read_falls_back_to_legacy_when_compact_one_expired(self):
+        self.redis.hashes[compact_key(1)] = {b't': b'expired', b'te': str(int(time.time()) - 10).encode()}
+        self.redis.strings[legacy_key(1, 'acess_token')] = (b'legacy', 100)
+
+        layout = self._layout(DUAL)
+        pipeline = self.redis.pipeline()
+        parse_token = layout.queue_read_token(pipeline, 1)
+        parse_user = layout.queue_read(pipeline, 1, USER, ['user_id'])
+        results = iter(self.redis.execute())
+
+        self.assertEqual(parse_token(results), (b'legacy', 100))
+        self.assertEqual(parse_user(results), [None]) # Reads queued after the token one still get their results
+
+    def test_dual_token_read_of_valid_compact_token_skips_legacy_results(self):
+        layout = self._layout(DUAL)
+        layout.queue_write_token(self.redis.pipeline(), 1, 'token', 3600)
+        self._write(layout, USER, {'user_id': 'user'})
+
+        pipeline = self.redis.pipeline()
+        parse_token = layout.queue_read_token(pipeline, 1)
+        parse_user = layout.queue_read(pipeline, 1, USER, ['user_id'])
+        results = iter(self.redis.execute())
+
+        token, expires_in = parse_token(results)
+        self.assertEqual(token, b'token')
+        self.assertAlmostEqual(expires_in, 3600, delta=2)
+        self.assertEqual(parse_user(results), [b'user'])
+
+    def test_delete_user_removes_both_layouts(self):
+        layout = self._layout(DUAL)
+        layout.queue_write_token(self.redis.pipeline(), 1, 'token', 3600)
+        for section in (USER, SEEDS, ATTRIBUTES):
+            self._write(layout, section, {'field': 'value'})
+        self.redis.hashes[legacy_key(2)] = {b'field': b'other user'}
+
+        layout.queue_delete_user(self.redis.pipeline(), 1)
+
+        self.assertEqual(self.redis.hashes, {legacy_key(2): {b'field': b'other user'}})
+        self.assertEqual(self.redis.strings, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
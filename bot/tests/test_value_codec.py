@@ -0,0 +1,68 @@
+import json
+import unittest
+from unittest import mock
+
+from backend_operations import value_codec
+
+_TRACKS = [
+    {'id': 'track1', 'name': 'Song', 'artists': ['Artist', 'Other'], 'link': 'https://open.spotify.com/track/track1'},
+    {'id': 'track2', 'name': 'Ção', 'artists': [], 'link': 'https://example.com/track2'} # Not the usual link
+]
+_ARTISTS = [{'id': 'artist1', 'name': 'Artist', 'genres': ['rock', 'pop'], 'link': 'https://open.spotify.com/artist/artist1'}]
+
+
+@unittest.skipIf(value_codec.msgpack is None, 'msgpack is not installed')
+class MessagePackTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        value = {'min': 0.25, 'max': 1, 'values': [None, True, 'text', 'ção']}
+        raw = value_codec.encode(value)
+
+        self.assertTrue(value_codec.is_compact(raw))
+        self.assertEqual(value_codec.decode(raw), value)
+
+    def test_seeds_round_trip(self):
+        for seeds, type_entity in ((_TRACKS, 'tracks'), (_ARTISTS, 'artists')):
+            raw = value_codec.encode_seeds(seeds, type_entity)
+
+            self.assertTrue(value_codec.is_compact(raw))
+            self.assertEqual(value_codec.decode_seeds(raw, type_entity), seeds)
+
+    def test_seeds_are_smaller_than_json(self):
+        self.assertLess(len(value_codec.encode_seeds(_TRACKS, 'tracks')), len(json.dumps(_TRACKS)))
+
+    def test_invalid_value(self):
+        with self.assertRaises(value_codec.CodecException):
+            value_codec.decode(value_codec.MSGPACK_V1 + b'\xc1') # Byte never used by MessagePack
+
+
+class JSONTest(unittest.TestCase):
+
+    def test_values_stored_as_json_by_older_versions_are_read(self):
+        raw = json.dumps(_TRACKS).encode('utf-8')
+
+        self.assertFalse(value_codec.is_compact(raw))
+        self.assertEqual(value_codec.decode(raw), _TRACKS)
+        self.assertEqual(value_codec.decode_seeds(raw, 'tracks'), _TRACKS)
+
+    def test_json_is_used_without_msgpack(self):
+        with mock.patch.object(value_codec, 'msgpack', None):
+            raw = value_codec.encode_seeds(_ARTISTS, 'artists')
+
+            self.assertFalse(value_codec.is_compact(raw))
+            self.assertEqual(value_codec.decode_seeds(raw, 'artists'), _ARTISTS)
+
+    def test_compact_value_without_msgpack(self):
+        raw = value_codec.MSGPACK_V1 + b'\x90'
+
+        with mock.patch.object(value_codec, 'msgpack', None):
+            with self.assertRaises(value_codec.CodecException):
+                value_codec.decode(raw)
+
+    def test_invalid_value(self):
+        with self.assertRaises(value_codec.CodecException):
+            value_codec.decode(b'{not json')
+
+
+if __name__ == '__main__':
+    unittest.main()
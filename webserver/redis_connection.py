@@ -0,0 +1,161 @@
+import os
+import threading
+import time
+
+import yaml
+from redis import Redis, BlockingConnectionPool
+from redis.backoff import ExponentialBackoff
+from redis.retry import Retry
+from redis.sentinel import Sentinel, SentinelConnectionPool
+
+# Connections to Redis of the whole process, configured by the 'redis' section of 'config.yaml': one pool per database, shared
+# by every client of that database. Used by both the bot and the webserver (as each Docker image is built from its own folder,
+# webserver/redis_connection.py is a copy of this file: keep both the same)
+
+_POOLS = {} # (host, port, database number) -> connection pool (host and port are None for the configured endpoint)
+_POOLS_LOCK = threading.Lock()
+_CONFIG = None
+
+
+class _PoolStatsMixin:
+    """ Counts how many connections were taken from a pool and how long it took (waiting for a free connection, or making a
+    new one) """
+
+    def _init_stats(self):
+        self._stats_lock = threading.Lock()
+        self._acquired = 0
+        self._failed = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+
+    def get_connection(self, *args, **kwargs):
+        start = time.monotonic()
+        try:
+            connection = super().get_connection(*args, **kwargs)
+        except Exception:
+            with self._stats_lock:
+                self._failed += 1
+            raise
+
+        waited = time.monotonic() - start
+        with self._stats_lock:
+            self._acquired += 1
+            self._wait_time += waited
+            self._max_wait_time = max(self._max_wait_time, waited)
+
+        return connection
+
+    def get_stats(self) -> dict:
+        if hasattr(self, '_in_use_connections'): # ConnectionPool (as the Sentinel one)
+            idle = len(self._available_connections)
+            in_use = len(self._in_use_connections)
+        else: # BlockingConnectionPool: idle connections are the ones in the queue (empty slots are None)
+            idle = len([connection for connection in list(self.pool.queue) if connection is not None])
+            in_use = len(self._connections) - idle
+
+        with self._stats_lock:
+            return {
+                'max_connections': self.max_connections,
+                'in_use': in_use,
+                'idle': idle,
+                'acquired': self._acquired,
+                'failed': self._failed,
+                'average_wait': self._wait_time / self._acquired if self._acquired > 0 else 0.0,
+                'max_wait': self._max_wait_time
+            }
+
+
+class _StatsBlockingConnectionPool(_PoolStatsMixin, BlockingConnectionPool):
+    def __init__(self, *args, **kwargs):
+        self._init_stats()
+        super().__init__(*args, **kwargs)
+
+
+class _StatsSentinelConnectionPool(_PoolStatsMixin, SentinelConnectionPool):
+    def __init__(self, *args, **kwargs):
+        self._init_stats()
+        super().__init__(*args, **kwargs)
+
+
+def _get_config() -> dict:
+    global _CONFIG
+
+    if _CONFIG is None:
+        with open('config.yaml', 'r') as f:
+            _CONFIG = yaml.safe_load(f).get('redis') or {}
+
+    return _CONFIG
+
+
+def _make_pool(db, host=None, port=None):
+    config = _get_config()
+
+    connection_kwargs = {
+        'db': db,
+        'password': os.environ.get('REDIS_PASSWORD') or None,
+        'socket_timeout': config.get('socketTimeout', 5),
+        'socket_connect_timeout': config.get('socketConnectTimeout', 2),
+        'health_check_interval': config.get('healthCheckInterval', 30),
+        'retry': Retry(ExponentialBackoff(cap=1, base=0.05), config.get('retries', 1)) if config.get('retries', 1) > 0 else None,
+        'retry_on_timeout': config.get('retries', 1) > 0
+    }
+
+    sentinel_config = config.get('sentinel') or {}
+    if sentinel_config.get('hosts') and host is None:
+        sentinel = Sentinel(
+            [(host.rsplit(':', 1)[0], int(host.rsplit(':', 1)[1])) for host in sentinel_config['hosts']],
+            sentinel_kwargs={'socket_timeout': connection_kwargs['socket_timeout'], 'password': connection_kwargs['password']}
+        )
+        return sentinel.master_for(
+            sentinel_config.get('service', 'mymaster'),
+            connection_pool_class=_StatsSentinelConnectionPool,
+            max_connections=config.get('maxConnections', 50),
+            **connection_kwargs
+        ).connection_pool
+
+    return _StatsBlockingConnectionPool(
+        host=host or config.get('host', 'redis'),
+        port=port or config.get('port', 6379),
+        max_connections=config.get('maxConnections', 50),
+        timeout=config.get('poolTimeout', 5),
+        **connection_kwargs
+    )
+
+
+def get_redis(db=0, client_class=Redis, host=None, port=None):
+    """
+    Get a client of a Redis database, using the connection pool of that database shared by the whole process (created on first
+    use with the settings found under the 'redis' section of 'config.yaml')
+
+    Args:
+        db (int): Database number
+        client_class (class): Class of the client (Redis or a subclass of it)
+        host (string) (optional): Host of another Redis server (as a shard), instead of the configured one
+        port (int) (optional): Port of that server
+
+    Returns:
+        Instance of 'client_class'
+    """
+
+    key = (host, port, db)
+
+    if key not in _POOLS:
+        with _POOLS_LOCK:
+            if key not in _POOLS:
+                _POOLS[key] = _make_pool(db, host, port)
+
+    return client_class(connection_pool=_POOLS[key])
+
+
+def get_pool_stats() -> dict:
+    """ Get metrics of the connection pool of each database used so far (by 'host:port/database', or just the database number
+    for the configured endpoint): maximum connections
+    ('max_connections'), connections in use ('in_use') and idle ('idle'), connections taken from the pool ('acquired'), failures
+    to get one ('failed': no free connection in time, or Redis unreachable), and average and maximum seconds spent getting one ('average_wait', 'max_wait') """
+
+    with _POOLS_LOCK:
+        pools = dict(_POOLS)
+    return {
+        db if host is None else '{}:{}/{}'.format(host, port, db): pool.get_stats()
+        for (host, port, db), pool in pools.items()
+    }
@@ -1,18 +1,14 @@
 from flask import Flask, jsonify, request, redirect
-from redis import Redis
 
 import string
 import secrets
 import yaml
 
+from redis_connection import get_redis
+
 app = Flask(__name__)
 
-redis = Redis(
-    host = 'redis',
-    port = 6379,
-    #password=,
-    db = 1 # USed for memcache the acess token into telegram bot
-)
+redis = get_redis(db = 1) # USed for memcache the acess token into telegram bot
 
 def code_generator(size, chars=string.ascii_letters + string.digits):
     return ''.join(secrets.choice(chars) for _ in range(size))